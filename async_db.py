@@ -0,0 +1,513 @@
+"""Async-facing database access for Karmabot.
+
+This module provides the AsyncKarmaDatabase class, which exposes awaitable
+counterparts of the KarmaDatabase methods.  Every call is handed to a
+dedicated database worker thread, so a slow disk never stalls the Discord
+event loop.
+
+`shared_database` returns the one AsyncKarmaDatabase each process uses, so
+the bot, leaderboards and users never open the database twice.
+"""
+
+import asyncio
+import functools
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from karma_cache import MISSING, KarmaCache
+from metrics import metrics
+from settings import REGISTRY_FLUSH_INTERVAL
+from spam_limiter import SpamLimiter
+from storage import KarmaUpdate, MemberSync, StorageBackend, open_storage
+
+
+class AsyncKarmaDatabase:
+    """
+    Runs storage backend operations on dedicated worker threads.
+
+    Writes are serialized through a single writer thread.  Reads go to a
+    small pool sized to the database's reader connections, or share the
+    writer thread when the database has none.
+
+    Registry updates are write-behind: the record_* methods only touch the
+    in-memory registry buffer, which is flushed by a background task every
+    REGISTRY_FLUSH_INTERVAL seconds, whenever it fills up, and on close.
+    Karma changes and their events are written immediately, in one
+    transaction.
+
+    Karma cooldowns are checked against an in-memory SpamLimiter first, so
+    spam-rejected adjustments are answered without any database work.
+
+    Karma values are cached in a KarmaCache.  Every karma write made through
+    this class (and, in shard processes, every change announced by the
+    writer) updates or drops the cached value, so get_karma stays exact while
+    repeated queries never leave the event loop.
+    """
+
+    def __init__(self, db: StorageBackend | None = None):
+        """
+        Initialize an AsyncKarmaDatabase instance.
+
+        Args:
+            db (StorageBackend, optional): The database to wrap. If None, the
+                configured storage backend is opened with the default settings.
+        """
+        self.db = db if db is not None else open_storage()
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="karmadb"
+        )
+        self._read_executor = self._executor
+        if self.db.reader_count > 0:
+            self._read_executor = ThreadPoolExecutor(
+                max_workers=self.db.reader_count, thread_name_prefix="karmadb-read"
+            )
+        self._flush_task = None
+        self._pending_flush = None
+        self._listening = False
+        self.spam_limiter = SpamLimiter()
+        self.karma_cache = KarmaCache()
+        metrics.track_cache("karma", self.karma_cache)
+        self.maintenance = None
+
+    @property
+    def guild_scoped(self) -> bool:
+        """Whether karma is tracked per guild rather than globally."""
+        return self.db.guild_scoped
+
+    @property
+    def listening(self) -> bool:
+        """Whether every karma change, this process's own included, arrives
+        through the handler passed to start_karma_listener."""
+        return self._listening
+
+    async def _run(self, func, *args, **kwargs):
+        """Run a blocking database write on the writer thread."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, functools.partial(func, *args, **kwargs)
+        )
+
+    async def _run_read(self, func, *args, **kwargs):
+        """Run a blocking database read on a reader thread."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._read_executor, functools.partial(func, *args, **kwargs)
+        )
+
+    def start_flusher(self, interval: float = REGISTRY_FLUSH_INTERVAL) -> None:
+        """
+        Start the background task that periodically flushes buffered writes.
+
+        Calling this again while the task is running has no effect, so it is
+        safe to call from on_ready, which fires again after reconnects.
+
+        Args:
+            interval (float): Seconds between flushes.
+        """
+        if self._flush_task is not None and not self._flush_task.done():
+            return
+        self._flush_task = asyncio.create_task(self._flush_periodically(interval))
+
+    async def _flush_periodically(self, interval: float) -> None:
+        """Flush buffered writes forever, every `interval` seconds."""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.flush()
+            except (sqlite3.Error, OSError) as exc:
+                # Rows were requeued; the next pass will retry them.
+                print(f"Flush failed: {exc}")
+
+    def start_maintenance(self, scheduler) -> None:
+        """
+        Run database maintenance in the background while the bot is idle.
+
+        Every buffered message counts as activity, and maintenance steps
+        queue on the writer thread like any other write, so they never
+        delay message handling by more than one step.  Calling this again
+        once maintenance is running has no effect.
+
+        Args:
+            scheduler (maintenance.MaintenanceScheduler): The tasks to run.
+        """
+        if self.maintenance is not None:
+            return
+        self.maintenance = scheduler
+        scheduler.start(self._run)
+
+    def start_karma_listener(self, handler) -> None:
+        """
+        Hear about karma changes applied by other shard processes.
+
+        Only databases that forward writes to a shared writer (see
+        db_writer.RemoteKarmaDatabase) publish changes; otherwise this does
+        nothing.  Each change also updates the spam limiter, so cooldowns
+        hold across shards.
+
+        Args:
+            handler: Called on the event loop with (user_id, guild_id, karma).
+        """
+        subscribe = getattr(self.db, "subscribe", None)
+        if subscribe is None or self._listening:
+            return
+        loop = asyncio.get_running_loop()
+
+        def karma_changed(user_id, guild_id, karma, last_karma):
+            key = self.db.karma_key(user_id, guild_id)
+            self.spam_limiter.record(key, last_karma)
+            self.karma_cache.set(key, karma)
+            handler(user_id, guild_id, karma)
+
+        subscribe(
+            lambda *change: loop.call_soon_threadsafe(karma_changed, *change)
+        )
+        self._listening = True
+
+    async def flush_registry(self) -> int:
+        """Awaitable counterpart of KarmaDatabase.flush_registry."""
+        return await self._run(self.db.flush_registry)
+
+    async def flush(self) -> int:
+        """Awaitable counterpart of KarmaDatabase.flush."""
+        return await self._run(self.db.flush)
+
+    async def _flush_for_ranking(self) -> None:
+        """
+        Write buffered registry rows on the writer thread before a ranking.
+
+        Rankings only count current members, so buffered joins and leaves
+        must be visible to the read that follows.
+        """
+        if self.db.registry_buffer:
+            await self._run(self.db.flush_registry)
+
+    def _flush_if_full(self) -> None:
+        """Schedule an early flush once the registry buffer reaches its batch size."""
+        if not self.db.registry_buffer.is_full():
+            return
+        if self._pending_flush is not None and not self._pending_flush.done():
+            return
+        self._pending_flush = asyncio.ensure_future(self.flush())
+
+    def close(self) -> None:
+        """Wait for queued database work, flush buffered writes, and close the database."""
+        self._executor.shutdown(wait=True)
+        self._read_executor.shutdown(wait=True)
+        self.db.flush()
+        self.db.close()
+
+    async def create(
+        self, user_id: int, karma: int = 0, guild_id: int | None = None
+    ) -> None:
+        """Awaitable counterpart of KarmaDatabase.create."""
+        try:
+            await self._run(self.db.create, user_id, karma, guild_id)
+        finally:
+            # The row may already have existed, so the resulting karma is unknown.
+            self.karma_cache.forget(self.db.karma_key(user_id, guild_id))
+
+    async def get_karma(self, user_id: int, guild_id: int | None = None) -> int | None:
+        """
+        Awaitable counterpart of KarmaDatabase.get_karma.
+
+        Cached values are returned without touching the database.
+        """
+        key = self.db.karma_key(user_id, guild_id)
+        karma = self.karma_cache.get(key)
+        if karma is not MISSING:
+            return karma
+        stamp = self.karma_cache.read_stamp()
+        karma = await self._run_read(self.db.get_karma, user_id, guild_id)
+        self.karma_cache.fill(key, karma, stamp)
+        return karma
+
+    async def update(
+        self, user_id: int, delta: int, guild_id: int | None = None
+    ) -> None:
+        """Awaitable counterpart of KarmaDatabase.update."""
+        try:
+            await self._run(self.db.update, user_id, delta, guild_id)
+        finally:
+            self.karma_cache.forget(self.db.karma_key(user_id, guild_id))
+
+    async def warm_spam_limiter(self) -> None:
+        """Load cooldowns still in effect from the karma table's last_karma column."""
+        since = int(time.time() - self.spam_limiter.delay)
+        rows = await self._run_read(self.db.recent_karma_changes, since)
+        self.spam_limiter.warm(rows)
+
+    async def apply_karma(
+        self,
+        user_id: int,
+        delta: int,
+        spam_delay: int,
+        guild_id: int | None = None,
+        giver_id: int | None = None,
+        message_id: int | None = None,
+    ) -> KarmaUpdate:
+        """
+        Awaitable counterpart of KarmaDatabase.apply_karma.
+
+        When spam_delay is set, the in-memory limiter is consulted first; a
+        rejection there returns KarmaUpdate(None, False) without touching
+        the database.
+        """
+        apply = functools.partial(
+            self.db.apply_karma,
+            user_id,
+            delta,
+            spam_delay,
+            guild_id,
+            giver_id,
+            message_id,
+        )
+        key = self.db.karma_key(user_id, guild_id)
+        if not spam_delay:
+            result = await self._run_karma_write(key, apply)
+            self._flush_if_full()
+            return result
+
+        if not self.spam_limiter.try_acquire(key):
+            return KarmaUpdate(None, False)
+        try:
+            result = await self._run_karma_write(key, apply)
+        except Exception:
+            self.spam_limiter.release(key)
+            raise
+        self.spam_limiter.record(key, result.last_karma)
+        self._flush_if_full()
+        return result
+
+    async def apply_karma_batch(
+        self,
+        changes: list[tuple[int, int]],
+        spam_delay: int,
+        guild_id: int | None = None,
+        giver_id: int | None = None,
+        message_id: int | None = None,
+    ) -> list[KarmaUpdate]:
+        """
+        Awaitable counterpart of KarmaDatabase.apply_karma_batch.
+
+        Changes the in-memory limiter rejects get KarmaUpdate(None, False)
+        and are left out of the batch; the rest are written in one
+        transaction on the writer thread.
+        """
+        keys = [self.db.karma_key(user_id, guild_id) for user_id, _ in changes]
+        results = [KarmaUpdate(None, False)] * len(changes)
+        if spam_delay:
+            admitted = [
+                i for i, key in enumerate(keys) if self.spam_limiter.try_acquire(key)
+            ]
+        else:
+            admitted = list(range(len(changes)))
+        if not admitted:
+            return results
+
+        apply = functools.partial(
+            self.db.apply_karma_batch,
+            [changes[i] for i in admitted],
+            spam_delay,
+            guild_id,
+            giver_id,
+            message_id,
+        )
+        try:
+            updates = await self._run(apply)
+        except Exception:
+            for i in admitted:
+                if spam_delay:
+                    self.spam_limiter.release(keys[i])
+                self.karma_cache.forget(keys[i])
+            raise
+        for i, result in zip(admitted, updates):
+            if spam_delay:
+                self.spam_limiter.record(keys[i], result.last_karma)
+            self._cache_karma_write(keys[i], result)
+            results[i] = result
+        self._flush_if_full()
+        return results
+
+    async def _run_karma_write(self, key, apply) -> KarmaUpdate:
+        """Run a karma adjustment and write its result through to the karma cache."""
+        try:
+            result = await self._run(apply)
+        except Exception:
+            self.karma_cache.forget(key)
+            raise
+        self._cache_karma_write(key, result)
+        return result
+
+    def _cache_karma_write(self, key, result: KarmaUpdate) -> None:
+        """Write a karma adjustment's result through to the karma cache."""
+        if result.karma is None or self._listening:
+            # Shard processes hear every change, their own included, in
+            # commit order from the writer; replies can overtake that stream,
+            # so the cached value is left to the listener.
+            self.karma_cache.forget(key)
+        else:
+            self.karma_cache.set(key, result.karma)
+
+    async def delete(self, user_id: int, guild_id: int | None = None) -> None:
+        """Awaitable counterpart of KarmaDatabase.delete."""
+        key = self.db.karma_key(user_id, guild_id)
+        try:
+            await self._run(self.db.delete, user_id, guild_id)
+        except Exception:
+            self.karma_cache.forget(key)
+            raise
+        self.karma_cache.set(key, None)
+
+    async def can_update_karma(self, user_id: int, guild_id: int | None = None) -> bool:
+        """Awaitable counterpart of KarmaDatabase.can_update_karma."""
+        return await self._run_read(self.db.can_update_karma, user_id, guild_id)
+
+    async def all_user_ids_and_karma(self) -> list[tuple[int, int]]:
+        """Collect KarmaDatabase.all_user_ids_and_karma into a list on a reader thread."""
+        return await self._run_read(list, self.db.all_user_ids_and_karma())
+
+    async def all_user_ids(self) -> list[int]:
+        """Collect KarmaDatabase.all_user_ids into a list on a reader thread."""
+        return await self._run_read(list, self.db.all_user_ids())
+
+    async def karma_user_count(self) -> int:
+        """Awaitable counterpart of KarmaDatabase.karma_user_count."""
+        return await self._run_read(self.db.karma_user_count)
+
+    async def upsert_guild(self, guild_id: int, guild_name: str) -> None:
+        """Awaitable counterpart of KarmaDatabase.upsert_guild."""
+        await self._run(self.db.upsert_guild, guild_id, guild_name)
+
+    async def upsert_user(self, user_id: int, user_name: str) -> None:
+        """Awaitable counterpart of KarmaDatabase.upsert_user."""
+        await self._run(self.db.upsert_user, user_id, user_name)
+
+    async def upsert_user_nickname(
+        self,
+        user_id: int,
+        guild_id: int,
+        nickname: str | None,
+        is_member: int | None,
+    ) -> None:
+        """Awaitable counterpart of KarmaDatabase.upsert_user_nickname."""
+        await self._run(
+            self.db.upsert_user_nickname, user_id, guild_id, nickname, is_member
+        )
+
+    async def sync_guild_members(self, guild) -> MemberSync:
+        """
+        Reconcile a guild's registry rows with its cached member list.
+
+        The member list is snapshotted on the event loop; the diff and the
+        writes run on the writer thread.
+        """
+        members = [
+            (member.id, member.name, member.nick) for member in guild.members
+        ]
+        return await self._run(
+            self.db.sync_guild_members, guild.id, guild.name, members
+        )
+
+    async def record_guild(self, guild) -> None:
+        """Buffer a guild for the registry without touching the disk."""
+        self.db.record_guild(guild)
+        self._flush_if_full()
+
+    async def record_member(self, member, guild=None) -> None:
+        """Buffer a member for the registry without touching the disk."""
+        self.db.record_member(member, guild)
+        self._flush_if_full()
+
+    async def record_departed_member(self, member, guild=None) -> None:
+        """Buffer a departed member for the registry without touching the disk."""
+        self.db.record_departed_member(member, guild)
+        self._flush_if_full()
+
+    async def record_message(self, message) -> None:
+        """Buffer a message's registry data without touching the disk."""
+        if self.maintenance is not None:
+            self.maintenance.note_activity()
+        self.db.record_message(message)
+        self._flush_if_full()
+
+    async def get_top_karma_entries(
+        self, guild_id: int, limit: int
+    ) -> list[sqlite3.Row]:
+        """Awaitable counterpart of KarmaDatabase.get_top_karma_entries."""
+        await self._flush_for_ranking()
+        return await self._run_read(self.db.get_top_karma_entries, guild_id, limit)
+
+    async def get_bottom_karma_entries(
+        self, guild_id: int, limit: int
+    ) -> list[sqlite3.Row]:
+        """Awaitable counterpart of KarmaDatabase.get_bottom_karma_entries."""
+        await self._flush_for_ranking()
+        return await self._run_read(self.db.get_bottom_karma_entries, guild_id, limit)
+
+    async def get_windowed_karma_entries(
+        self, guild_id: int, days: int, limit: int, descending: bool = True
+    ) -> list[sqlite3.Row]:
+        """Awaitable counterpart of KarmaDatabase.get_windowed_karma_entries."""
+        await self._flush_for_ranking()
+        return await self._run_read(
+            self.db.get_windowed_karma_entries, guild_id, days, limit, descending
+        )
+
+    async def member_karma_rows(self) -> list[tuple[int, int, int]]:
+        """Awaitable counterpart of KarmaDatabase.member_karma_rows."""
+        await self._flush_for_ranking()
+        return await self._run_read(self.db.member_karma_rows)
+
+    async def all_guild_ids(self) -> list[int]:
+        """Awaitable counterpart of KarmaDatabase.all_guild_ids."""
+        return await self._run_read(self.db.all_guild_ids)
+
+    async def registry_backfill_plan(
+        self, guild_id: int, after_user_id: int = 0
+    ) -> list[int]:
+        """Awaitable counterpart of KarmaDatabase.registry_backfill_plan."""
+        return await self._run_read(
+            self.db.registry_backfill_plan, guild_id, after_user_id
+        )
+
+    async def mark_departed(self, guild_id: int, user_ids: list[int]) -> None:
+        """Awaitable counterpart of KarmaDatabase.mark_departed."""
+        await self._run(self.db.mark_departed, guild_id, user_ids)
+
+    async def needs_registry_backfill(self, user_id: int, guild_id: int) -> bool:
+        """Awaitable counterpart of KarmaDatabase.needs_registry_backfill."""
+        return await self._run_read(self.db.needs_registry_backfill, user_id, guild_id)
+
+    async def has_user_registry_entry(self, user_id: int) -> bool:
+        """Awaitable counterpart of KarmaDatabase.has_user_registry_entry."""
+        return await self._run_read(self.db.has_user_registry_entry, user_id)
+
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def shared_database(db: StorageBackend | None = None) -> AsyncKarmaDatabase:
+    """
+    Return the process-wide AsyncKarmaDatabase, opening it on first use.
+
+    Args:
+        db (StorageBackend, optional): The database to wrap on first use,
+            e.g. a RemoteKarmaDatabase in a shard process. If None, the
+            configured storage backend is opened.
+
+    Returns:
+        AsyncKarmaDatabase: The shared instance.
+
+    Raises:
+        ValueError: If `db` is given after a different database was shared.
+    """
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = AsyncKarmaDatabase(db)
+        elif db is not None and db is not _shared.db:
+            raise ValueError("A different database is already shared.")
+        return _shared
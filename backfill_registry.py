@@ -1,85 +1,377 @@
-"""Slowly populate the local user/guild registry for existing karma rows."""
+"""Populate the local user/guild registry for existing karma rows.
+
+Members are resolved in bulk over the gateway, either by chunking a whole
+guild or with `query_members` batches of up to 100 user IDs, whichever
+needs fewer requests.  Guilds are processed concurrently, sharing one
+adaptive rate limiter.
+
+Each guild's work list comes from a single set-based query, results are
+written one batch per transaction, and progress is checkpointed to a file
+so an interrupted run picks up where it stopped.
+"""
 
 import argparse
 import asyncio
+import json
+import math
+import os
+import time
 
 import discord
 
-from db import KarmaDatabase
+from async_db import AsyncKarmaDatabase
+from rate_limiter import AdaptiveRateLimiter
 from settings import DISCORD_API_KEY
 
+# Discord caps query_members at 100 user IDs per request.
+MAX_QUERY_BATCH = 100
+# Members per gateway chunk when requesting a whole guild.
+CHUNK_SIZE = 1000
+# Attempts per request before a batch is counted as failed.
+MAX_ATTEMPTS = 5
+# Errors that fail a request once its retries are used up.
+REQUEST_ERRORS = (discord.HTTPException, discord.RateLimited, asyncio.TimeoutError)
+# Where progress is saved between runs.
+DEFAULT_CHECKPOINT = "backfill_checkpoint.json"
+
+
+def _retry_after(exc: discord.HTTPException) -> float | None:
+    """Return the Retry-After header of a 429 response, if it has one."""
+    response = getattr(exc, "response", None)
+    value = response.headers.get("Retry-After") if response is not None else None
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+class BackfillCheckpoint:
+    """
+    Progress of a backfill run, saved to a JSON file after every batch.
+
+    Records which guilds are finished and, for guilds in progress, the
+    highest user ID before which every user was handled (work lists are in
+    user ID order) and how many users were written so far.  A guild with
+    failed batches is never finished, so the next run retries it.
+    """
+
+    def __init__(self, path: str):
+        """
+        Load a checkpoint, or start an empty one if the file does not exist.
+
+        Args:
+            path (str): The checkpoint file.
+        """
+        self.path = path
+        self.completed: set[int] = set()
+        self.cursors: dict[int, int] = {}
+        self.stored: dict[int, int] = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as file:
+                data = json.load(file)
+            self.completed = set(data.get("completed", []))
+            self.cursors = {
+                int(guild_id): user_id
+                for guild_id, user_id in data.get("cursors", {}).items()
+            }
+            self.stored = {
+                int(guild_id): count
+                for guild_id, count in data.get("stored", {}).items()
+            }
+
+    def __bool__(self) -> bool:
+        """Return True if there is saved progress to resume from."""
+        return bool(self.completed or self.cursors or self.stored)
+
+    def cursor(self, guild_id: int) -> int:
+        """Return the user ID up to which every user in a guild is handled."""
+        return self.cursors.get(guild_id, 0)
+
+    def stored_count(self, guild_id: int) -> int:
+        """Return the number of users written in a guild by earlier runs."""
+        return self.stored.get(guild_id, 0)
+
+    def advance(self, guild_id: int, stored: int, user_id: int | None = None) -> None:
+        """
+        Record a written batch, and save.
+
+        Args:
+            guild_id (int): The guild the batch belongs to.
+            stored (int): The number of users written.
+            user_id (int, optional): Move the guild's cursor here; only given
+                while no earlier batch in the guild has failed.
+        """
+        self.stored[guild_id] = self.stored.get(guild_id, 0) + stored
+        if user_id is not None:
+            self.cursors[guild_id] = user_id
+        self.save()
+
+    def complete(self, guild_id: int) -> None:
+        """Record that a guild is finished, and save."""
+        self.completed.add(guild_id)
+        self.cursors.pop(guild_id, None)
+        self.stored.pop(guild_id, None)
+        self.save()
+
+    def save(self) -> None:
+        """Atomically write the checkpoint file."""
+        data = {
+            "completed": sorted(self.completed),
+            "cursors": {
+                str(guild_id): user_id for guild_id, user_id in self.cursors.items()
+            },
+            "stored": {
+                str(guild_id): count for guild_id, count in self.stored.items()
+            },
+        }
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as file:
+            json.dump(data, file)
+        os.replace(temp_path, self.path)
+
+    def discard(self) -> None:
+        """Delete the checkpoint file after a finished run."""
+        self.completed.clear()
+        self.cursors.clear()
+        self.stored.clear()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
 
 class RegistryBackfillClient(discord.Client):
     """Discord client that fills in local registry data with rate limiting."""
 
-    def __init__(self, request_delay: float, retry_delay: float):
+    def __init__(
+        self,
+        request_delay: float,
+        retry_delay: float,
+        concurrency: int = 4,
+        batch_size: int = MAX_QUERY_BATCH,
+        progress_interval: float = 10.0,
+        checkpoint_path: str = DEFAULT_CHECKPOINT,
+        restart: bool = False,
+    ):
         intents = discord.Intents.default()
         intents.members = True
-        super().__init__(intents=intents)
-        self.db = KarmaDatabase()
-        self.request_delay = request_delay
+        # Guilds are chunked on demand, only when that is the cheaper option.
+        super().__init__(
+            intents=intents, chunk_guilds_at_startup=False, max_ratelimit_timeout=30.0
+        )
+        # Database work runs on its own threads, so writes never stall the
+        # gateway or the other guilds' requests.
+        self.db = AsyncKarmaDatabase()
+        self.limiter = AdaptiveRateLimiter(request_delay)
         self.retry_delay = retry_delay
+        self.concurrency = concurrency
+        self.batch_size = max(1, min(batch_size, MAX_QUERY_BATCH))
+        self.progress_interval = progress_interval
+        self.checkpoint = BackfillCheckpoint(checkpoint_path)
+        if restart:
+            self.checkpoint.discard()
+        self.resolved = 0
+        self.resumed = 0
+        self.skipped = 0
+        self.missing = 0
+        self.errors = 0
+        self.guilds_done = 0
+        self.started = 0.0
 
     async def on_ready(self):
         """Backfill the local registry once the bot is connected."""
         print(f"Logged in as {self.user.name} ({self.user.id})")
 
-        karma_user_ids = self.db.all_user_ids()
-        if not karma_user_ids:
+        karma_user_count = await self.db.karma_user_count()
+        if not karma_user_count:
             print("No karma-tracked users found. Nothing to backfill.")
             await self.close()
             return
+        if self.checkpoint:
+            print(
+                f"Resuming from {self.checkpoint.path}: "
+                f"{len(self.checkpoint.completed)} guilds already done."
+            )
+
+        self.started = time.monotonic()
+        reporter = asyncio.create_task(self._report_progress())
+        slots = asyncio.Semaphore(self.concurrency)
+
+        async def run(guild):
+            async with slots:
+                await self.backfill_guild(guild, karma_user_count)
 
-        fetched = 0
-        skipped = 0
-        missing = 0
-        errors = 0
-
-        for guild in self.guilds:
-            self.db.record_guild(guild)
-            print(f"Scanning guild: {guild.name} ({guild.id})")
-
-            for user_id in karma_user_ids:
-                if not self.db.needs_registry_backfill(user_id, guild.id):
-                    skipped += 1
-                    continue
-
-                member = guild.get_member(user_id)
-                fetched_from_api = False
-
-                if member is None:
-                    try:
-                        member = await guild.fetch_member(user_id)
-                        fetched_from_api = True
-                    except discord.NotFound:
-                        if not self.db.has_user_registry_entry(user_id):
-                            self.db.upsert_user(user_id, f"user-{user_id}")
-                        self.db.upsert_user_nickname(user_id, guild.id, None, 0)
-                        missing += 1
-                        if self.request_delay > 0:
-                            await asyncio.sleep(self.request_delay)
-                        continue
-                    except discord.HTTPException as exc:
-                        errors += 1
-                        print(
-                            f"Fetch failed for user {user_id} in guild {guild.id}: "
-                            f"{exc.status} {exc}"
-                        )
-                        await asyncio.sleep(self.retry_delay)
-                        continue
-
-                self.db.record_member(member, guild)
-                fetched += 1
-
-                if fetched_from_api and self.request_delay > 0:
-                    await asyncio.sleep(self.request_delay)
+        try:
+            await asyncio.gather(*(run(guild) for guild in self.guilds))
+        finally:
+            reporter.cancel()
 
+        if self.errors:
+            # Guilds with failed batches keep their cursors, so the next run
+            # retries exactly the users that were not handled.
+            print(
+                "Run again to retry the failed users; "
+                f"progress is kept in {self.checkpoint.path}."
+            )
+        else:
+            self.checkpoint.discard()
         print(
             "Backfill complete. "
-            f"fetched={fetched} skipped={skipped} missing={missing} errors={errors}"
+            f"resolved={self.resolved} resumed={self.resumed} "
+            f"skipped={self.skipped} missing={self.missing} errors={self.errors} "
+            f"in {time.monotonic() - self.started:.1f}s"
         )
         await self.close()
 
+    async def backfill_guild(self, guild: discord.Guild, karma_user_count: int):
+        """Resolve every karma user lacking registry data for one guild."""
+        if guild.id in self.checkpoint.completed:
+            self.guilds_done += 1
+            return
+
+        await self.db.record_guild(guild)
+        # Departed users are written directly and need the guild row first.
+        await self.db.flush_registry()
+        pending = await self.db.registry_backfill_plan(
+            guild.id, self.checkpoint.cursor(guild.id)
+        )
+        # Users written by an earlier run now have registry rows, so they
+        # are missing from the plan without having been skipped.
+        resumed = self.checkpoint.stored_count(guild.id)
+        self.resumed += resumed
+        self.skipped += max(0, karma_user_count - resumed - len(pending))
+        succeeded = True
+        if pending:
+            print(f"Scanning guild: {guild.name} ({guild.id}), {len(pending)} users")
+            if self._should_chunk(guild, len(pending)):
+                succeeded = await self._resolve_by_chunking(guild, pending)
+            else:
+                succeeded = await self._resolve_by_query(guild, pending)
+        if succeeded:
+            self.checkpoint.complete(guild.id)
+        self.guilds_done += 1
+
+    def _should_chunk(self, guild: discord.Guild, pending: int) -> bool:
+        """Return True when chunking the whole guild takes fewer requests."""
+        if guild.chunked:
+            return True
+        if guild.member_count is None:
+            return False
+        chunk_requests = math.ceil(guild.member_count / CHUNK_SIZE)
+        return chunk_requests <= math.ceil(pending / self.batch_size)
+
+    async def _resolve_by_chunking(
+        self, guild: discord.Guild, pending: list[int]
+    ) -> bool:
+        """
+        Load the guild's full member list, then resolve users from the cache.
+
+        Returns:
+            bool: False if the guild could not be chunked.
+        """
+        if not guild.chunked:
+            try:
+                await self._request(guild.chunk)
+            except REQUEST_ERRORS as exc:
+                self.errors += len(pending)
+                print(f"Chunking guild {guild.id} failed: {exc}")
+                return False
+        found = {user_id: guild.get_member(user_id) for user_id in pending}
+        await self._store_batch(guild, pending, found, advance=True)
+        return True
+
+    async def _resolve_by_query(self, guild: discord.Guild, pending: list[int]) -> bool:
+        """
+        Resolve users with batched query_members requests.
+
+        The checkpoint cursor only moves over the batches before the first
+        failure, so a resumed run retries every user that was not handled.
+
+        Returns:
+            bool: False if any batch failed.
+        """
+        succeeded = True
+        for start in range(0, len(pending), self.batch_size):
+            batch = pending[start : start + self.batch_size]
+            try:
+                members = await self._request(
+                    guild.query_members, user_ids=batch, limit=len(batch), cache=False
+                )
+            except REQUEST_ERRORS as exc:
+                self.errors += len(batch)
+                print(f"Member query failed in guild {guild.id}: {exc}")
+                succeeded = False
+                continue
+            await self._store_batch(
+                guild, batch, {member.id: member for member in members}, succeeded
+            )
+        return succeeded
+
+    async def _store_batch(
+        self, guild: discord.Guild, user_ids: list[int], found: dict, advance: bool
+    ):
+        """
+        Record resolved members, mark the rest as no longer in the guild, and
+        checkpoint the batch once it is written.
+
+        Args:
+            advance (bool): Move the guild's cursor past the batch, which is
+                only safe while every earlier batch succeeded.
+        """
+        departed = []
+        for user_id in user_ids:
+            member = found.get(user_id)
+            if member is not None:
+                await self.db.record_member(member, guild)
+            else:
+                departed.append(user_id)
+        await self.db.flush_registry()
+        if departed:
+            await self.db.mark_departed(guild.id, departed)
+        self.resolved += len(user_ids) - len(departed)
+        self.missing += len(departed)
+        self.checkpoint.advance(
+            guild.id, len(user_ids), user_ids[-1] if advance else None
+        )
+
+    async def _request(self, func, *args, **kwargs):
+        """
+        Make one Discord request under the shared rate limiter.
+
+        Rate limits (429s and gateway timeouts) slow the limiter down and are
+        retried; after MAX_ATTEMPTS the last error is raised.
+        """
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            await self.limiter.acquire()
+            try:
+                result = await func(*args, **kwargs)
+            except discord.RateLimited as exc:
+                self.limiter.limited(exc.retry_after)
+                if attempt == MAX_ATTEMPTS:
+                    raise
+            except discord.HTTPException as exc:
+                if exc.status != 429 or attempt == MAX_ATTEMPTS:
+                    raise
+                self.limiter.limited(_retry_after(exc))
+            except asyncio.TimeoutError:
+                self.limiter.limited(self.retry_delay)
+                if attempt == MAX_ATTEMPTS:
+                    raise
+            else:
+                self.limiter.succeeded()
+                return result
+
+    async def _report_progress(self):
+        """Print progress and throughput every progress_interval seconds."""
+        while True:
+            await asyncio.sleep(self.progress_interval)
+            elapsed = time.monotonic() - self.started
+            done = self.resolved + self.missing + self.errors
+            print(
+                f"[{elapsed:.0f}s] guilds {self.guilds_done}/{len(self.guilds)} "
+                f"resolved={self.resolved} missing={self.missing} errors={self.errors} "
+                f"({done / elapsed:.1f} users/s, {self.limiter.rate:.2f} req/s, "
+                f"rate limited {self.limiter.rate_limited}x)"
+            )
+
 
 def parse_args() -> argparse.Namespace:
     """Parse command-line arguments for the backfill job."""
@@ -88,25 +380,68 @@ def parse_args() -> argparse.Namespace:
         "--request-delay",
         type=float,
         default=1.5,
-        help="Seconds to wait after each Discord API member fetch.",
+        help="Starting seconds between member requests, shared by all guilds. "
+        "Shrinks while requests succeed and grows when Discord rate limits us.",
     )
     parser.add_argument(
         "--retry-delay",
         type=float,
         default=30.0,
-        help="Seconds to wait after a Discord HTTP error before continuing.",
+        help="Seconds to pause after a member request times out.",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=4,
+        help="Number of guilds processed at the same time.",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=MAX_QUERY_BATCH,
+        help=f"User IDs per member query (at most {MAX_QUERY_BATCH}).",
+    )
+    parser.add_argument(
+        "--progress-interval",
+        type=float,
+        default=10.0,
+        help="Seconds between progress reports.",
+    )
+    parser.add_argument(
+        "--checkpoint",
+        default=DEFAULT_CHECKPOINT,
+        help="File that records progress, so an interrupted run can resume.",
+    )
+    parser.add_argument(
+        "--restart",
+        action="store_true",
+        help="Ignore any saved checkpoint and start from the beginning.",
     )
     return parser.parse_args()
 
 
-async def main(request_delay: float, retry_delay: float) -> None:
+async def main(
+    request_delay: float,
+    retry_delay: float,
+    concurrency: int = 4,
+    batch_size: int = MAX_QUERY_BATCH,
+    progress_interval: float = 10.0,
+    checkpoint_path: str = DEFAULT_CHECKPOINT,
+    restart: bool = False,
+) -> None:
     """Run the backfill client with explicit async lifecycle management."""
     client = RegistryBackfillClient(
         request_delay=request_delay,
         retry_delay=retry_delay,
+        concurrency=concurrency,
+        batch_size=batch_size,
+        progress_interval=progress_interval,
+        checkpoint_path=checkpoint_path,
+        restart=restart,
     )
     async with client:
         await client.start(DISCORD_API_KEY)
+    client.db.close()
     await asyncio.sleep(0)
 
 
@@ -116,5 +451,10 @@ if __name__ == "__main__":
         main(
             request_delay=args.request_delay,
             retry_delay=args.retry_delay,
+            concurrency=args.concurrency,
+            batch_size=args.batch_size,
+            progress_interval=args.progress_interval,
+            checkpoint_path=args.checkpoint,
+            restart=args.restart,
         )
     )
@@ -0,0 +1,247 @@
+"""End-to-end benchmark for Karmabot's message handling.
+
+Feeds synthetic server traffic through karmabot.on_message using small
+stand-ins for discord.Message, Member, Guild and TextChannel, against a
+throwaway SQLite file.  No Discord connection is made.
+
+Reports messages per second, p50/p99 handler latency, and SQLite statements
+executed per message (counted with sqlite3 trace callbacks on every
+connection the bot holds).
+
+Usage:
+    python ./bench_bot.py [--messages N] [--users U] [--concurrency C]
+                          [--seed S] [--no-spam-delay] [--backend B]
+
+With the spam delay on (as configured in settings.py), most adjustments to
+a popular user are rejected in memory; --no-spam-delay makes every
+adjustment reach the database.  --backend memory runs against the
+in-memory journaled storage backend instead of SQLite; SQLite statements
+are then not counted.
+"""
+
+import argparse
+import asyncio
+import itertools
+import os
+import random
+import statistics
+import tempfile
+import time
+
+import settings
+
+from bench_parser import CHATTER, _mention
+
+_message_ids = itertools.count(1)
+
+
+class FakeGuild:
+    """Stand-in for discord.Guild."""
+
+    def __init__(self, guild_id: int, name: str):
+        self.id = guild_id
+        self.name = name
+        self.me = None
+        self.members: dict[int, "FakeMember"] = {}
+
+    def get_member(self, user_id: int):
+        """Return a cached member, like discord.Guild.get_member."""
+        return self.members.get(user_id)
+
+
+class FakeMember:
+    """Stand-in for discord.Member."""
+
+    def __init__(self, user_id: int, name: str, guild: FakeGuild, bot: bool = False):
+        self.id = user_id
+        self.name = name
+        self.nick = None
+        self.display_name = name
+        self.bot = bot
+        self.guild = guild
+        guild.members[user_id] = self
+
+    def __eq__(self, other) -> bool:
+        return getattr(other, "id", None) == self.id
+
+    def __hash__(self) -> int:
+        return hash(self.id)
+
+
+class FakeTextChannel:
+    """Stand-in for discord.TextChannel that records what the bot sends."""
+
+    def __init__(self, channel_id: int, guild: FakeGuild):
+        self.id = channel_id
+        self.guild = guild
+        self.sent: list[str] = []
+
+    async def send(self, content: str) -> None:
+        """Record an outgoing message."""
+        self.sent.append(content)
+
+
+class FakeMessage:
+    """Stand-in for discord.Message."""
+
+    def __init__(
+        self, author: FakeMember, channel: FakeTextChannel, content: str, mentions
+    ):
+        self.id = next(_message_ids)
+        self.author = author
+        self.channel = channel
+        self.guild = channel.guild
+        self.content = content
+        self.mentions = list(mentions)
+
+
+class FakeClient:
+    """Stand-in for the discord.Client attributes on_message reads."""
+
+    def __init__(self, user: FakeMember):
+        self.user = user
+
+
+def build_traffic(
+    count: int, guild: FakeGuild, channels: list[FakeTextChannel], seed: int
+) -> list[FakeMessage]:
+    """
+    Build a message mix weighted towards plain chatter, as on a real server.
+
+    Karma adjustments, queries, rank lookups, leaderboards and multi-mention
+    messages are mixed in.
+    """
+    rng = random.Random(seed)
+    bot_member = guild.me
+    members = [member for member in guild.members.values() if not member.bot]
+    traffic = []
+    for _ in range(count):
+        author = rng.choice(members)
+        channel = rng.choice(channels)
+        target = rng.choice(members)
+        roll = rng.random()
+        if roll < 0.60:
+            content, mentions = rng.choice(CHATTER), []
+        elif roll < 0.75:
+            symbols = rng.choice(["+", "++", "+++", "-", "--", "++++++++"])
+            content, mentions = f"{_mention(target.id)} {symbols} nice one", [target]
+        elif roll < 0.82:
+            content, mentions = f"{_mention(target.id)} karma", [target]
+        elif roll < 0.86:
+            content, mentions = f"{_mention(target.id)} rank", [target]
+        elif roll < 0.91:
+            content = f"hey {_mention(target.id)} {rng.choice(CHATTER)}"
+            mentions = [target]
+        elif roll < 0.95:
+            command = rng.choice(["top", "bottom", "top week", "bottom month"])
+            content, mentions = f"{_mention(bot_member.id)} {command}", [bot_member]
+        else:
+            targets = rng.sample(members, rng.randint(2, 5))
+            content = " ".join(
+                f"{_mention(member.id)} {rng.choice(['++', '--', 'karma'])}"
+                for member in targets
+            )
+            mentions = targets
+        traffic.append(FakeMessage(author, channel, content, mentions))
+    return traffic
+
+
+def trace_statements(db, counter: list[int]) -> None:
+    """Count every statement run on the database's connections into counter[0]."""
+
+    def trace(_statement):
+        counter[0] += 1
+
+    db._writer.set_trace_callback(trace)
+    if db._readers is not None:
+        readers = [db._readers.get() for _ in range(db.reader_count)]
+        for conn in readers:
+            conn.set_trace_callback(trace)
+            db._readers.put(conn)
+
+
+async def run(args: argparse.Namespace, karmabot) -> None:
+    """Drive the traffic through on_message and print the results."""
+    guild = FakeGuild(1, "bench")
+    guild.me = FakeMember(2, "KarmaBot", guild, bot=True)
+    for user_id in range(100, 100 + args.users):
+        FakeMember(user_id, f"user{user_id}", guild)
+    channels = [FakeTextChannel(10 + index, guild) for index in range(4)]
+    traffic = build_traffic(args.messages, guild, channels, args.seed)
+
+    karmabot.bot = FakeClient(guild.me)
+    if args.no_spam_delay:
+        karmabot.ENFORCE_KARMA_SPAM_DELAY = False
+    karmabot.replies = karmabot.ReplyQueue(
+        coalesce_window=0, rate_limit=args.messages, rate_period=1.0
+    )
+    db = karmabot.db
+    db.start_flusher()
+    await db.record_guild(guild)
+    for member in guild.members.values():
+        await db.record_member(member)
+    await db.flush()
+    karmabot.ranks.load(await db.member_karma_rows())
+
+    statements = [0]
+    if args.backend == "sqlite":
+        trace_statements(db.db, statements)
+    latencies = []
+    limit = asyncio.Semaphore(args.concurrency)
+
+    async def handle(message):
+        async with limit:
+            started = time.perf_counter()
+            await karmabot.on_message(message)
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(handle(message) for message in traffic))
+    elapsed = time.perf_counter() - started
+
+    await db.flush()
+    while karmabot.replies._tasks:
+        await asyncio.sleep(0.01)
+    sent = sum(len(channel.sent) for channel in channels)
+
+    latencies.sort()
+    p50 = statistics.median(latencies) * 1e3
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1e3
+    print(f"messages          {len(traffic)}")
+    print(f"throughput        {len(traffic) / elapsed:10.1f} msgs/sec")
+    print(f"latency p50       {p50:10.3f} ms")
+    print(f"latency p99       {p99:10.3f} ms")
+    if args.backend == "sqlite":
+        print(f"sqlite statements {statements[0] / len(traffic):10.2f} per message")
+    print(f"registry cache    {db.db.registry_cache.hit_rate():10.1%} of writes skipped")
+    print(f"karma cache       {db.karma_cache.hit_rate():10.1%} of lookups hit")
+    print(f"replies sent      {sent}")
+
+
+def main() -> None:
+    """Set up a temporary database, import the bot against it, and run."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=5_000)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--no-spam-delay", action="store_true")
+    parser.add_argument("--backend", choices=("sqlite", "memory"), default="sqlite")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # Point the bot at a throwaway database before it opens one on import.
+        settings.SQLITE_DB = os.path.join(tmp, "bench.sqlite3")
+        settings.MEMORY_DB_JOURNAL = os.path.join(tmp, "bench.journal")
+        settings.MEMORY_DB_SNAPSHOT = os.path.join(tmp, "bench.snapshot")
+        settings.STORAGE_BACKEND = args.backend
+        import karmabot
+
+        try:
+            asyncio.run(run(args, karmabot))
+        finally:
+            karmabot.db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""Micro-benchmark for Karmabot's message parser.
+
+Compares the single-pass parser in karma_parser.py with the previous
+approach of compiling two regexes per mentioned user per message, over a
+corpus of realistic messages.
+
+Usage:
+    python ./bench_parser.py [--messages N] [--repeat R]
+"""
+
+import argparse
+import random
+import re
+import timeit
+
+from karma_parser import parse_karma_commands
+
+CHATTER = [
+    "lol",
+    "anyone up for a game tonight?",
+    "brb getting coffee",
+    "that patch note is wild, did you see the balance changes?",
+    "https://example.com/some/long/link?with=query&params=1",
+    "```py\nprint('hello world')\n```",
+    "I think the --verbose flag is what you want",
+    "c++ is fine actually",
+    "ok :thumbsup:",
+]
+
+
+def _mention(user_id: int) -> str:
+    """Return a mention token, sometimes in the nickname form."""
+    return f"<@!{user_id}>" if user_id % 3 == 0 else f"<@{user_id}>"
+
+
+def build_corpus(count: int, seed: int = 1234) -> list[tuple[str, list[int]]]:
+    """
+    Build a corpus of (content, mentioned user IDs) pairs.
+
+    The mix is weighted towards plain chatter, as on a real server, with
+    karma adjustments, queries, conversational mentions and multi-mention
+    messages mixed in.
+    """
+    rng = random.Random(seed)
+    user_ids = [rng.randrange(10**17, 10**18) for _ in range(200)]
+    corpus = []
+    for _ in range(count):
+        roll = rng.random()
+        if roll < 0.70:
+            corpus.append((rng.choice(CHATTER), []))
+        elif roll < 0.80:
+            user_id = rng.choice(user_ids)
+            symbols = rng.choice(["+", "++", "+++", "-", "--", "++++++++"])
+            corpus.append((f"{_mention(user_id)} {symbols} nice one", [user_id]))
+        elif roll < 0.85:
+            user_id = rng.choice(user_ids)
+            corpus.append((f"{_mention(user_id)} karma", [user_id]))
+        elif roll < 0.95:
+            user_id = rng.choice(user_ids)
+            corpus.append((f"hey {_mention(user_id)} {rng.choice(CHATTER)}", [user_id]))
+        else:
+            targets = rng.sample(user_ids, rng.randint(2, 5))
+            content = " ".join(
+                f"{_mention(user_id)} {rng.choice(['++', '--', 'karma'])}"
+                for user_id in targets
+            )
+            corpus.append((content, targets))
+    return corpus
+
+
+def legacy_parse(content: str, mentioned_ids: list[int]) -> dict:
+    """The previous per-mention parsing, kept here as the baseline."""
+    commands = {}
+    for user_id in mentioned_ids:
+        mention_str = f"<@{user_id}>"
+        alt_mention_str = f"<@!{user_id}>"
+        karma_query_pattern = (
+            rf"({re.escape(mention_str)}|{re.escape(alt_mention_str)})\s*karma\b"
+        )
+        karma_adjustment_pattern = (
+            rf"({re.escape(mention_str)}|{re.escape(alt_mention_str)})\s*([+-]+)"
+        )
+        if re.search(karma_query_pattern, content, re.IGNORECASE):
+            commands[user_id] = "query"
+        elif match := re.search(karma_adjustment_pattern, content):
+            commands[user_id] = match.group(2)
+    return commands
+
+
+def main() -> None:
+    """Run both parsers over the corpus and report per-message timings."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=10_000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    corpus = build_corpus(args.messages)
+
+    def run_legacy():
+        for content, mentioned_ids in corpus:
+            legacy_parse(content, mentioned_ids)
+
+    def run_single_pass():
+        for content, _ in corpus:
+            parse_karma_commands(content)
+
+    for name, func in (("legacy", run_legacy), ("single-pass", run_single_pass)):
+        best = min(timeit.repeat(func, number=1, repeat=args.repeat))
+        per_message = best / len(corpus) * 1e6
+        print(f"{name:<12} {per_message:8.2f} us/message  ({best:.3f}s best of {args.repeat})")
+
+
+if __name__ == "__main__":
+    main()
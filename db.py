@@ -1,134 +1,579 @@
 """Database handling for Karmabot.
 
-This module provides the KarmaDatabase class, which encapsulates all
-CRUD operations for managing user karma in a SQLite database.
+This module provides the KarmaDatabase class, the SQLite storage backend,
+which encapsulates all CRUD operations for managing user karma in a SQLite
+database.
 """
 
+import os
+import queue
 import sqlite3
+import threading
 import time
+from contextlib import contextmanager
+from itertools import islice
+from typing import Iterable, Iterator, NamedTuple
 
-from settings import SQLITE_DB, KARMA_SPAM_DELAY
+from metrics import metrics
+from settings import (
+    EXPORT_CHUNK_SIZE,
+    KARMA_REBUILD_CHUNK,
+    KARMA_SCOPE,
+    KARMA_SPAM_DELAY,
+    LEADERBOARD_WINDOWS,
+    MAINTENANCE_ANALYSIS_LIMIT,
+    MAINTENANCE_VACUUM_PAGES,
+    SQLITE_BUSY_TIMEOUT,
+    SQLITE_CACHED_STATEMENTS,
+    SQLITE_DB,
+    SQLITE_JOURNAL_MODE,
+    SQLITE_READER_CONNECTIONS,
+    SQLITE_SYNCHRONOUS,
+)
+from storage import (
+    EXPORT_TABLES,
+    SECONDS_PER_DAY,
+    WRITE_METHODS,
+    KarmaUpdate,
+    MemberSync,
+    StorageBackend,
+)
+
+UPSERT_GUILD_SQL = """
+    INSERT INTO guilds (guild_id, guild_name)
+    VALUES (?, ?)
+    ON CONFLICT(guild_id) DO UPDATE SET guild_name = excluded.guild_name
+"""
+
+UPSERT_USER_SQL = """
+    INSERT INTO users (user_id, user_name)
+    VALUES (?, ?)
+    ON CONFLICT(user_id) DO UPDATE SET user_name = excluded.user_name
+"""
+
+INSERT_PLACEHOLDER_USER_SQL = """
+    INSERT INTO users (user_id, user_name)
+    VALUES (?, ?)
+    ON CONFLICT(user_id) DO NOTHING
+"""
+
+UPSERT_USER_NICKNAME_SQL = """
+    INSERT INTO user_nicknames (user_id, guild_id, nickname, is_member)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT(user_id, guild_id) DO UPDATE SET
+        nickname = excluded.nickname,
+        is_member = excluded.is_member
+"""
+
+INSERT_KARMA_EVENT_SQL = """
+    INSERT INTO karma_events (
+        giver_id, receiver_id, guild_id, guild_scoped, delta, created_at, message_id
+    )
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+"""
+
+
+class KarmaEvent(NamedTuple):
+    """One karma change, as stored in the karma_events table."""
+
+    giver_id: int | None
+    receiver_id: int
+    guild_id: int | None
+    guild_scoped: int
+    delta: int
+    created_at: int
+    message_id: int | None
+
+
+ADD_KARMA_BUCKET_SQL = """
+    INSERT INTO karma_daily (guild_id, day, user_id, delta)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT(guild_id, day, user_id) DO UPDATE SET
+        delta = karma_daily.delta + excluded.delta
+"""
+
+
+# Databases already migrated by this process, as (absolute path, guild_scoped).
+_migrated: set[tuple[str, bool]] = set()
+_migrated_lock = threading.Lock()
+
+
+def _create_core_tables(conn: sqlite3.Connection) -> None:
+    """Migration 1: global karma and the user/guild registry."""
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS karma (
+            user_id INTEGER PRIMARY KEY,
+            karma INTEGER DEFAULT 0,
+            last_karma INTEGER DEFAULT 0
+        )
+    """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS guilds (
+            guild_id INTEGER PRIMARY KEY,
+            guild_name TEXT NOT NULL DEFAULT ''
+        )
+    """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            user_name TEXT NOT NULL DEFAULT ''
+        )
+    """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS user_nicknames (
+            user_id INTEGER NOT NULL,
+            guild_id INTEGER NOT NULL,
+            nickname TEXT,
+            PRIMARY KEY (user_id, guild_id),
+            FOREIGN KEY (user_id) REFERENCES users(user_id),
+            FOREIGN KEY (guild_id) REFERENCES guilds(guild_id)
+        )
+    """
+    )
+    columns = {
+        row["name"]
+        for row in conn.execute("PRAGMA table_info(user_nicknames)").fetchall()
+    }
+    if "is_member" not in columns:
+        conn.execute("ALTER TABLE user_nicknames ADD COLUMN is_member INTEGER")
+    conn.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_karma_karma_desc
+        ON karma (karma DESC, user_id ASC)
+    """
+    )
+    conn.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_karma_karma_asc
+        ON karma (karma ASC, user_id ASC)
+    """
+    )
 
 
-class KarmaDatabase:
+def _create_guild_karma(conn: sqlite3.Connection) -> None:
+    """Migration 2: per-guild karma."""
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS guild_karma (
+            guild_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            karma INTEGER DEFAULT 0,
+            last_karma INTEGER DEFAULT 0,
+            PRIMARY KEY (guild_id, user_id)
+        )
+    """
+    )
+    conn.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_guild_karma_karma_desc
+        ON guild_karma (guild_id, karma DESC, user_id ASC)
+    """
+    )
+    conn.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_guild_karma_karma_asc
+        ON guild_karma (guild_id, karma ASC, user_id ASC)
+    """
+    )
+
+
+def _create_karma_events(conn: sqlite3.Connection) -> None:
+    """Migration 3: the karma event log, seeded with existing totals."""
+    has_event_log = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'karma_events'"
+    ).fetchone()
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS karma_events (
+            event_id INTEGER PRIMARY KEY,
+            giver_id INTEGER,
+            receiver_id INTEGER NOT NULL,
+            guild_id INTEGER,
+            guild_scoped INTEGER NOT NULL DEFAULT 0,
+            delta INTEGER NOT NULL,
+            created_at INTEGER NOT NULL,
+            message_id INTEGER
+        )
+    """
+    )
+    conn.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_karma_events_receiver
+        ON karma_events (guild_scoped, receiver_id, guild_id)
+    """
+    )
+    if not has_event_log:
+        # Karma that predates the log becomes one baseline event per row,
+        # so rebuilding from the log keeps it.
+        conn.execute(
+            """
+            INSERT INTO karma_events (
+                receiver_id, guild_id, guild_scoped, delta, created_at
+            )
+            SELECT user_id, NULL, 0, karma, last_karma
+            FROM karma WHERE karma != 0
+        """
+        )
+        conn.execute(
+            """
+            INSERT INTO karma_events (
+                receiver_id, guild_id, guild_scoped, delta, created_at
+            )
+            SELECT user_id, guild_id, 1, karma, last_karma
+            FROM guild_karma WHERE karma != 0
+        """
+        )
+
+
+def _create_karma_daily(conn: sqlite3.Connection) -> None:
+    """Migration 4: daily karma buckets, filled from the event log."""
+    has_buckets = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'karma_daily'"
+    ).fetchone()
+    # guild_id is 0 for karma given outside a guild.
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS karma_daily (
+            guild_id INTEGER NOT NULL,
+            day INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            delta INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (guild_id, day, user_id)
+        ) WITHOUT ROWID
+    """
+    )
+    conn.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_karma_daily_day
+        ON karma_daily (day, user_id)
+    """
+    )
+    if not has_buckets:
+        # Fill the buckets still inside a leaderboard window from the log.
+        first_day = int(time.time()) // SECONDS_PER_DAY - max(
+            LEADERBOARD_WINDOWS.values()
+        )
+        conn.execute(
+            """
+            INSERT INTO karma_daily (guild_id, day, user_id, delta)
+            SELECT IFNULL(guild_id, 0), created_at / 86400, receiver_id, SUM(delta)
+            FROM karma_events
+            WHERE giver_id IS NOT NULL AND created_at >= ?
+            GROUP BY IFNULL(guild_id, 0), created_at / 86400, receiver_id
+        """,
+            (first_day * SECONDS_PER_DAY,),
+        )
+
+
+def _create_meta(conn: sqlite3.Connection) -> None:
+    """Migration 5: a key/value table recording one-time data changes."""
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        )
+    """
+    )
+
+
+# Schema migrations, in order.  A database's PRAGMA user_version is the
+# number of migrations applied to it.  Files created before versioning
+# start at 0; every migration checks what already exists, so they replay
+# safely over such files.  Append new migrations; never reorder or edit
+# released ones.
+MIGRATIONS = (
+    _create_core_tables,
+    _create_guild_karma,
+    _create_karma_events,
+    _create_karma_daily,
+    _create_meta,
+)
+
+# meta key set once per-guild karma has been seeded from global karma.
+GUILD_KARMA_SEEDED = "guild_karma_seeded"
+
+
+@metrics.instrument_methods("db", skip=("close",), writes=WRITE_METHODS)
+class KarmaDatabase(StorageBackend):
     """
     Handles all CRUD operations for the karma database.
 
     This class provides methods to initialize the database, add new users,
     update existing users' karma, retrieve karma values, and delete users.
+
+    Karma is either global (the `karma` table, keyed by user) or, when
+    KARMA_SCOPE is "guild", kept separately per guild (the `guild_karma`
+    table, keyed by guild and user).  Karma methods take an optional
+    guild_id; it is ignored in global mode, and karma given outside a guild
+    always uses the global table.
+
+    Every karma change is also appended to the `karma_events` log, so the
+    karma tables are materialized totals of that log and can be rebuilt
+    from it.  Each event is written in the same transaction as its change.
+
+    Karma given by users is also summed into per-day buckets
+    (`karma_daily`), so "top this week" style leaderboards read a few
+    dozen bucket rows instead of the raw log.
     """
 
-    def __init__(self, db_path=SQLITE_DB):
+    def __init__(
+        self,
+        db_path=SQLITE_DB,
+        reader_count=SQLITE_READER_CONNECTIONS,
+        guild_scoped=KARMA_SCOPE == "guild",
+    ):
         """
-        Initialize a KarmaDatabase instance and ensure the karma table exists.
+        Initialize a KarmaDatabase instance and bring the schema up to date.
+
+        The instance keeps one long-lived writer connection plus an optional
+        pool of read-only connections for the lifetime of the object.
 
         Args:
             db_path (str): Path to the SQLite database file.
+            reader_count (int): Number of read-only connections to keep open.
+                With 0, reads share the writer connection.
+            guild_scoped (bool): Keep karma per guild instead of globally.
         """
+        super().__init__(guild_scoped, reader_count)
         self.db_path = db_path
-        self._initialize_db()
+        self._write_lock = threading.RLock()
+        self._writer = self._connect()
+        self._prepare_file()
 
-    def _get_conn(self) -> sqlite3.Connection:
-        """Return a sqlite connection configured for this app."""
-        conn = sqlite3.connect(self.db_path)
+        self._readers = None
+        if reader_count > 0:
+            self._readers = queue.SimpleQueue()
+            for _ in range(reader_count):
+                conn = self._connect()
+                conn.execute("PRAGMA query_only = ON")
+                self._readers.put(conn)
+
+    def _connect(self) -> sqlite3.Connection:
+        """Open a long-lived sqlite connection configured for this app."""
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=SQLITE_BUSY_TIMEOUT,
+            cached_statements=SQLITE_CACHED_STATEMENTS,
+            check_same_thread=False,
+        )
         conn.row_factory = sqlite3.Row
         conn.execute("PRAGMA foreign_keys = ON")
+        conn.execute(f"PRAGMA synchronous = {SQLITE_SYNCHRONOUS}")
         return conn
 
-    def _initialize_db(self) -> None:
+    @contextmanager
+    def _write(self):
+        """Yield the writer connection inside a transaction."""
+        with self._write_lock, self._writer:
+            yield self._writer
+
+    @contextmanager
+    def _read(self):
+        """Yield a connection for read-only queries."""
+        if self._readers is None:
+            with self._write_lock:
+                yield self._writer
+            return
+
+        conn = self._readers.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put(conn)
+
+    def close(self) -> None:
+        """Close the writer and all reader connections."""
+        with self._write_lock:
+            self._writer.close()
+        for _ in range(self.reader_count):
+            self._readers.get().close()
+
+    def _prepare_file(self) -> None:
         """
-        Create or migrate the database schema.
+        Set the journal mode and apply pending migrations, once per process.
+
+        Later instances on the same file skip straight past this, so
+        constructing a KarmaDatabase costs only its connections.
         """
-        with self._get_conn() as conn:
-            conn.execute(
-                """
-                CREATE TABLE IF NOT EXISTS karma (
-                    user_id INTEGER PRIMARY KEY,
-                    karma INTEGER DEFAULT 0,
-                    last_karma INTEGER DEFAULT 0
-                )
-            """
-            )
-            conn.execute(
-                """
-                CREATE TABLE IF NOT EXISTS guilds (
-                    guild_id INTEGER PRIMARY KEY,
-                    guild_name TEXT NOT NULL DEFAULT ''
-                )
-            """
-            )
-            conn.execute(
-                """
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id INTEGER PRIMARY KEY,
-                    user_name TEXT NOT NULL DEFAULT ''
-                )
-            """
-            )
-            conn.execute(
+        key = (os.path.abspath(self.db_path), self.guild_scoped)
+        with _migrated_lock:
+            if key in _migrated:
+                return
+            # Only takes effect on a new file; `vacuum` converts older ones.
+            self._writer.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            self._writer.execute(f"PRAGMA journal_mode = {SQLITE_JOURNAL_MODE}")
+            self._migrate()
+            if self.guild_scoped:
+                self.migrate_to_guild_scope()
+            # An in-memory database is new with every connection.
+            if self.db_path != ":memory:":
+                _migrated.add(key)
+
+    def _migrate(self) -> int:
+        """
+        Apply every migration newer than the file's user_version.
+
+        Each migration commits together with its version bump, so an
+        interrupted run resumes where it stopped, and a process that finds
+        another already migrated the file does nothing.
+
+        Returns:
+            int: The number of migrations applied.
+        """
+        applied = 0
+        with self._write_lock:
+            conn = self._writer
+            while True:
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    version = conn.execute("PRAGMA user_version").fetchone()[0]
+                    if version >= len(MIGRATIONS):
+                        conn.rollback()
+                        return applied
+                    MIGRATIONS[version](conn)
+                    conn.execute(f"PRAGMA user_version = {version + 1}")
+                except BaseException:
+                    conn.rollback()
+                    raise
+                conn.commit()
+                applied += 1
+
+    def migrate_to_guild_scope(self) -> int:
+        """
+        Seed per-guild karma from the global karma table.
+
+        Every guild a user is a current member of starts with that user's
+        global karma.  The seed is recorded in the `meta` table, so it runs
+        once per file and is safe to call on every start; run
+        backfill_registry.py first so that users without registry rows are
+        not left behind.
+
+        Returns:
+            int: The number of guild_karma rows created.
+        """
+        with self._write() as conn:
+            if conn.execute(
+                "SELECT 1 FROM meta WHERE key = ?", (GUILD_KARMA_SEEDED,)
+            ).fetchone():
+                return 0
+            # Per-guild karma that is already there was seeded before the
+            # seed was recorded, or imported; it is kept as it is.
+            created = 0
+            if not conn.execute("SELECT 1 FROM guild_karma LIMIT 1").fetchone():
+                # An unknown membership state counts as a member.
+                cur = conn.execute(
+                    """
+                    INSERT INTO guild_karma (guild_id, user_id, karma, last_karma)
+                    SELECT user_nicknames.guild_id, karma.user_id,
+                        karma.karma, karma.last_karma
+                    FROM karma
+                    JOIN user_nicknames ON user_nicknames.user_id = karma.user_id
+                    WHERE user_nicknames.is_member IS NOT 0
                 """
-                CREATE TABLE IF NOT EXISTS user_nicknames (
-                    user_id INTEGER NOT NULL,
-                    guild_id INTEGER NOT NULL,
-                    nickname TEXT,
-                    PRIMARY KEY (user_id, guild_id),
-                    FOREIGN KEY (user_id) REFERENCES users(user_id),
-                    FOREIGN KEY (guild_id) REFERENCES guilds(guild_id)
                 )
-            """
-            )
-            columns = {
-                row["name"]
-                for row in conn.execute("PRAGMA table_info(user_nicknames)").fetchall()
-            }
-            if "is_member" not in columns:
+                created = cur.rowcount
                 conn.execute(
-                    "ALTER TABLE user_nicknames ADD COLUMN is_member INTEGER"
-                )
-            conn.execute(
+                    """
+                    INSERT INTO karma_events (
+                        receiver_id, guild_id, guild_scoped, delta, created_at
+                    )
+                    SELECT user_id, guild_id, 1, karma, last_karma
+                    FROM guild_karma WHERE karma != 0
                 """
-                CREATE INDEX IF NOT EXISTS idx_karma_karma_desc
-                ON karma (karma DESC, user_id ASC)
-            """
-            )
+                )
             conn.execute(
-                """
-                CREATE INDEX IF NOT EXISTS idx_karma_karma_asc
-                ON karma (karma ASC, user_id ASC)
-            """
+                "INSERT INTO meta (key, value) VALUES (?, 1)", (GUILD_KARMA_SEEDED,)
             )
-            conn.commit()
+            return created
 
-    def create(self, user_id: int, karma: int = 0) -> None:
+    def _karma_scope(self, user_id: int, guild_id: int | None):
+        """
+        Return where a user's karma lives.
+
+        Returns:
+            tuple: (table name, key column names, key values).
+        """
+        if self.guild_scoped and guild_id is not None:
+            return "guild_karma", ("guild_id", "user_id"), (guild_id, user_id)
+        return "karma", ("user_id",), (user_id,)
+
+    def _log_event(
+        self,
+        conn: sqlite3.Connection,
+        user_id: int,
+        guild_id: int | None,
+        delta: int,
+        created_at: int,
+        giver_id: int | None = None,
+        message_id: int | None = None,
+    ) -> None:
+        """
+        Append a karma change to the event log inside the caller's transaction.
+
+        The event commits or rolls back with the karma change itself, so the
+        log never lags the totals.
+        """
+        table, _, _ = self._karma_scope(user_id, guild_id)
+        conn.execute(
+            INSERT_KARMA_EVENT_SQL,
+            KarmaEvent(
+                giver_id,
+                user_id,
+                guild_id,
+                int(table == "guild_karma"),
+                delta,
+                created_at,
+                message_id,
+            ),
+        )
+
+    def create(self, user_id: int, karma: int = 0, guild_id: int | None = None) -> None:
         """
         Add a new user to the karma table with an initial karma value.
 
         Args:
             user_id (int): The Discord user ID to add.
             karma (int, optional): The initial karma value. Defaults to 0.
+            guild_id (int, optional): The guild, in guild-scoped mode.
         """
-        with self._get_conn() as conn:
-            conn.execute(
-                "INSERT OR IGNORE INTO karma (user_id, karma) VALUES (?, ?)",
-                (user_id, karma),
+        table, columns, key = self._karma_scope(user_id, guild_id)
+        marks = ", ".join("?" for _ in columns)
+        with self._write() as conn:
+            cur = conn.execute(
+                f"INSERT OR IGNORE INTO {table} ({', '.join(columns)}, karma) "
+                f"VALUES ({marks}, ?)",
+                (*key, karma),
             )
+            if cur.rowcount and karma:
+                self._log_event(conn, user_id, guild_id, karma, int(time.time()))
 
-    def get_karma(self, user_id: int) -> int | None:
+    def get_karma(self, user_id: int, guild_id: int | None = None) -> int | None:
         """
         Retrieve the karma value for a specific user.
 
         Args:
             user_id (int): The Discord user ID to look up.
+            guild_id (int, optional): The guild, in guild-scoped mode.
 
         Returns:
             int or None: The user's karma value, or None if the user does not exist.
         """
-        with self._get_conn() as conn:
-            cur = conn.execute("SELECT karma FROM karma WHERE user_id = ?", (user_id,))
+        table, columns, key = self._karma_scope(user_id, guild_id)
+        where = " AND ".join(f"{column} = ?" for column in columns)
+        with self._read() as conn:
+            cur = conn.execute(f"SELECT karma FROM {table} WHERE {where}", key)
             row = cur.fetchone()
             return row[0] if row else None
 
-    def update(self, user_id: int, delta: int) -> None:
+    def update(self, user_id: int, delta: int, guild_id: int | None = None) -> None:
         """
         Update the karma value for a specific user by a given delta,
         and update the last_karma timestamp.
@@ -136,25 +581,162 @@ class KarmaDatabase:
         Args:
             user_id (int): The Discord user ID to update.
             delta (int): The amount to add (or subtract) from the user's karma.
+            guild_id (int, optional): The guild, in guild-scoped mode.
         """
         now = int(time.time())
-        with self._get_conn() as conn:
-            conn.execute(
-                "UPDATE karma SET karma = karma + ?, last_karma = ? WHERE user_id = ?",
-                (delta, now, user_id),
+        table, columns, key = self._karma_scope(user_id, guild_id)
+        where = " AND ".join(f"{column} = ?" for column in columns)
+        with self._write() as conn:
+            cur = conn.execute(
+                f"UPDATE {table} SET karma = karma + ?, last_karma = ? WHERE {where}",
+                (delta, now, *key),
             )
+            if cur.rowcount:
+                self._log_event(conn, user_id, guild_id, delta, now)
 
-    def delete(self, user_id: int) -> None:
+    def apply_karma(
+        self,
+        user_id: int,
+        delta: int,
+        spam_delay: int = KARMA_SPAM_DELAY,
+        guild_id: int | None = None,
+        giver_id: int | None = None,
+        message_id: int | None = None,
+    ) -> KarmaUpdate:
+        """
+        Atomically create the user if needed, enforce the spam delay, and
+        apply a karma delta.
+
+        The spam check and the update happen in one statement, so two
+        simultaneous adjustments cannot both slip past the delay.
+
+        Args:
+            user_id (int): The Discord user ID to update.
+            delta (int): The (already capped) amount to add to the user's karma.
+            spam_delay (int): Minimum seconds since the last change. Use 0 to
+                disable the check.
+            guild_id (int, optional): The guild, in guild-scoped mode.
+            giver_id (int, optional): Who gave the karma, for the event log.
+            message_id (int, optional): The triggering message, for the event log.
+
+        Returns:
+            KarmaUpdate: The user's karma after the call, whether the delta
+                was applied (False when rejected by the spam delay), and the
+                stored last_karma timestamp.
+        """
+        return self.apply_karma_batch(
+            [(user_id, delta)], spam_delay, guild_id, giver_id, message_id
+        )[0]
+
+    def apply_karma_batch(
+        self,
+        changes: list[tuple[int, int]],
+        spam_delay: int = KARMA_SPAM_DELAY,
+        guild_id: int | None = None,
+        giver_id: int | None = None,
+        message_id: int | None = None,
+    ) -> list[KarmaUpdate]:
+        """
+        Apply several karma changes from one message in a single transaction.
+
+        Each change is applied exactly as apply_karma would, but the whole
+        batch costs one commit.
+
+        Args:
+            changes (list): (user_id, delta) pairs; deltas are already capped.
+            spam_delay (int): Minimum seconds since each user's last change.
+                Use 0 to disable the check.
+            guild_id (int, optional): The guild, in guild-scoped mode.
+            giver_id (int, optional): Who gave the karma, for the event log.
+            message_id (int, optional): The triggering message, for the event log.
+
+        Returns:
+            list[KarmaUpdate]: One result per change, in order.
+        """
+        now = int(time.time())
+        results = []
+        with self._write() as conn:
+            for user_id, delta in changes:
+                results.append(
+                    self._apply_karma_row(
+                        conn,
+                        user_id,
+                        delta,
+                        spam_delay,
+                        guild_id,
+                        giver_id,
+                        message_id,
+                        now,
+                    )
+                )
+        return results
+
+    def _apply_karma_row(
+        self,
+        conn: sqlite3.Connection,
+        user_id: int,
+        delta: int,
+        spam_delay: int,
+        guild_id: int | None,
+        giver_id: int | None,
+        message_id: int | None,
+        now: int,
+    ) -> KarmaUpdate:
+        """
+        Upsert one user's karma inside the caller's transaction.
+
+        An applied change is logged, and karma given by a user is added to
+        its day's bucket, in the same transaction, so neither the event log
+        nor windowed leaderboards can miss committed karma.
+        """
+        table, columns, key = self._karma_scope(user_id, guild_id)
+        column_list = ", ".join(columns)
+        marks = ", ".join("?" for _ in columns)
+        where = " AND ".join(f"{column} = ?" for column in columns)
+        row = conn.execute(
+            f"""
+            INSERT INTO {table} ({column_list}, karma, last_karma)
+            VALUES ({marks}, ?, ?)
+            ON CONFLICT({column_list}) DO UPDATE SET
+                karma = {table}.karma + excluded.karma,
+                last_karma = excluded.last_karma
+            WHERE excluded.last_karma - {table}.last_karma >= ?
+            RETURNING karma, last_karma
+        """,
+            (*key, delta, now, spam_delay),
+        ).fetchone()
+        if row is not None:
+            self._log_event(conn, user_id, guild_id, delta, now, giver_id, message_id)
+            if giver_id is not None:
+                conn.execute(
+                    ADD_KARMA_BUCKET_SQL,
+                    (guild_id or 0, now // SECONDS_PER_DAY, user_id, delta),
+                )
+            return KarmaUpdate(row[0], True, row[1])
+        row = conn.execute(
+            f"SELECT karma, last_karma FROM {table} WHERE {where}", key
+        ).fetchone()
+        return KarmaUpdate(row[0], False, row[1])
+
+    def delete(self, user_id: int, guild_id: int | None = None) -> None:
         """
         Remove a user from the karma table.
 
         Args:
             user_id (int): The Discord user ID to delete.
+            guild_id (int, optional): The guild, in guild-scoped mode.
         """
-        with self._get_conn() as conn:
-            conn.execute("DELETE FROM karma WHERE user_id = ?", (user_id,))
+        table, columns, key = self._karma_scope(user_id, guild_id)
+        where = " AND ".join(f"{column} = ?" for column in columns)
+        with self._write() as conn:
+            row = conn.execute(
+                f"DELETE FROM {table} WHERE {where} RETURNING karma", key
+            ).fetchone()
+            # The log is append-only, so cancel the user's total out instead.
+            if row is not None and row[0]:
+                self._log_event(conn, user_id, guild_id, -row[0], int(time.time()))
 
-    def can_update_karma(self, user_id: int) -> bool:
+    def can_update_karma(self, user_id: int, guild_id: int | None = None) -> bool:
         """
         Determine whether enough time has passed since the user's last karma update.
 
@@ -164,70 +746,111 @@ class KarmaDatabase:
 
         Args:
             user_id (int): The Discord user ID to check.
+            guild_id (int, optional): The guild, in guild-scoped mode.
 
         Returns:
             bool: True if the user can receive a karma update, False otherwise.
         """
-        with self._get_conn() as conn:
-            cur = conn.execute(
-                "SELECT last_karma FROM karma WHERE user_id = ?", (user_id,)
-            )
+        table, columns, key = self._karma_scope(user_id, guild_id)
+        where = " AND ".join(f"{column} = ?" for column in columns)
+        with self._read() as conn:
+            cur = conn.execute(f"SELECT last_karma FROM {table} WHERE {where}", key)
             row = cur.fetchone()
             if row and time.time() - row[0] < KARMA_SPAM_DELAY:
                 return False
             return True
 
-    def all_user_ids_and_karma(self) -> list[tuple[int, int]]:
+    def recent_karma_changes(self, since: int) -> list[tuple]:
         """
-        Retrieve all users and their karma values from the database.
+        Retrieve users whose karma changed at or after a given time.
+
+        Args:
+            since (int): Unix timestamp to look back to.
 
         Returns:
-            list[tuple[int, int]]: A list of tuples containing user IDs and their karma values.
+            list[tuple]: (karma_key, last_karma) pairs, where karma_key is as
+                returned by `karma_key`.
         """
-        with self._get_conn() as conn:
-            cur = conn.execute("SELECT user_id, karma FROM karma")
-            return cur.fetchall()
+        with self._read() as conn:
+            rows = [
+                (row[0], row[1])
+                for row in conn.execute(
+                    "SELECT user_id, last_karma FROM karma WHERE last_karma >= ?",
+                    (since,),
+                )
+            ]
+            if self.guild_scoped:
+                rows.extend(
+                    ((row[0], row[1]), row[2])
+                    for row in conn.execute(
+                        """
+                        SELECT guild_id, user_id, last_karma
+                        FROM guild_karma WHERE last_karma >= ?
+                    """,
+                        (since,),
+                    )
+                )
+            return rows
 
-    def all_user_ids(self) -> list[int]:
+    def all_user_ids_and_karma(
+        self, chunk_size: int = EXPORT_CHUNK_SIZE
+    ) -> Iterator[tuple[int, int]]:
         """
-        Retrieve a list of all user IDs in the karma table.
+        Stream all users and their karma values from the database.
 
-        Returns:
-            list[int]: A list of Discord user IDs.
+        Rows are fetched chunk_size at a time, and a read connection is held
+        until the iterator is exhausted or closed.
+
+        Args:
+            chunk_size (int): Rows fetched per batch.
+
+        Yields:
+            tuple[int, int]: A user ID and that user's karma.
         """
-        with self._get_conn() as conn:
-            cur = conn.execute("SELECT user_id FROM karma")
-            return [row[0] for row in cur.fetchall()]
+        with self._read() as conn:
+            if self.guild_scoped:
+                cur = conn.execute(
+                    "SELECT user_id, SUM(karma) FROM guild_karma GROUP BY user_id"
+                )
+            else:
+                cur = conn.execute("SELECT user_id, karma FROM karma")
+            while rows := cur.fetchmany(chunk_size):
+                yield from ((row[0], row[1]) for row in rows)
+
+    def all_user_ids(self, chunk_size: int = EXPORT_CHUNK_SIZE) -> Iterator[int]:
+        """
+        Stream the IDs of all users in the karma table.
+
+        Args:
+            chunk_size (int): Rows fetched per batch.
+
+        Yields:
+            int: A Discord user ID.
+        """
+        table = "guild_karma" if self.guild_scoped else "karma"
+        with self._read() as conn:
+            cur = conn.execute(f"SELECT DISTINCT user_id FROM {table}")
+            while rows := cur.fetchmany(chunk_size):
+                yield from (row[0] for row in rows)
 
     def karma_user_count(self) -> int:
         """Return the number of karma-tracked users."""
-        with self._get_conn() as conn:
-            cur = conn.execute("SELECT COUNT(*) FROM karma")
+        table = "guild_karma" if self.guild_scoped else "karma"
+        with self._read() as conn:
+            cur = conn.execute(f"SELECT COUNT(DISTINCT user_id) FROM {table}")
             return cur.fetchone()[0]
 
     def upsert_guild(self, guild_id: int, guild_name: str) -> None:
         """Insert or update a guild in the local registry."""
-        with self._get_conn() as conn:
-            conn.execute(
-                """
-                INSERT INTO guilds (guild_id, guild_name)
-                VALUES (?, ?)
-                ON CONFLICT(guild_id) DO UPDATE SET guild_name = excluded.guild_name
-            """,
-                (guild_id, guild_name),
-            )
+        with self._write() as conn:
+            conn.execute(UPSERT_GUILD_SQL, (guild_id, guild_name))
+        self.registry_cache.forget_guild(guild_id)
 
     def upsert_user(self, user_id: int, user_name: str) -> None:
         """Insert or update a user in the local registry."""
-        with self._get_conn() as conn:
-            conn.execute(
-                """
-                INSERT INTO users (user_id, user_name)
-                VALUES (?, ?)
-                ON CONFLICT(user_id) DO UPDATE SET user_name = excluded.user_name
-            """,
-                (user_id, user_name),
-            )
+        with self._write() as conn:
+            conn.execute(UPSERT_USER_SQL, (user_id, user_name))
+        self.registry_cache.forget_user(user_id)
 
     def upsert_user_nickname(
         self,
@@ -237,78 +860,277 @@ class KarmaDatabase:
         is_member: int | None,
     ) -> None:
         """Insert or update a user's guild-specific name and membership state."""
-        with self._get_conn() as conn:
+        with self._write() as conn:
+            conn.execute(
+                UPSERT_USER_NICKNAME_SQL, (user_id, guild_id, nickname, is_member)
+            )
+        self.registry_cache.forget_member(user_id, guild_id)
+
+    def write_registry_batch(
+        self, guilds: list, users: list, nicknames: list
+    ) -> None:
+        """
+        Upsert many registry rows in a single transaction.
+
+        Args:
+            guilds (list): (guild_id, guild_name) tuples.
+            users (list): (user_id, user_name) tuples.
+            nicknames (list): (user_id, guild_id, nickname, is_member) tuples.
+        """
+        with self._write() as conn:
+            conn.executemany(UPSERT_GUILD_SQL, guilds)
+            conn.executemany(UPSERT_USER_SQL, users)
+            conn.executemany(UPSERT_USER_NICKNAME_SQL, nicknames)
+
+    def prune_karma_buckets(self, before_day: int) -> int:
+        """
+        Delete daily karma buckets that no leaderboard window reaches.
+
+        Args:
+            before_day (int): Days since the epoch; older buckets are deleted.
+
+        Returns:
+            int: The number of buckets deleted.
+        """
+        with self._write() as conn:
+            cur = conn.execute("DELETE FROM karma_daily WHERE day < ?", (before_day,))
+            return cur.rowcount
+
+    def rebuild_karma_totals(self, chunk_size: int = KARMA_REBUILD_CHUNK) -> int:
+        """
+        Recompute the karma tables from the event log.
+
+        The log is aggregated by SQLite and streamed back in chunks, so memory
+        use does not grow with the size of the log.  The whole rebuild is one
+        transaction.  last_karma timestamps are kept.
+
+        Args:
+            chunk_size (int): Rows to fetch and write per batch.
+
+        Returns:
+            int: The number of karma totals written.
+        """
+        written = 0
+        with self._write() as conn:
+            for scoped in (0, 1):
+                if scoped:
+                    conn.execute("UPDATE guild_karma SET karma = 0")
+                    aggregate = """
+                        SELECT guild_id, receiver_id, SUM(delta), MAX(created_at)
+                        FROM karma_events WHERE guild_scoped = 1
+                        GROUP BY receiver_id, guild_id
+                        HAVING SUM(delta) != 0
+                    """
+                    upsert = """
+                        INSERT INTO guild_karma (guild_id, user_id, karma, last_karma)
+                        VALUES (?, ?, ?, ?)
+                        ON CONFLICT(guild_id, user_id) DO UPDATE SET
+                            karma = excluded.karma
+                    """
+                else:
+                    conn.execute("UPDATE karma SET karma = 0")
+                    aggregate = """
+                        SELECT receiver_id, SUM(delta), MAX(created_at)
+                        FROM karma_events WHERE guild_scoped = 0
+                        GROUP BY receiver_id
+                        HAVING SUM(delta) != 0
+                    """
+                    upsert = """
+                        INSERT INTO karma (user_id, karma, last_karma)
+                        VALUES (?, ?, ?)
+                        ON CONFLICT(user_id) DO UPDATE SET karma = excluded.karma
+                    """
+                source = conn.execute(aggregate)
+                while rows := source.fetchmany(chunk_size):
+                    conn.executemany(upsert, rows)
+                    written += len(rows)
+        return written
+
+    def compact_karma_events(self, before: int) -> int:
+        """
+        Collapse old events into one summary event per receiver and guild.
+
+        Totals are unchanged; only per-event detail (giver, message, exact
+        time) older than the cutoff is lost.
+
+        Args:
+            before (int): Unix timestamp; events older than this are compacted.
+
+        Returns:
+            int: The number of events removed.
+        """
+        with self._write() as conn:
+            last_id = conn.execute(
+                "SELECT MAX(event_id) FROM karma_events WHERE created_at < ?",
+                (before,),
+            ).fetchone()[0]
+            if last_id is None:
+                return 0
             conn.execute(
                 """
-                INSERT INTO user_nicknames (user_id, guild_id, nickname, is_member)
-                VALUES (?, ?, ?, ?)
-                ON CONFLICT(user_id, guild_id) DO UPDATE SET
-                    nickname = excluded.nickname,
-                    is_member = excluded.is_member
+                INSERT INTO karma_events (
+                    receiver_id, guild_id, guild_scoped, delta, created_at
+                )
+                SELECT receiver_id, guild_id, guild_scoped, SUM(delta), MAX(created_at)
+                FROM karma_events
+                WHERE created_at < ? AND event_id <= ?
+                GROUP BY guild_scoped, receiver_id, guild_id
+                HAVING SUM(delta) != 0
             """,
-                (user_id, guild_id, nickname, is_member),
+                (before, last_id),
             )
-
-    def record_guild(self, guild) -> None:
-        """Store a guild from Discord in the local registry."""
-        self.upsert_guild(guild.id, guild.name)
-
-    def record_member(self, member, guild=None) -> None:
-        """Store a member or user plus any guild-specific nickname."""
-        target_guild = guild or getattr(member, "guild", None)
-        self.upsert_user(member.id, member.name)
-        if target_guild is not None:
-            self.upsert_guild(target_guild.id, target_guild.name)
-            self.upsert_user_nickname(
-                member.id,
-                target_guild.id,
-                getattr(member, "nick", None),
-                1,
+            cur = conn.execute(
+                "DELETE FROM karma_events WHERE created_at < ? AND event_id <= ?",
+                (before, last_id),
             )
+            return cur.rowcount
 
-    def record_departed_member(self, member, guild=None) -> None:
-        """Mark a user as not currently belonging to a guild."""
-        target_guild = guild or getattr(member, "guild", None)
-        if target_guild is None:
-            return
+    def export_rows(
+        self, table: str, chunk_size: int = EXPORT_CHUNK_SIZE
+    ) -> Iterator[tuple]:
+        """
+        Stream every row of an exportable table.
 
-        self.upsert_user(member.id, member.name)
-        self.upsert_guild(target_guild.id, target_guild.name)
-        self.upsert_user_nickname(
-            member.id,
-            target_guild.id,
-            None,
-            0,
-        )
+        Rows are fetched chunk_size at a time, so memory use does not grow
+        with the table.  A read connection is held until the iterator is
+        exhausted or closed.
 
-    def record_message(self, message) -> None:
-        """Record the message's guild, author, and mentions into the registry."""
-        if message.guild is None:
-            return
+        Args:
+            table (str): One of EXPORT_TABLES.
+            chunk_size (int): Rows fetched per batch.
 
-        self.record_guild(message.guild)
-        self.record_member(message.author, message.guild)
-        for member in message.mentions:
-            self.record_member(member, message.guild)
+        Yields:
+            tuple: The row's values, in EXPORT_TABLES column order.
+        """
+        keys, values = EXPORT_TABLES[table]
+        with self._read() as conn:
+            cur = conn.execute(f"SELECT {', '.join(keys + values)} FROM {table}")
+            while rows := cur.fetchmany(chunk_size):
+                yield from (tuple(row) for row in rows)
 
-    def get_top_karma_entries(self, guild_id: int, limit: int) -> list[sqlite3.Row]:
-        """Return the highest-karma users with locally cached names."""
-        return self._get_ranked_karma_entries(guild_id, limit, descending=True)
+    def import_rows(
+        self, table: str, rows: Iterable[tuple], chunk_size: int = EXPORT_CHUNK_SIZE
+    ) -> int:
+        """
+        Upsert a stream of rows into an exportable table in one transaction.
 
-    def get_bottom_karma_entries(self, guild_id: int, limit: int) -> list[sqlite3.Row]:
-        """Return the lowest-karma users with locally cached names."""
-        return self._get_ranked_karma_entries(guild_id, limit, descending=False)
+        Rows are consumed and written chunk_size at a time with executemany,
+        so memory use does not grow with the input.  Imported karma is also
+        logged to `karma_events` as the difference from the stored total, so
+        the log still adds up to the karma tables.  Each key should appear
+        at most once in `rows`, as in an export.
+
+        Args:
+            table (str): One of EXPORT_TABLES.
+            rows (Iterable[tuple]): Values in EXPORT_TABLES column order.
+            chunk_size (int): Rows written per batch.
+
+        Returns:
+            int: The number of rows imported.
+        """
+        keys, values = EXPORT_TABLES[table]
+        columns = keys + values
+        upsert = f"""
+            INSERT INTO {table} ({', '.join(columns)})
+            VALUES ({', '.join('?' for _ in columns)})
+            ON CONFLICT({', '.join(keys)}) DO UPDATE SET
+                {', '.join(f'{column} = excluded.{column}' for column in values)}
+        """
+        log_events = None
+        if table in ("karma", "guild_karma"):
+            # Numbered parameters refer to the row's columns, in order.
+            if table == "karma":
+                receiver, guild, scoped, karma, created = "?1", "NULL", 0, "?2", "?3"
+                stored = "SELECT karma FROM karma WHERE user_id = ?1"
+            else:
+                receiver, guild, scoped, karma, created = "?2", "?1", 1, "?3", "?4"
+                stored = "SELECT karma FROM guild_karma WHERE guild_id = ?1 AND user_id = ?2"
+            log_events = f"""
+                INSERT INTO karma_events (
+                    receiver_id, guild_id, guild_scoped, delta, created_at
+                )
+                SELECT {receiver}, {guild}, {scoped},
+                    {karma} - IFNULL(({stored}), 0), {created}
+                WHERE {karma} != IFNULL(({stored}), 0)
+            """
+
+        imported = 0
+        rows = iter(rows)
+        with self._write() as conn:
+            while chunk := list(islice(rows, chunk_size)):
+                if log_events is not None:
+                    conn.executemany(log_events, chunk)
+                conn.executemany(upsert, chunk)
+                imported += len(chunk)
+        return imported
+
+    def _write_member_sync(
+        self, guild_id: int, guild_name: str, members: list[tuple[int, str, str | None]]
+    ) -> tuple[MemberSync, list[int]]:
+        """Diff and write a guild member sync; returns the counts and departed IDs."""
+        current = {
+            user_id: (user_name, nickname) for user_id, user_name, nickname in members
+        }
+        users = []
+        nicknames = []
+        joined = changed = 0
+        with self._write() as conn:
+            stored = {
+                row[0]: (row[1], row[2], row[3])
+                for row in conn.execute(
+                    """
+                    SELECT user_nicknames.user_id, users.user_name,
+                        user_nicknames.nickname, user_nicknames.is_member
+                    FROM user_nicknames
+                    LEFT JOIN users ON users.user_id = user_nicknames.user_id
+                    WHERE user_nicknames.guild_id = ?
+                """,
+                    (guild_id,),
+                )
+            }
+            for user_id, (user_name, nickname) in current.items():
+                old = stored.get(user_id)
+                if old is None or old[2] != 1:
+                    joined += 1
+                elif old[0] != user_name or old[1] != nickname:
+                    changed += 1
+                else:
+                    continue
+                users.append((user_id, user_name))
+                nicknames.append((user_id, guild_id, nickname, 1))
+            departed = [
+                user_id
+                for user_id, (_, _, is_member) in stored.items()
+                if is_member != 0 and user_id not in current
+            ]
+            nicknames.extend((user_id, guild_id, None, 0) for user_id in departed)
+
+            conn.execute(UPSERT_GUILD_SQL, (guild_id, guild_name))
+            conn.executemany(UPSERT_USER_SQL, users)
+            conn.executemany(UPSERT_USER_NICKNAME_SQL, nicknames)
+        return MemberSync(joined, len(departed), changed), departed
 
     def _get_ranked_karma_entries(
         self, guild_id: int, limit: int, descending: bool
     ) -> list[sqlite3.Row]:
         """Return ranked karma rows, attaching cached names after ranking."""
         order = "DESC" if descending else "ASC"
-        with self._get_conn() as conn:
-            cur = conn.execute(
-                f"""
-                SELECT ranked.user_id, ranked.karma, users.user_name, ranked.nickname
-                FROM (
+        if self.guild_scoped:
+            # Walks only this guild's slice of the (guild_id, karma) index.
+            ranked_sql = f"""
+                    SELECT guild_karma.user_id, guild_karma.karma,
+                        user_nicknames.nickname
+                    FROM guild_karma
+                    JOIN user_nicknames
+                        ON user_nicknames.user_id = guild_karma.user_id
+                        AND user_nicknames.guild_id = guild_karma.guild_id
+                        AND user_nicknames.is_member = 1
+                    WHERE guild_karma.guild_id = ?
+                    ORDER BY guild_karma.karma {order}, guild_karma.user_id ASC
+                    LIMIT ?
+            """
+        else:
+            ranked_sql = f"""
                     SELECT karma.user_id, karma.karma, user_nicknames.nickname
                     FROM karma
                     JOIN user_nicknames
@@ -317,7 +1139,12 @@ class KarmaDatabase:
                         AND user_nicknames.is_member = 1
                     ORDER BY karma.karma {order}, karma.user_id ASC
                     LIMIT ?
-                ) AS ranked
+            """
+        with self._read() as conn:
+            cur = conn.execute(
+                f"""
+                SELECT ranked.user_id, ranked.karma, users.user_name, ranked.nickname
+                FROM ({ranked_sql}) AS ranked
                 LEFT JOIN users ON users.user_id = ranked.user_id
                 ORDER BY ranked.karma {order}, ranked.user_id ASC
             """,
@@ -325,15 +1152,155 @@ class KarmaDatabase:
             )
             return cur.fetchall()
 
+    def get_windowed_karma_entries(
+        self, guild_id: int, days: int, limit: int, descending: bool = True
+    ) -> list[sqlite3.Row]:
+        """
+        Return users ranked by the karma they were given in the last few days.
+
+        Only users given karma in the window are ranked.  Rows have the same
+        shape as get_top_karma_entries, with `karma` holding the window's total.
+
+        Args:
+            guild_id (int): The guild to rank current members of.
+            days (int): Window length in days, including today.
+            limit (int): Maximum rows to return.
+            descending (bool): Most karma first when True, least when False.
+
+        Returns:
+            list[sqlite3.Row]: user_id, karma, user_name and nickname rows.
+        """
+        order = "DESC" if descending else "ASC"
+        first_day = int(time.time()) // SECONDS_PER_DAY - (days - 1)
+        if self.guild_scoped:
+            # One range scan of this guild's slice of the primary key.
+            totals_sql = """
+                    SELECT user_id, SUM(delta) AS karma
+                    FROM karma_daily
+                    WHERE guild_id = ? AND day >= ?
+                    GROUP BY user_id
+            """
+            params = (guild_id, first_day, guild_id, limit)
+        else:
+            # Global karma counts what was given in any guild.
+            totals_sql = """
+                    SELECT user_id, SUM(delta) AS karma
+                    FROM karma_daily
+                    WHERE day >= ?
+                    GROUP BY user_id
+            """
+            params = (first_day, guild_id, limit)
+        with self._read() as conn:
+            cur = conn.execute(
+                f"""
+                SELECT totals.user_id, totals.karma, users.user_name,
+                    user_nicknames.nickname
+                FROM ({totals_sql}) AS totals
+                JOIN user_nicknames
+                    ON user_nicknames.user_id = totals.user_id
+                    AND user_nicknames.guild_id = ?
+                    AND user_nicknames.is_member = 1
+                LEFT JOIN users ON users.user_id = totals.user_id
+                ORDER BY totals.karma {order}, totals.user_id ASC
+                LIMIT ?
+            """,
+                params,
+            )
+            return cur.fetchall()
+
+    def member_karma_rows(self) -> list[tuple[int, int, int]]:
+        """
+        Return the karma of every current guild member, for rank indexing.
+
+        Returns:
+            list[tuple[int, int, int]]: (guild_id, user_id, karma) rows.
+        """
+        if self.guild_scoped:
+            sql = """
+                SELECT guild_karma.guild_id, guild_karma.user_id, guild_karma.karma
+                FROM guild_karma
+                JOIN user_nicknames
+                    ON user_nicknames.user_id = guild_karma.user_id
+                    AND user_nicknames.guild_id = guild_karma.guild_id
+                    AND user_nicknames.is_member = 1
+            """
+        else:
+            sql = """
+                SELECT user_nicknames.guild_id, karma.user_id, karma.karma
+                FROM karma
+                JOIN user_nicknames
+                    ON user_nicknames.user_id = karma.user_id
+                    AND user_nicknames.is_member = 1
+            """
+        with self._read() as conn:
+            return [(row[0], row[1], row[2]) for row in conn.execute(sql)]
+
     def all_guild_ids(self) -> list[int]:
         """Return all guild IDs in the local registry."""
-        with self._get_conn() as conn:
+        with self._read() as conn:
             cur = conn.execute("SELECT guild_id FROM guilds ORDER BY guild_id")
             return [row[0] for row in cur.fetchall()]
 
+    def registry_backfill_plan(self, guild_id: int, after_user_id: int = 0) -> list[int]:
+        """
+        Return every karma user missing registry data for a guild, in one query.
+
+        A user needs backfilling when they have no `users` row, or no
+        `user_nicknames` row for the guild, or an unknown membership state.
+
+        Args:
+            guild_id (int): The guild to plan for.
+            after_user_id (int): Only return user IDs above this, to resume
+                an interrupted run.
+
+        Returns:
+            list[int]: User IDs in ascending order.
+        """
+        table = "guild_karma" if self.guild_scoped else "karma"
+        with self._read() as conn:
+            cur = conn.execute(
+                f"""
+                WITH karma_users AS (SELECT DISTINCT user_id FROM {table})
+                SELECT karma_users.user_id
+                FROM karma_users
+                LEFT JOIN users ON users.user_id = karma_users.user_id
+                LEFT JOIN user_nicknames
+                    ON user_nicknames.user_id = karma_users.user_id
+                    AND user_nicknames.guild_id = ?
+                WHERE karma_users.user_id > ?
+                    AND (users.user_id IS NULL OR user_nicknames.is_member IS NULL)
+                ORDER BY karma_users.user_id
+            """,
+                (guild_id, after_user_id),
+            )
+            return [row[0] for row in cur.fetchall()]
+
+    def mark_departed(self, guild_id: int, user_ids: list[int]) -> None:
+        """
+        Record users as not in a guild, in one transaction.
+
+        Users without a registry name get a `user-<id>` placeholder; existing
+        names are kept.
+
+        Args:
+            guild_id (int): The guild the users are not in.
+            user_ids (list[int]): The users to mark.
+        """
+        with self._write() as conn:
+            conn.executemany(
+                INSERT_PLACEHOLDER_USER_SQL,
+                [(user_id, f"user-{user_id}") for user_id in user_ids],
+            )
+            conn.executemany(
+                UPSERT_USER_NICKNAME_SQL,
+                [(user_id, guild_id, None, 0) for user_id in user_ids],
+            )
+        for user_id in user_ids:
+            self.registry_cache.forget_member(user_id, guild_id)
+
     def needs_registry_backfill(self, user_id: int, guild_id: int) -> bool:
         """Return True when we are missing user or guild-specific name data."""
-        with self._get_conn() as conn:
+        with self._read() as conn:
             user_row = conn.execute(
                 "SELECT 1 FROM users WHERE user_id = ?",
                 (user_id,),
@@ -354,9 +1321,105 @@ class KarmaDatabase:
 
     def has_user_registry_entry(self, user_id: int) -> bool:
         """Return True if the user exists in the local registry."""
-        with self._get_conn() as conn:
+        with self._read() as conn:
             row = conn.execute(
                 "SELECT 1 FROM users WHERE user_id = ?",
                 (user_id,),
             ).fetchone()
         return row is not None
+
+    # Maintenance
+
+    def checkpoint(self, mode: str = "PASSIVE") -> bool:
+        """
+        Copy the write-ahead log into the database file.
+
+        Args:
+            mode (str): "PASSIVE" copies what it can without waiting on
+                readers, so it never stalls the writer.  "TRUNCATE" also
+                waits up to the busy timeout for readers to finish and then
+                empties the log; keep it for offline use.
+
+        Returns:
+            bool: True if the whole log was copied, False if readers held
+                part of it back.
+        """
+        if mode not in ("PASSIVE", "TRUNCATE"):
+            raise ValueError(f"Unsupported checkpoint mode: {mode}")
+        with self._write_lock:
+            busy, logged, copied = self._writer.execute(
+                f"PRAGMA wal_checkpoint({mode})"
+            ).fetchone()
+        return busy == 0 and logged == copied
+
+    def optimize(self, analysis_limit: int = MAINTENANCE_ANALYSIS_LIMIT) -> None:
+        """
+        Refresh the query planner's statistics.
+
+        The first run analyzes every table; later runs use PRAGMA optimize,
+        which only re-analyzes tables whose statistics look stale.
+
+        Args:
+            analysis_limit (int): Rows sampled per index, so analysis stays
+                quick on large files. 0 samples everything.
+        """
+        with self._write_lock:
+            conn = self._writer
+            conn.execute(f"PRAGMA analysis_limit = {int(analysis_limit)}")
+            analyzed = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'"
+            ).fetchone()
+            conn.execute("PRAGMA optimize" if analyzed else "ANALYZE")
+
+    def incremental_vacuum(self, pages: int = MAINTENANCE_VACUUM_PAGES) -> int:
+        """
+        Return up to `pages` free pages to the file system.
+
+        Does nothing on files created without incremental auto-vacuum; run
+        `vacuum` once to convert them.
+
+        Returns:
+            int: The number of free pages left in the file.
+        """
+        with self._write_lock:
+            conn = self._writer
+            if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                return 0
+            # execute() would free only one page: the pragma frees a page per
+            # step and returns no rows, so Python stops after the first step.
+            conn.executescript(f"PRAGMA incremental_vacuum({int(pages)});")
+            return conn.execute("PRAGMA freelist_count").fetchone()[0]
+
+    def vacuum(self) -> None:
+        """
+        Rebuild the whole file, switching it to incremental auto-vacuum.
+
+        This blocks every write until it finishes, so only run it with the
+        bot stopped.
+        """
+        with self._write_lock:
+            self._writer.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            self._writer.execute("VACUUM")
+
+    def backup(self, path: str) -> None:
+        """
+        Copy the database to `path` with the SQLite online backup API.
+
+        The copy is taken from a separate connection in one step, so it is
+        a consistent snapshot and, in WAL mode, does not block writers.  It
+        is written next to `path` and moved into place once complete.
+
+        Args:
+            path (str): Where to write the backup.
+        """
+        temp_path = f"{path}.tmp"
+        source = self._connect()
+        try:
+            target = sqlite3.connect(temp_path)
+            try:
+                source.backup(target)
+            finally:
+                target.close()
+        finally:
+            source.close()
+        os.replace(temp_path, path)
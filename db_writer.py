@@ -0,0 +1,328 @@
+"""Single-writer database access for sharded Karmabot deployments.
+
+When the bot runs as several shard processes, only one process may write
+to the SQLite file.  This module provides:
+
+- DatabaseWriter, which owns the only KarmaDatabase writer and serves write
+  requests from shard processes over a local multiprocessing connection,
+  and publishes every applied karma change to subscribed shards.
+- RemoteKarmaDatabase, a KarmaDatabase for shard processes that reads from
+  its own read-only connections and forwards every write to the writer.
+"""
+
+import queue
+import sqlite3
+import threading
+from multiprocessing.connection import Client, Listener
+
+from db import KarmaDatabase
+from metrics import metrics
+from settings import (
+    KARMA_SCOPE,
+    REGISTRY_FLUSH_INTERVAL,
+    SQLITE_DB,
+    SQLITE_READER_CONNECTIONS,
+)
+from storage import WRITE_METHODS, StorageBackend
+
+# Request name that turns a connection into a karma change subscription.
+SUBSCRIBE = "subscribe"
+
+
+class DatabaseWriter:
+    """
+    Owns the database writer and runs write requests from shard processes.
+
+    Each shard connection is served by its own thread; requests run under
+    the database's write lock, so they are applied one at a time.  Applied
+    karma changes are published to subscribers while the lock is still
+    held, so every shard sees them in commit order.
+    """
+
+    def __init__(
+        self,
+        address,
+        authkey: bytes,
+        db: KarmaDatabase | None = None,
+        flush_interval: float = REGISTRY_FLUSH_INTERVAL,
+        maintenance=None,
+    ):
+        """
+        Initialize a DatabaseWriter and start listening.
+
+        Args:
+            address: Where to listen, as accepted by multiprocessing's Listener.
+            authkey (bytes): Shared secret shard processes must present.
+            db (KarmaDatabase, optional): The database to write to. If None, a
+                new one is created with the default settings.
+            flush_interval (float): Seconds between flushes of buffered writes.
+            maintenance (maintenance.MaintenanceScheduler, optional): Database
+                maintenance to run between flushes while no shard is writing.
+        """
+        self.db = db if db is not None else KarmaDatabase(reader_count=0)
+        self.flush_interval = flush_interval
+        self.maintenance = maintenance
+        self._listener = Listener(address, authkey=authkey)
+        self._subscribers = []
+        self._stopped = threading.Event()
+        self._threads = []
+
+    @property
+    def address(self):
+        """The address shard processes should connect to."""
+        return self._listener.address
+
+    def start(self) -> None:
+        """Start accepting shard connections and flushing in the background."""
+        for target in (self._accept_forever, self._flush_periodically):
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _accept_forever(self) -> None:
+        """Serve every incoming shard connection on its own thread."""
+        while not self._stopped.is_set():
+            try:
+                conn = self._listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn) -> None:
+        """Run one shard's requests until it disconnects."""
+        while True:
+            try:
+                name, args, kwargs = conn.recv()
+            except (EOFError, OSError):
+                conn.close()
+                return
+
+            if name == SUBSCRIBE:
+                with self.db._write_lock:
+                    self._subscribers.append(conn)
+                return
+            if name not in WRITE_METHODS:
+                conn.send((False, ValueError(f"Unknown write method: {name}")))
+                continue
+            if self.maintenance is not None:
+                self.maintenance.note_activity()
+
+            try:
+                with self.db._write_lock:
+                    result = getattr(self.db, name)(*args, **kwargs)
+                    if name == "apply_karma" and result.applied:
+                        user_id, guild_id = args[0], args[3]
+                        self._publish((user_id, guild_id, result.karma, result.last_karma))
+                    elif name == "apply_karma_batch":
+                        changes, guild_id = args[0], args[2]
+                        for (user_id, _), update in zip(changes, result):
+                            if update.applied:
+                                self._publish(
+                                    (user_id, guild_id, update.karma, update.last_karma)
+                                )
+            except Exception as exc:  # Sent back and re-raised in the shard.
+                conn.send((False, exc))
+            else:
+                conn.send((True, result))
+
+    def _publish(self, change: tuple) -> None:
+        """Send a karma change to every subscriber; caller holds the write lock."""
+        for conn in list(self._subscribers):
+            try:
+                conn.send(change)
+            except OSError:
+                self._subscribers.remove(conn)
+
+    def _flush_periodically(self) -> None:
+        """
+        Write buffered registry rows every flush_interval seconds.
+
+        Due maintenance runs after each flush, for as long as no shard
+        sends a request.
+        """
+        while not self._stopped.wait(self.flush_interval):
+            try:
+                self.db.flush()
+            except sqlite3.Error as exc:
+                # Events were requeued; the next pass will retry them.
+                print(f"Flush failed: {exc}")
+            if self.maintenance is not None:
+                self.maintenance.run_due()
+
+    def close(self) -> None:
+        """Stop serving, flush buffered writes, and close the database."""
+        self._stopped.set()
+        self._listener.close()
+        with self.db._write_lock:
+            for conn in self._subscribers:
+                conn.close()
+            self._subscribers.clear()
+        self.db.flush()
+        self.db.close()
+
+
+def _forward(name: str):
+    """Build a RemoteKarmaDatabase method that runs `name` in the writer."""
+
+    def method(self, *args, **kwargs):
+        return self._call(name, *args, **kwargs)
+
+    method.__name__ = name
+    method.__doc__ = f"Run KarmaDatabase.{name} in the writer process."
+    return method
+
+
+@metrics.instrument_methods("db", skip=("close",), writes=WRITE_METHODS)
+class RemoteKarmaDatabase(KarmaDatabase):
+    """
+    A KarmaDatabase for shard processes.
+
+    Reads use this process's own read-only connections, so shards read
+    concurrently.  Writes are sent to the DatabaseWriter and block until
+    they are committed.  Registry updates are still buffered locally and
+    sent as one batch per flush.
+    """
+
+    def __init__(
+        self,
+        address,
+        authkey: bytes,
+        db_path=SQLITE_DB,
+        reader_count=max(1, SQLITE_READER_CONNECTIONS),
+        guild_scoped=KARMA_SCOPE == "guild",
+    ):
+        """
+        Connect to a DatabaseWriter and open read-only connections.
+
+        The writer creates and migrates the schema, so it must be running
+        first.
+
+        Args:
+            address: The writer's address.
+            authkey (bytes): The writer's shared secret.
+            db_path (str): Path to the SQLite database file.
+            reader_count (int): Number of read-only connections (at least 1).
+            guild_scoped (bool): Keep karma per guild instead of globally.
+        """
+        # Skips KarmaDatabase.__init__, which would open a local writer.
+        StorageBackend.__init__(self, guild_scoped, max(1, reader_count))
+        self.db_path = db_path
+        self.address = address
+        self._authkey = authkey
+        self._conn = Client(address, authkey=authkey)
+        self._conn_lock = threading.Lock()
+        self._write_lock = threading.RLock()
+        self._writer = None
+
+        self._readers = queue.SimpleQueue()
+        for _ in range(self.reader_count):
+            conn = self._connect()
+            conn.execute("PRAGMA query_only = ON")
+            self._readers.put(conn)
+
+    def _call(self, name: str, *args, **kwargs):
+        """Run a write method in the writer process and return its result."""
+        with self._conn_lock:
+            self._conn.send((name, args, kwargs))
+            ok, value = self._conn.recv()
+        if not ok:
+            raise value
+        return value
+
+    def _write(self):
+        """Writes must be forwarded; opening a local write transaction is a bug."""
+        raise RuntimeError("RemoteKarmaDatabase forwards writes to the writer process")
+
+    def close(self) -> None:
+        """Disconnect from the writer and close the reader connections."""
+        with self._conn_lock:
+            self._conn.close()
+        for _ in range(self.reader_count):
+            self._readers.get().close()
+
+    def subscribe(self, callback) -> None:
+        """
+        Receive every karma change applied by any shard.
+
+        Args:
+            callback: Called from a background thread with
+                (user_id, guild_id, karma, last_karma) for each change.
+        """
+        conn = Client(self.address, authkey=self._authkey)
+        conn.send((SUBSCRIBE, (), {}))
+
+        def listen():
+            while True:
+                try:
+                    change = conn.recv()
+                except (EOFError, OSError):
+                    return
+                callback(*change)
+
+        threading.Thread(target=listen, daemon=True).start()
+
+    create = _forward("create")
+    update = _forward("update")
+    delete = _forward("delete")
+    migrate_to_guild_scope = _forward("migrate_to_guild_scope")
+    write_registry_batch = _forward("write_registry_batch")
+    _write_member_sync = _forward("_write_member_sync")
+    prune_karma_buckets = _forward("prune_karma_buckets")
+    rebuild_karma_totals = _forward("rebuild_karma_totals")
+    compact_karma_events = _forward("compact_karma_events")
+
+    def apply_karma(
+        self,
+        user_id: int,
+        delta: int,
+        spam_delay: int = 0,
+        guild_id: int | None = None,
+        giver_id: int | None = None,
+        message_id: int | None = None,
+    ):
+        """Run KarmaDatabase.apply_karma in the writer process."""
+        # Positional, so the writer can find the user and guild to publish.
+        return self._call(
+            "apply_karma", user_id, delta, spam_delay, guild_id, giver_id, message_id
+        )
+
+    def apply_karma_batch(
+        self,
+        changes: list[tuple[int, int]],
+        spam_delay: int = 0,
+        guild_id: int | None = None,
+        giver_id: int | None = None,
+        message_id: int | None = None,
+    ):
+        """Run KarmaDatabase.apply_karma_batch in the writer process."""
+        # Positional, so the writer can find the users and guild to publish.
+        return self._call(
+            "apply_karma_batch", changes, spam_delay, guild_id, giver_id, message_id
+        )
+
+    def upsert_guild(self, guild_id: int, guild_name: str) -> None:
+        """Run KarmaDatabase.upsert_guild in the writer process."""
+        self._call("upsert_guild", guild_id, guild_name)
+        self.registry_cache.forget_guild(guild_id)
+
+    def upsert_user(self, user_id: int, user_name: str) -> None:
+        """Run KarmaDatabase.upsert_user in the writer process."""
+        self._call("upsert_user", user_id, user_name)
+        self.registry_cache.forget_user(user_id)
+
+    def upsert_user_nickname(
+        self,
+        user_id: int,
+        guild_id: int,
+        nickname: str | None,
+        is_member: int | None,
+    ) -> None:
+        """Run KarmaDatabase.upsert_user_nickname in the writer process."""
+        self._call("upsert_user_nickname", user_id, guild_id, nickname, is_member)
+        self.registry_cache.forget_member(user_id, guild_id)
+
+    def mark_departed(self, guild_id: int, user_ids: list[int]) -> None:
+        """Run KarmaDatabase.mark_departed in the writer process."""
+        self._call("mark_departed", guild_id, user_ids)
+        for user_id in user_ids:
+            self.registry_cache.forget_member(user_id, guild_id)
@@ -0,0 +1,113 @@
+"""In-memory karma values for Karmabot.
+
+This module provides the KarmaCache class, a size-bounded LRU copy of the
+karma values the bot has read or written, so that repeated `@user karma`
+queries are answered without going to the database.
+"""
+
+from collections import OrderedDict
+
+from settings import KARMA_CACHE_SIZE
+
+# Returned by `get` when a key is not cached; None means "known not to exist".
+MISSING = object()
+
+
+class KarmaCache:
+    """
+    Remembers recently read and written karma values.
+
+    Keys are StorageBackend.karma_key values, so each guild of a user has its
+    own entry in guild-scoped mode.  A cached None records that the user has
+    no karma row, so lookups of unknown users are cached too.
+
+    The database stays authoritative; writes must be reported through `set`
+    or `forget`.  Values read on another thread are stored with `fill`, which
+    drops them if any write landed while the read was in flight, so a slow
+    read can never overwrite a newer value.  The cache is only touched from
+    the event loop, so it needs no lock.
+    """
+
+    def __init__(self, max_size: int = KARMA_CACHE_SIZE):
+        """
+        Initialize an empty KarmaCache.
+
+        Args:
+            max_size (int): Maximum number of karma values kept. 0 disables
+                the cache.
+        """
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict = OrderedDict()
+        self._writes = 0
+
+    def __len__(self) -> int:
+        """Return the number of cached karma values."""
+        return len(self._entries)
+
+    def get(self, key):
+        """
+        Look up a karma value.
+
+        Returns:
+            int, None or MISSING: The cached karma, None if the user is known
+                to have none, or MISSING if the cache cannot tell.
+        """
+        value = self._entries.get(key, MISSING)
+        if value is MISSING:
+            self.misses += 1
+        else:
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return value
+
+    def _store(self, key, karma: int | None) -> None:
+        """Store a value and evict the least recently used ones past max_size."""
+        entries = self._entries
+        entries[key] = karma
+        entries.move_to_end(key)
+        while len(entries) > self.max_size:
+            entries.popitem(last=False)
+
+    def set(self, key, karma: int | None) -> None:
+        """
+        Record a value just written to the database.
+
+        Args:
+            key: The user (or guild/user pair) whose karma was written.
+            karma (int or None): The new karma, or None if the row was deleted.
+        """
+        self._writes += 1
+        self._store(key, karma)
+
+    def forget(self, key) -> None:
+        """Drop a value whose new karma is unknown, e.g. after a blind update."""
+        self._writes += 1
+        self._entries.pop(key, None)
+
+    def read_stamp(self) -> int:
+        """Return a stamp to pass to `fill` for a read about to start."""
+        return self._writes
+
+    def fill(self, key, karma: int | None, stamp: int) -> None:
+        """
+        Cache a value read from the database, unless a write has since landed.
+
+        Args:
+            key: The user (or guild/user pair) that was read.
+            karma (int or None): The value read.
+            stamp (int): `read_stamp()` taken before the read started.
+        """
+        if stamp == self._writes:
+            self._store(key, karma)
+
+    def clear(self) -> None:
+        """Drop every cached value."""
+        self._writes += 1
+        self._entries.clear()
+
+    def hit_rate(self) -> float:
+        """Return the fraction of karma lookups answered from memory."""
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
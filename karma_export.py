@@ -0,0 +1,170 @@
+"""Export and import karma and registry data as JSONL or CSV.
+
+Every table in storage.EXPORT_TABLES is written to its own file in a
+directory (e.g. `backup/karma.jsonl`).  Rows are streamed through
+generators and read and written EXPORT_CHUNK_SIZE at a time, so exports,
+imports and migrations between storage backends run in constant memory.
+
+Usage:
+    python ./karma_export.py export DIR [--format jsonl|csv] [--tables T ...]
+    python ./karma_export.py import DIR [--format jsonl|csv] [--tables T ...]
+
+Both commands also take --chunk-size N and --backend sqlite|memory, so data
+can be exported from one backend and imported into the other.  Imports
+upsert, so existing rows with the same keys are overwritten.
+
+Stop the bot before running either command.
+"""
+
+import argparse
+import csv
+import json
+import os
+
+from settings import EXPORT_CHUNK_SIZE
+from storage import EXPORT_TABLES, open_storage
+
+# Columns holding text; every other column holds an integer.
+TEXT_COLUMNS = frozenset({"guild_name", "user_name", "nickname"})
+# Columns that may be NULL.  CSV has no NULL, so they are written as "".
+NULLABLE_COLUMNS = frozenset({"nickname", "is_member"})
+
+
+def table_columns(table: str) -> tuple[str, ...]:
+    """Return a table's exported columns, keys first."""
+    keys, values = EXPORT_TABLES[table]
+    return keys + values
+
+
+def jsonl_lines(columns: tuple[str, ...], rows):
+    """Yield one JSON object per row, as a line."""
+    for row in rows:
+        yield json.dumps(dict(zip(columns, row)), ensure_ascii=False) + "\n"
+
+
+def csv_values(rows):
+    """Yield rows with NULLs replaced by empty strings."""
+    for row in rows:
+        yield ["" if value is None else value for value in row]
+
+
+def read_jsonl(path: str, columns: tuple[str, ...]):
+    """Yield a table's rows from a JSONL file."""
+    with open(path, encoding="utf-8") as file:
+        for line in file:
+            if line.strip():
+                record = json.loads(line)
+                yield tuple(record.get(column) for column in columns)
+
+
+def parse_csv_value(column: str, value: str):
+    """Convert a CSV field back to the column's type."""
+    if value == "" and column in NULLABLE_COLUMNS:
+        return None
+    if column in TEXT_COLUMNS:
+        return value
+    return int(value)
+
+
+def read_csv(path: str, columns: tuple[str, ...]):
+    """Yield a table's rows from a CSV file with a header row."""
+    with open(path, encoding="utf-8", newline="") as file:
+        for record in csv.DictReader(file):
+            yield tuple(parse_csv_value(column, record[column]) for column in columns)
+
+
+def export_table(db, table: str, path: str, file_format: str, chunk_size: int) -> int:
+    """
+    Stream one table into a file, replacing it only once complete.
+
+    Returns:
+        int: The number of rows written.
+    """
+    columns = table_columns(table)
+    count = 0
+
+    def counted(rows):
+        nonlocal count
+        for row in rows:
+            count += 1
+            yield row
+
+    rows = counted(db.export_rows(table, chunk_size))
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w", encoding="utf-8", newline="") as file:
+        if file_format == "jsonl":
+            file.writelines(jsonl_lines(columns, rows))
+        else:
+            writer = csv.writer(file)
+            writer.writerow(columns)
+            writer.writerows(csv_values(rows))
+    os.replace(temp_path, path)
+    return count
+
+
+def import_table(db, table: str, path: str, file_format: str, chunk_size: int) -> int:
+    """
+    Stream one table's file into the database.
+
+    Returns:
+        int: The number of rows imported.
+    """
+    columns = table_columns(table)
+    reader = read_jsonl if file_format == "jsonl" else read_csv
+    return db.import_rows(table, reader(path, columns), chunk_size)
+
+
+def parse_args() -> argparse.Namespace:
+    """Parse command-line arguments for the export tools."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=("export", "import"))
+    parser.add_argument("directory", help="Directory holding one file per table.")
+    parser.add_argument("--format", choices=("jsonl", "csv"), default="jsonl")
+    parser.add_argument(
+        "--tables",
+        nargs="+",
+        choices=list(EXPORT_TABLES),
+        default=list(EXPORT_TABLES),
+        help="Tables to export or import. Defaults to all of them.",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=EXPORT_CHUNK_SIZE,
+        help="Rows read and written per batch.",
+    )
+    parser.add_argument(
+        "--backend",
+        choices=("sqlite", "memory"),
+        default=None,
+        help="Storage backend to read or write. Defaults to STORAGE_BACKEND.",
+    )
+    return parser.parse_args()
+
+
+def main() -> None:
+    """Run the requested export or import."""
+    args = parse_args()
+    # Parents first, so imported rows never refer to missing ones.
+    tables = [table for table in EXPORT_TABLES if table in args.tables]
+    chunk_size = max(1, args.chunk_size)
+    db = open_storage(args.backend)
+    try:
+        if args.command == "export":
+            os.makedirs(args.directory, exist_ok=True)
+        for table in tables:
+            path = os.path.join(args.directory, f"{table}.{args.format}")
+            if args.command == "export":
+                count = export_table(db, table, path, args.format, chunk_size)
+                print(f"Exported {count} {table} rows to {path}.")
+            elif not os.path.exists(path):
+                print(f"Skipped {table}: {path} does not exist.")
+            else:
+                count = import_table(db, table, path, args.format, chunk_size)
+                print(f"Imported {count} {table} rows from {path}.")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
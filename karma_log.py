@@ -0,0 +1,62 @@
+"""Maintain karma totals from the karma event log.
+
+Usage:
+    python ./karma_log.py rebuild [--chunk-size N]
+    python ./karma_log.py compact --older-than-days N
+
+Stop the bot before running either command.
+"""
+
+import argparse
+import time
+
+from db import KarmaDatabase
+from settings import KARMA_REBUILD_CHUNK
+
+
+def parse_args() -> argparse.Namespace:
+    """Parse command-line arguments for the event log tools."""
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    rebuild = commands.add_parser(
+        "rebuild", help="Recompute every karma total from the event log."
+    )
+    rebuild.add_argument(
+        "--chunk-size",
+        type=int,
+        default=KARMA_REBUILD_CHUNK,
+        help="Rows fetched and written per batch.",
+    )
+
+    compact = commands.add_parser(
+        "compact",
+        help="Collapse old events into one summary event per user and guild.",
+    )
+    compact.add_argument(
+        "--older-than-days",
+        type=float,
+        required=True,
+        help="Compact events older than this many days.",
+    )
+    return parser.parse_args()
+
+
+def main() -> None:
+    """Run the requested event log command."""
+    args = parse_args()
+    db = KarmaDatabase()
+    try:
+        if args.command == "rebuild":
+            written = db.rebuild_karma_totals(args.chunk_size)
+            print(f"Rebuilt {written} karma totals from the event log.")
+        elif args.command == "compact":
+            before = int(time.time() - args.older_than_days * 86400)
+            removed = db.compact_karma_events(before)
+            print(f"Compacted {removed} events.")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""Message parsing for Karmabot.
+
+This module turns message content into karma commands with a single
+precompiled regex, scanning the message once no matter how many users it
+mentions.
+"""
+
+import re
+from typing import NamedTuple
+
+# A user mention (<@id>, or <@!id> for nicknames) followed by either a
+# keyword ("karma" or "rank") or a run of +/- symbols.
+COMMAND_PATTERN = re.compile(
+    r"<@!?(\d+)>\s*(?:(karma|rank)\b|([+-]+))", re.IGNORECASE
+)
+
+# KarmaCommand actions.
+QUERY = "karma"
+RANK = "rank"
+ADJUST = "adjust"
+
+
+class KarmaCommand(NamedTuple):
+    """A karma query, rank query, or adjustment aimed at one mentioned user."""
+
+    user_id: int
+    action: str
+    delta: int = 0
+
+
+def parse_karma_commands(content: str) -> dict[int, KarmaCommand]:
+    """
+    Extract the karma command for every user mentioned in a message.
+
+    Each user gets at most one command.  A keyword query ("karma" or "rank",
+    whichever comes first) wins over an adjustment; otherwise the user's
+    first adjustment counts, and if that mixes + and - the user gets no
+    command at all.
+
+    Args:
+        content (str): The message content.
+
+    Returns:
+        dict[int, KarmaCommand]: Commands keyed by the mentioned user's ID.
+    """
+    # Fast path: most messages contain no mentions at all.
+    if "<@" not in content:
+        return {}
+
+    commands = {}
+    adjustments = {}
+    for match in COMMAND_PATTERN.finditer(content):
+        user_id = int(match.group(1))
+        keyword = match.group(2)
+        if keyword is not None:
+            if user_id not in commands:
+                commands[user_id] = KarmaCommand(user_id, keyword.lower())
+        elif user_id not in adjustments:
+            adjustments[user_id] = match.group(3)
+
+    for user_id, symbols in adjustments.items():
+        if user_id in commands:
+            continue
+        if symbols.count("+") == len(symbols):
+            commands[user_id] = KarmaCommand(user_id, ADJUST, len(symbols))
+        elif symbols.count("-") == len(symbols):
+            commands[user_id] = KarmaCommand(user_id, ADJUST, -len(symbols))
+    return commands
@@ -2,56 +2,128 @@
 Users can give and receive karma points by using commands."""
 
 import logging
-import re
 
 import discord
 
-from db import KarmaDatabase
+from async_db import shared_database
+from db_writer import RemoteKarmaDatabase
+from karma_parser import ADJUST, QUERY, RANK, KarmaCommand, parse_karma_commands
 from user import User
-from leaderboard import get_leaderboard_by_guild
+from leaderboard import (
+    get_leaderboard_by_guild,
+    get_windowed_leaderboard_by_guild,
+    leaderboard_cache,
+)
+from maintenance import MaintenanceScheduler
+from metrics import metrics
+from rank_index import RankIndex
+from reply_queue import ReplyQueue
 from settings import (
     BUZZKILL_NEGATIVE_MAX,
     BUZZKILL_POSITIVE_MAX,
+    DB_WRITER_ADDRESS,
+    DB_WRITER_AUTHKEY,
     DISCORD_API_KEY,
     ENABLE_LEADERBOARD,
+    ENABLE_MAINTENANCE,
     ENFORCE_KARMA_SPAM_DELAY,
+    KARMA_SPAM_DELAY,
+    LEADERBOARD_WINDOWS,
     PREVENT_SELF_KARMA,
+    SHARD_COUNT,
+    SHARD_IDS,
+    STORAGE_BACKEND,
+    SYNC_MEMBERS_ON_STARTUP,
 )
 
 intents = discord.Intents.default()
 intents.members = True
 intents.message_content = True
-bot = discord.Client(intents=intents)
-db = KarmaDatabase()
+if SHARD_COUNT is None:
+    bot = discord.Client(intents=intents)
+else:
+    bot = discord.AutoShardedClient(
+        intents=intents, shard_count=SHARD_COUNT, shard_ids=SHARD_IDS
+    )
+if DB_WRITER_AUTHKEY is None:
+    db = shared_database()
+else:
+    # A shard process started by shard_launcher.py: writes go to its writer.
+    db = shared_database(RemoteKarmaDatabase(DB_WRITER_ADDRESS, DB_WRITER_AUTHKEY))
+replies = ReplyQueue()
+ranks = RankIndex(guild_scoped=db.guild_scoped)
 
 
 @bot.event
 async def on_ready():
     """Event handler for when the bot is ready."""
+    db.start_flusher()
+    db.start_karma_listener(karma_changed_elsewhere)
+    # Shard processes leave maintenance to the database writer.
+    if (
+        ENABLE_MAINTENANCE
+        and STORAGE_BACKEND == "sqlite"
+        and DB_WRITER_AUTHKEY is None
+        and db.maintenance is None
+    ):
+        db.start_maintenance(MaintenanceScheduler(db.db))
+    metrics.start_textfile_writer()
+    await db.warm_spam_limiter()
     for guild in bot.guilds:
-        db.record_guild(guild)
+        # Guilds are chunked before on_ready, so their member lists are complete.
+        if SYNC_MEMBERS_ON_STARTUP and guild.chunked:
+            sync = await db.sync_guild_members(guild)
+            if any(sync):
+                leaderboard_cache.invalidate_guild(guild.id)
+                print(
+                    f"Synced {guild.name}: {sync.joined} joined, "
+                    f"{sync.left} left, {sync.changed} changed"
+                )
+        else:
+            await db.record_guild(guild)
+    ranks.load(await db.member_karma_rows())
     print(f"Logged in as {bot.user.name} ({bot.user.id})")
 
 
+def karma_changed_elsewhere(user_id: int, guild_id: int | None, karma: int):
+    """Apply a karma change made by any shard process to this process's caches."""
+    leaderboard_cache.karma_changed(
+        user_id, karma, guild_id if db.guild_scoped else None
+    )
+    # Changes made in another process's guilds only matter here for global karma.
+    if guild_id is not None and bot.get_guild(guild_id) is None:
+        guild_id = None
+    if guild_id is not None or not db.guild_scoped:
+        ranks.karma_changed(user_id, karma, guild_id)
+
+
 @bot.event
 async def on_member_join(member):
     """Refresh registry membership data when a user joins a guild."""
-    db.record_member(member)
+    await db.record_member(member)
+    leaderboard_cache.invalidate_guild(member.guild.id)
+    karma = await db.get_karma(member.id, member.guild.id)
+    if karma is not None:
+        ranks.add_member(member.guild.id, member.id, karma)
 
 
 @bot.event
 async def on_member_remove(member):
     """Refresh registry membership data when a user leaves a guild."""
-    db.record_departed_member(member)
+    await db.record_departed_member(member)
+    leaderboard_cache.invalidate_guild(member.guild.id)
+    ranks.remove_member(member.guild.id, member.id)
 
 
 @bot.event
 async def on_member_update(before, after):
     """Refresh registry membership data when a member's profile changes."""
     if before.nick != after.nick or before.display_name != after.display_name:
-        db.record_member(after)
+        await db.record_member(after)
+        leaderboard_cache.invalidate_guild(after.guild.id)
 
 
+@metrics.timed()
 async def bot_commands(message):
     """Handles bot commands.\n\n
 
@@ -71,141 +143,218 @@ async def bot_commands(message):
             "- `@user -` or `@user --`\n    Remove karma from a user"
             + f" (max of {BUZZKILL_NEGATIVE_MAX}).\n"
             "- `@user karma`\n    Check a user's karma.\n"
+            "- `@user rank`\n    Show a user's rank and who is around them.\n"
             f"- `@{bot_member.display_name} top`\n    Show the top users by karma.\n"
             f"- `@{bot_member.display_name} bottom`\n    Show the bottom users by karma.\n"
+            f"- `@{bot_member.display_name} top week` or `top month`\n"
+            "    Show who received the most (or with `bottom`, least) karma recently.\n"
+            f"- `@{bot_member.display_name} stats`\n"
+            "    Show performance stats (server administrators only).\n"
             f"- `@{bot_member.display_name} help` or `?`\n    Show this help message.\n"
         )
-        await message.channel.send(help_message)
+        replies.post(message.channel, help_message)
+
+    # Stats requests
+    if "stats" in message.content.lower():
+        if not message.author.guild_permissions.administrator:
+            replies.post(
+                message.channel, "Only server administrators can see bot stats."
+            )
+        elif not metrics.enabled:
+            replies.post(
+                message.channel, "Stats are disabled; set ENABLE_METRICS to enable them."
+            )
+        else:
+            replies.post(message.channel, f"📊 **Bot Stats:**\n```{metrics.summary()}```")
 
     # Leaderboard requests
     if "top" in message.content.lower() or "bottom" in message.content.lower():
         if ENABLE_LEADERBOARD:
-            await message.channel.send("Fetching leaderboard, please wait...")
-            top_users, bottom_users = await get_leaderboard_by_guild(message.guild)
+            content = message.content.lower()
+            window = next(
+                (name for name in LEADERBOARD_WINDOWS if name in content), None
+            )
+            if window is None:
+                title = ""
+                top_users, bottom_users = await get_leaderboard_by_guild(
+                    message.guild, db
+                )
+            else:
+                title = f" This {window.capitalize()}"
+                top_users, bottom_users = await get_windowed_leaderboard_by_guild(
+                    message.guild, LEADERBOARD_WINDOWS[window], db
+                )
             if "top" in message.content.lower():
-                msg = "🏆 **Top Users:**\n```"
+                msg = f"🏆 **Top Users{title}:**\n```"
                 i = 1
                 for user in top_users:
-                    karma = user.get_karma()
+                    karma = await user.get_karma()
                     karma_str = f"{karma:+d}" if karma != 0 else "0"
                     msg += f"{i}) {user.display_name:<20} {karma_str:>5}\n"
                     i += 1
                 msg += "```"
-                await message.channel.send(msg)
+                replies.post(message.channel, msg)
             if "bottom" in message.content.lower():
-                msg = "💀 **Bottom Users:**\n```"
+                msg = f"💀 **Bottom Users{title}:**\n```"
                 i = 1
                 for user in bottom_users:
-                    karma = user.get_karma()
+                    karma = await user.get_karma()
                     karma_str = f"{karma:+d}" if karma != 0 else "0"
                     msg += f"{i}) {user.display_name:<20} {karma_str:>5}\n"
                     i += 1
                 msg += "```"
-                await message.channel.send(msg)
+                replies.post(message.channel, msg)
 
 
-async def karma_commands(user: User, message: discord.Message):
-    """Handles user's karma adjustments and queries.\n\n
+@metrics.timed()
+async def karma_commands(user: User, command: KarmaCommand, message: discord.Message):
+    """Handles karma and rank queries about a user.\n\n
 
-    This is when a user has been @mentioned in a message.
+    This is when a user has been @mentioned in a message.  Karma adjustments
+    are applied together by karma_adjustments instead.
 
     Args:
         user (User): The User object representing the mentioned user.
+        command (KarmaCommand): The parsed command aimed at this user.
         message (discord.Message): The message that triggered the command.
     """
 
-    # Construct the string version of the mention (e.g. <@123456789012345678>)
-    # This is what the bot sees when someone @mentions a user.
-    mention_str = f"<@{user.id}>"
-    # Discord also supports <@!id> for nicknames
-    alt_mention_str = f"<@!{user.id}>"
-
-    # Construct the regexes for queries and adjustments
-    # Karma query pattern
-    karma_query_pattern = (
-        rf"({re.escape(mention_str)}|{re.escape(alt_mention_str)})\s*karma\b"
-    )
-    # Karma adjustment pattern
-    karma_adjustment_pattern = (
-        rf"({re.escape(mention_str)}|{re.escape(alt_mention_str)})\s*([+-]+)"
-    )
-
     # Command is a karma query
-    if re.search(karma_query_pattern, message.content, re.IGNORECASE):
-        karma = user.get_karma() if user.get_karma() is not None else 0
-        await message.channel.send(f"{user.display_name} has {karma} karma.")
+    if command.action == QUERY:
+        karma = await user.get_karma()
+        if karma is None:
+            karma = 0
+        replies.post(message.channel, f"{user.display_name} has {karma} karma.")
+
+    # Command is a rank query
+    elif command.action == RANK:
+        position = ranks.rank(user.guild_id, user.id)
+        if position is None:
+            replies.post(message.channel, f"{user.display_name} is not ranked yet.")
+            return
+        rank, total = position
+        msg = f"{user.display_name} is ranked #{rank} of {total}.\n```"
+        for entry_rank, member_id, karma in ranks.around(user.guild_id, user.id):
+            member = message.guild.get_member(member_id)
+            name = member.display_name if member is not None else f"user-{member_id}"
+            karma_str = f"{karma:+d}" if karma != 0 else "0"
+            marker = ">" if member_id == user.id else " "
+            msg += f"{marker}{entry_rank}) {name:<20} {karma_str:>5}\n"
+        msg += "```"
+        replies.post(message.channel, msg)
+
+
+@metrics.timed()
+async def karma_adjustments(
+    adjustments: list[tuple[User, KarmaCommand]], message: discord.Message
+):
+    """Applies every karma adjustment in a message as one batch.\n\n
+
+    All deltas are validated first, then written in a single database
+    transaction, and the outcome for every user is sent as one reply.
 
-    # Command is a karma adjustment
-    elif match := re.search(karma_adjustment_pattern, message.content):
+    Args:
+        adjustments (list): (User, KarmaCommand) pairs, one per mentioned user.
+        message (discord.Message): The message that triggered the adjustments.
+    """
+    lines = []
+    notes = []
+    changes = []
+    for user, command in adjustments:
 
         # Prevent self-karma
-        if PREVENT_SELF_KARMA:
-            if user.id == message.author.id:
-                karma = user.get_karma() if user.get_karma() is not None else 0
-                await message.channel.send(f"{user.display_name} has {karma} karma.")
-                await message.channel.send("_Buzzkill Mode™ has prevented self-karma._")
-                return
-
-        # Prevent karma spam
-        if ENFORCE_KARMA_SPAM_DELAY:
-            if not user.can_update_karma():
-                await message.channel.send(
-                    f"{user.display_name} cannot update karma yet."
-                )
-                await message.channel.send("_Buzzkill Mode™ has prevented karma spam._")
-                return
-
-        # Count the +'s and -'s
-        symbol_str = match.group(2)
-        if all(c == "+" for c in symbol_str):
-            delta = len(symbol_str)
-        elif all(c == "-" for c in symbol_str):
-            delta = -len(symbol_str)
-        else:
-            return
+        if PREVENT_SELF_KARMA and user.id == message.author.id:
+            karma = await user.get_karma()
+            if karma is None:
+                karma = 0
+            lines.append(f"{user.display_name} has {karma} karma.")
+            notes.append("_Buzzkill Mode™ has prevented self-karma._")
+            continue
+
+        delta = command.delta
 
         # Cap the karma delta
-        buzzkill = False
         if delta > BUZZKILL_POSITIVE_MAX:
             delta = BUZZKILL_POSITIVE_MAX
-            buzzkill = True
+            notes.append(f"_Buzzkill Mode™ has limited karma change to {delta} points._")
         elif delta < -BUZZKILL_NEGATIVE_MAX:
             delta = -BUZZKILL_NEGATIVE_MAX
-            buzzkill = True
-
-        # Update the user's karma and send a confirmation message
-        user.update_karma(delta)
-        await message.channel.send(
-            f"{user.display_name} now has {user.get_karma()} karma."
+            notes.append(f"_Buzzkill Mode™ has limited karma change to {delta} points._")
+        # Keep the user's place in the reply until the result is known.
+        changes.append((user, delta, len(lines)))
+        lines.append("")
+
+    # Apply the changes; the spam delay is enforced atomically by the database
+    if changes:
+        spam_delay = KARMA_SPAM_DELAY if ENFORCE_KARMA_SPAM_DELAY else 0
+        guild_id = message.guild.id if message.guild is not None else None
+        results = await db.apply_karma_batch(
+            [(user.id, delta) for user, delta, _ in changes],
+            spam_delay,
+            guild_id,
+            giver_id=message.author.id,
+            message_id=message.id,
         )
-        if buzzkill:
-            await message.channel.send(
-                f"_Buzzkill Mode™ has limited karma change to {delta} points._"
-            )
+        for (user, _, line), result in zip(changes, results):
+
+            # Prevent karma spam
+            if not result.applied:
+                lines[line] = f"{user.display_name} cannot update karma yet."
+                notes.append("_Buzzkill Mode™ has prevented karma spam._")
+                continue
+
+            # Shard processes hear this change from the writer too, in commit
+            # order; this reply may arrive after a newer change, so patching
+            # from it is left to karma_changed_elsewhere.
+            if not db.listening:
+                leaderboard_cache.karma_changed(
+                    user.id, result.karma, guild_id if db.guild_scoped else None
+                )
+                if guild_id is not None:
+                    ranks.karma_changed(user.id, result.karma, guild_id)
+            lines[line] = f"{user.display_name} now has {result.karma} karma."
+
+    # Send one confirmation message, with each distinct note once
+    replies.post(message.channel, "\n".join(lines + list(dict.fromkeys(notes))))
 
 
 @bot.event
+@metrics.timed()
 async def on_message(message):
     """Event handler for incoming messages."""
     if message.author.bot:
         return
 
-    db.record_message(message)
+    await db.record_message(message)
 
     if not message.mentions:
         return
 
-    for mentioned_user in message.mentions:
+    commands = parse_karma_commands(message.content)
+    adjustments = []
+    with replies.holding(message.channel):
+        for mentioned_user in message.mentions:
 
-        if mentioned_user == bot.user:
-            await bot_commands(message)
-            continue
+            if mentioned_user == bot.user:
+                await bot_commands(message)
+                continue
 
-        user = User(mentioned_user, db)
-        await karma_commands(user, message)
+            command = commands.get(mentioned_user.id)
+            if command is None:
+                continue
 
+            user = User(mentioned_user, db)
+            if command.action == ADJUST:
+                adjustments.append((user, command))
+            else:
+                await karma_commands(user, command, message)
 
-if __name__ == "__main__":
+        if adjustments:
+            await karma_adjustments(adjustments, message)
+
+
+def main():
+    """Run the bot until it is stopped."""
     # WebSocket close code 1000 is a normal/graceful closure by Discord's servers
     # (e.g. during rolling restarts). discord.py reconnects automatically, so
     # logging these at ERROR level is just noise. Filter them out.
@@ -222,3 +371,9 @@ if __name__ == "__main__":
         print(f"Failed to log in: {e}")
     except discord.DiscordException as e:
         print(f"A Discord-related error occurred: {e}")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,35 +1,193 @@
 """A leaderboard for finding out who has the best and worst karma in a server."""
 
+import time
+
 from discord import Guild
 
-from db import KarmaDatabase
+from async_db import AsyncKarmaDatabase, shared_database
+from metrics import metrics
 from user import User
-from settings import LEADERBOARD_SIZE
+from settings import LEADERBOARD_CACHE_TTL, LEADERBOARD_SIZE
+
+
+def _top_key(row) -> tuple[int, int]:
+    """Sort key for the top leaderboard: highest karma first."""
+    return (-row["karma"], row["user_id"])
+
+
+def _bottom_key(row) -> tuple[int, int]:
+    """Sort key for the bottom leaderboard: lowest karma first."""
+    return (row["karma"], row["user_id"])
+
+
+def _patch_ranking(rows: list[dict], user_id: int, karma: int, key, limit: int) -> bool:
+    """
+    Apply a karma change to a cached ranking in place.
+
+    Args:
+        rows (list[dict]): The cached ranking, sorted by `key`.
+        user_id (int): The user whose karma changed.
+        karma (int): The user's new karma.
+        key: The ranking's sort key.
+        limit (int): The size the ranking was fetched with.
+
+    Returns:
+        bool: False if the change cannot be applied from the cached rows
+            alone and the ranking must be refetched.
+    """
+    for row in rows:
+        if row["user_id"] != user_id:
+            continue
+        old_key = key(row)
+        row["karma"] = karma
+        rows.sort(key=key)
+        # Someone outside the cached rows may now outrank a user who slid
+        # into last place.
+        return not (
+            len(rows) >= limit and rows[-1] is row and key(row) > old_key
+        )
+
+    # A short ranking already holds every member, so any new entrant changes it.
+    if len(rows) < limit:
+        return False
+    # The user may not even be a member; only a user who would make the cut matters.
+    return not key({"user_id": user_id, "karma": karma}) < key(rows[-1])
+
+
+class LeaderboardCache:
+    """
+    Per-guild cache of the top and bottom karma rankings.
+
+    Entries are patched in place when a karma change can be applied from the
+    cached rows alone, and dropped when it cannot, when guild membership
+    changes, or after LEADERBOARD_CACHE_TTL seconds.
+    """
+
+    def __init__(self, ttl: float = LEADERBOARD_CACHE_TTL):
+        """
+        Initialize an empty LeaderboardCache.
+
+        Args:
+            ttl (float): Seconds before a cached ranking is refetched anyway.
+        """
+        self.ttl = ttl
+        self._entries: dict[int, tuple[float, int, list[dict], list[dict]]] = {}
+
+    def get(self, guild_id: int, limit: int) -> tuple[list[dict], list[dict]] | None:
+        """Return the cached (top, bottom) rows for a guild, or None on a miss."""
+        entry = self._entries.get(guild_id)
+        if entry is None:
+            return None
+        expires, cached_limit, top, bottom = entry
+        if cached_limit != limit or time.monotonic() >= expires:
+            del self._entries[guild_id]
+            return None
+        return top, bottom
 
+    def put(
+        self, guild_id: int, limit: int, top: list, bottom: list
+    ) -> tuple[list[dict], list[dict]]:
+        """Cache freshly fetched (top, bottom) rows for a guild and return them."""
+        top = [dict(row) for row in top]
+        bottom = [dict(row) for row in bottom]
+        self._entries[guild_id] = (time.monotonic() + self.ttl, limit, top, bottom)
+        return top, bottom
 
-async def get_leaderboard_by_guild(guild: Guild) -> tuple[list[User], list[User]]:
+    def invalidate_guild(self, guild_id: int) -> None:
+        """Drop a guild's cached rankings, e.g. after a membership change."""
+        self._entries.pop(guild_id, None)
+
+    def karma_changed(
+        self, user_id: int, karma: int, guild_id: int | None = None
+    ) -> None:
+        """
+        Patch or drop every cached ranking affected by a user's karma change.
+
+        Args:
+            user_id (int): The user whose karma changed.
+            karma (int): The user's new karma.
+            guild_id (int, optional): The only guild affected, for guild-scoped
+                karma. When None, the karma is global and the change can
+                affect any guild the user is in.
+        """
+        if guild_id is None:
+            guild_ids = list(self._entries)
+        else:
+            guild_ids = [guild_id] if guild_id in self._entries else []
+
+        for cached_guild_id in guild_ids:
+            _, limit, top, bottom = self._entries[cached_guild_id]
+            if not (
+                _patch_ranking(top, user_id, karma, _top_key, limit)
+                and _patch_ranking(bottom, user_id, karma, _bottom_key, limit)
+            ):
+                del self._entries[cached_guild_id]
+
+
+leaderboard_cache = LeaderboardCache()
+
+
+@metrics.timed()
+async def get_leaderboard_by_guild(
+    guild: Guild,
+    db: AsyncKarmaDatabase | None = None,
+    cache: LeaderboardCache = leaderboard_cache,
+) -> tuple[list[User], list[User]]:
     """Returns a list of users with the most and least karma.
-    
+
     Args:
         guild (discord.Guild): The Discord guild to fetch the leaderboard for.
+        db (AsyncKarmaDatabase, optional): The database to query. If None,
+            the process-wide shared database is used.
+        cache (LeaderboardCache, optional): Where rankings are cached between
+            requests. Defaults to the shared module-level cache.
     Returns:
         tuple: A tuple containing two lists:
             - The top users with the most karma.
             - The bottom users with the least karma.
     """
-    db = KarmaDatabase()
-    user_count = db.karma_user_count()
-    if not user_count:
-        return [], []
-
-    size = max(1, min(LEADERBOARD_SIZE, 100, user_count))
-    top_users = [
-        User.from_registry_row(row, db)
-        for row in db.get_top_karma_entries(guild.id, size)
-    ]
-    bottom_users = [
-        User.from_registry_row(row, db)
-        for row in db.get_bottom_karma_entries(guild.id, size)
-    ]
+    size = max(1, min(LEADERBOARD_SIZE, 100))
+    cached = cache.get(guild.id, size)
+    if cached is None:
+        if db is None:
+            db = shared_database()
+        top_rows = await db.get_top_karma_entries(guild.id, size)
+        bottom_rows = await db.get_bottom_karma_entries(guild.id, size)
+        cached = cache.put(guild.id, size, top_rows, bottom_rows)
+
+    top_rows, bottom_rows = cached
+    top_users = [User.from_registry_row(row, db, guild.id) for row in top_rows]
+    bottom_users = [User.from_registry_row(row, db, guild.id) for row in bottom_rows]
+
+    return top_users, bottom_users
+
+
+@metrics.timed()
+async def get_windowed_leaderboard_by_guild(
+    guild: Guild, days: int, db: AsyncKarmaDatabase | None = None
+) -> tuple[list[User], list[User]]:
+    """Returns the users given the most and least karma in the last few days.
+
+    Windowed rankings are read from the daily karma buckets rather than
+    cached, since they shift as days roll over.
+
+    Args:
+        guild (discord.Guild): The Discord guild to fetch the leaderboard for.
+        days (int): Window length in days, including today.
+        db (AsyncKarmaDatabase, optional): The database to query. If None,
+            the process-wide shared database is used.
+    Returns:
+        tuple: A tuple containing two lists:
+            - The top users by karma received in the window.
+            - The bottom users by karma received in the window.
+    """
+    size = max(1, min(LEADERBOARD_SIZE, 100))
+    if db is None:
+        db = shared_database()
+    top_rows = await db.get_windowed_karma_entries(guild.id, days, size, True)
+    bottom_rows = await db.get_windowed_karma_entries(guild.id, days, size, False)
+
+    top_users = [User.from_registry_row(row, db, guild.id) for row in top_rows]
+    bottom_users = [User.from_registry_row(row, db, guild.id) for row in bottom_rows]
 
     return top_users, bottom_users
@@ -0,0 +1,235 @@
+"""Background database maintenance for Karmabot.
+
+This module provides the MaintenanceScheduler class, which keeps a
+long-running SQLite database healthy: it checkpoints the write-ahead log,
+refreshes the query planner's statistics, returns free pages to the file
+system and writes backups, each on its own cadence.
+
+Maintenance only runs once the bot has been idle for a while, and long
+tasks run in small steps with an idle check between each, so it gets out
+of the way as soon as messages arrive again.
+
+It can also be run by hand, with the bot stopped:
+    python ./maintenance.py run       (run every task now)
+    python ./maintenance.py backup    (write a backup to DB_BACKUP_DIR)
+    python ./maintenance.py vacuum    (rebuild the file; needed once for
+                                       databases created before free page
+                                       cleanup existed)
+"""
+
+import argparse
+import asyncio
+import glob
+import os
+import sqlite3
+import time
+
+from db import KarmaDatabase
+from settings import (
+    DB_BACKUP_DIR,
+    DB_BACKUP_KEEP,
+    MAINTENANCE_IDLE_SECONDS,
+    MAINTENANCE_INTERVALS,
+)
+
+# Maintenance tasks, in the order they run when several are due.
+TASKS = ("checkpoint", "optimize", "vacuum", "backup")
+# Tasks that use the writer connection.  Backups read through their own
+# connection, so they run beside the writer instead of queueing behind it.
+WRITER_TASKS = frozenset({"checkpoint", "optimize", "vacuum"})
+
+
+def _backup_order(path: str) -> tuple[str, int]:
+    """Sort key putting backups oldest first, numbered same-second ones included."""
+    stem = os.path.basename(path)[: -len(".sqlite3")]
+    stamp, _, count = stem.partition(".")
+    return stamp, int(count or 0)
+
+
+class MaintenanceScheduler:
+    """
+    Runs database maintenance tasks when they are due and the bot is idle.
+
+    Callers report activity with `note_activity`.  A task is due once its
+    interval has passed since it last finished; every task first runs one
+    interval after the scheduler is created.  Vacuuming is done a few pages
+    per step, and a task interrupted by activity resumes on the next idle
+    period.
+    """
+
+    def __init__(
+        self,
+        db: KarmaDatabase,
+        intervals: dict = MAINTENANCE_INTERVALS,
+        idle_seconds: float = MAINTENANCE_IDLE_SECONDS,
+        backup_dir: str = DB_BACKUP_DIR,
+        backup_keep: int = DB_BACKUP_KEEP,
+    ):
+        """
+        Initialize a MaintenanceScheduler.
+
+        Args:
+            db (KarmaDatabase): The database to maintain.
+            intervals (dict): Seconds between runs of each task in TASKS;
+                tasks that are missing or None never run.
+            idle_seconds (float): Seconds without activity before tasks run.
+            backup_dir (str): Directory backups are written to.
+            backup_keep (int): Number of the newest backups to keep.
+        """
+        self.db = db
+        self.intervals = {
+            task: intervals[task] for task in TASKS if intervals.get(task)
+        }
+        self.idle_seconds = idle_seconds
+        self.backup_dir = backup_dir
+        self.backup_keep = backup_keep
+        now = time.monotonic()
+        self.last_run = {task: now for task in self.intervals}
+        self.last_activity = now
+        self._task = None
+
+    def note_activity(self) -> None:
+        """Record that the bot is busy, so maintenance holds off."""
+        self.last_activity = time.monotonic()
+
+    def is_idle(self) -> bool:
+        """Return True once no activity has been seen for idle_seconds."""
+        return time.monotonic() - self.last_activity >= self.idle_seconds
+
+    def due(self) -> list[str]:
+        """Return the tasks whose interval has passed, in TASKS order."""
+        now = time.monotonic()
+        return [
+            task
+            for task, interval in self.intervals.items()
+            if now - self.last_run[task] >= interval
+        ]
+
+    def step(self, task: str) -> bool:
+        """
+        Run one step of a task.  Blocks, so call it off the event loop.
+
+        A failed step is reported and counts as finished, so it is retried
+        one interval later instead of straight away.
+
+        Args:
+            task (str): One of TASKS.
+
+        Returns:
+            bool: True if the task is finished, False if it has more steps.
+        """
+        try:
+            if task == "checkpoint":
+                self.db.checkpoint()
+            elif task == "optimize":
+                self.db.optimize()
+            elif task == "vacuum":
+                if self.db.incremental_vacuum():
+                    return False
+            elif task == "backup":
+                self.backup()
+        except (sqlite3.Error, OSError) as exc:
+            print(f"Database maintenance task {task} failed: {exc}")
+        self.last_run[task] = time.monotonic()
+        return True
+
+    def backup(self) -> str:
+        """
+        Write a timestamped backup and delete all but the newest backup_keep.
+
+        Returns:
+            str: The path of the new backup.
+        """
+        os.makedirs(self.backup_dir, exist_ok=True)
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        path = os.path.join(self.backup_dir, f"karma-{stamp}.sqlite3")
+        # Two backups in the same second get numbered instead of overwriting.
+        count = 0
+        while os.path.exists(path):
+            count += 1
+            path = os.path.join(self.backup_dir, f"karma-{stamp}.{count}.sqlite3")
+        self.db.backup(path)
+        backups = sorted(
+            glob.glob(os.path.join(self.backup_dir, "karma-*.sqlite3")),
+            key=_backup_order,
+        )
+        for old in backups[: max(0, len(backups) - self.backup_keep)]:
+            os.remove(old)
+        return path
+
+    def run_due(self) -> int:
+        """
+        Run due tasks step by step on this thread while the bot stays idle.
+
+        Returns:
+            int: The number of tasks finished.
+        """
+        finished = 0
+        for task in self.due():
+            while self.is_idle():
+                if self.step(task):
+                    finished += 1
+                    break
+            if not self.is_idle():
+                break
+        return finished
+
+    def start(self, run_on_writer, check_interval: float = 5.0) -> None:
+        """
+        Start the background task that runs maintenance from the event loop.
+
+        Calling this again while the task is running has no effect.
+
+        Args:
+            run_on_writer: Awaitable runner that calls a function on the
+                database writer thread, e.g. AsyncKarmaDatabase._run.
+            check_interval (float): Seconds between checks for due tasks.
+        """
+        if self._task is not None and not self._task.done():
+            return
+        self._task = asyncio.create_task(
+            self._run_periodically(run_on_writer, check_interval)
+        )
+
+    async def _run_periodically(self, run_on_writer, check_interval: float) -> None:
+        """Run due tasks forever, one step per writer-thread call."""
+        while True:
+            await asyncio.sleep(check_interval)
+            for task in self.due():
+                run = run_on_writer if task in WRITER_TASKS else asyncio.to_thread
+                # Each step is queued separately, so messages arriving
+                # between steps are handled before the next one starts.
+                while self.is_idle() and not await run(self.step, task):
+                    pass
+                if not self.is_idle():
+                    break
+
+
+def main() -> None:
+    """Run maintenance tasks by hand."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=("run", "backup", "vacuum"))
+    args = parser.parse_args()
+    db = KarmaDatabase(reader_count=0)
+    try:
+        if args.command == "vacuum":
+            db.vacuum()
+            print("Vacuumed the database.")
+            return
+        scheduler = MaintenanceScheduler(db)
+        if args.command == "backup":
+            print(f"Wrote {scheduler.backup()}.")
+            return
+        db.checkpoint("TRUNCATE")
+        db.optimize()
+        while db.incremental_vacuum():
+            pass
+        print("Checkpointed, analyzed and vacuumed the database.")
+        if "backup" in scheduler.intervals:
+            print(f"Wrote {scheduler.backup()}.")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,856 @@
+"""In-memory storage backend for Karmabot.
+
+This module provides the MemoryKarmaDatabase class, which keeps karma, the
+user/guild registry and the daily karma buckets in plain dictionaries and
+persists them through an append-only journal plus periodic snapshots.
+
+Every write appends the rows it changed to the journal as one JSON line, so
+replaying the journal over the last snapshot rebuilds the exact state, and a
+write is replayed either whole or not at all.
+Once the journal grows past MEMORY_SNAPSHOT_EVERY records, the next flush
+writes a fresh snapshot and truncates the journal.
+"""
+
+import heapq
+import json
+import os
+import threading
+import time
+from itertools import islice
+from typing import Iterable, Iterator
+
+from metrics import metrics
+from settings import (
+    EXPORT_CHUNK_SIZE,
+    KARMA_SCOPE,
+    KARMA_SPAM_DELAY,
+    MEMORY_DB_JOURNAL,
+    MEMORY_DB_SNAPSHOT,
+    MEMORY_SNAPSHOT_EVERY,
+)
+from storage import (
+    SECONDS_PER_DAY,
+    WRITE_METHODS,
+    KarmaEntry,
+    KarmaUpdate,
+    MemberSync,
+    StorageBackend,
+)
+
+# Journal record kinds.  Every record sets a row to its new value, so
+# replaying a record that is already reflected in the snapshot is harmless.
+# Each journal line holds the list of records of one write; journals from
+# before that hold one record per line.
+KARMA = "k"  # [KARMA, guild_id or None, user_id, karma, last_karma]
+KARMA_DELETED = "kd"  # [KARMA_DELETED, guild_id or None, user_id]
+GUILD = "g"  # [GUILD, guild_id, guild_name]
+USER = "u"  # [USER, user_id, user_name]
+NICKNAME = "n"  # [NICKNAME, user_id, guild_id, nickname, is_member]
+BUCKET = "b"  # [BUCKET, guild_id or 0, day, user_id, delta]
+BUCKETS_PRUNED = "bp"  # [BUCKETS_PRUNED, before_day]
+GUILD_KARMA_SEEDED = "gs"  # [GUILD_KARMA_SEEDED]
+
+
+@metrics.instrument_methods("db", skip=("close",), writes=WRITE_METHODS)
+class MemoryKarmaDatabase(StorageBackend):
+    """
+    Keeps all karma data in memory, journaled to disk.
+
+    Reads never touch the disk, and a write costs one buffered append to
+    the journal.  All data must fit in memory, and only one process may
+    open a journal at a time.
+
+    Karma given outside a guild is bucketed under guild 0, as in the
+    SQLite backend.  There is no per-event karma log; the journal records
+    totals, not individual events.
+    """
+
+    def __init__(
+        self,
+        journal_path=MEMORY_DB_JOURNAL,
+        snapshot_path=MEMORY_DB_SNAPSHOT,
+        snapshot_every=MEMORY_SNAPSHOT_EVERY,
+        guild_scoped=KARMA_SCOPE == "guild",
+    ):
+        """
+        Initialize a MemoryKarmaDatabase, loading the last snapshot and journal.
+
+        Args:
+            journal_path (str): Path to the append-only journal.
+            snapshot_path (str): Path to the snapshot file.
+            snapshot_every (int): Journal records after which a flush writes
+                a new snapshot.
+            guild_scoped (bool): Keep karma per guild instead of globally.
+        """
+        super().__init__(guild_scoped)
+        self.journal_path = journal_path
+        self.snapshot_path = snapshot_path
+        self.snapshot_every = snapshot_every
+        self._write_lock = threading.RLock()
+        self._karma: dict[int, tuple[int, int]] = {}
+        self._guild_karma: dict[int, dict[int, tuple[int, int]]] = {}
+        self._guilds: dict[int, str] = {}
+        self._users: dict[int, str] = {}
+        self._members: dict[int, dict[int, tuple[str | None, int | None]]] = {}
+        self._buckets: dict[int, dict[int, dict[int, int]]] = {}
+        self._guild_karma_seeded = False
+
+        self._load_snapshot()
+        self._journal_records = self._replay_journal()
+        # Files seeded before the seed was recorded already have guild karma.
+        self._guild_karma_seeded = self._guild_karma_seeded or any(
+            self._guild_karma.values()
+        )
+        self._journal = open(self.journal_path, "a", encoding="utf-8")
+        if guild_scoped:
+            self.migrate_to_guild_scope()
+
+    # Persistence
+
+    def _load_snapshot(self) -> None:
+        """Load the last snapshot, if there is one."""
+        try:
+            with open(self.snapshot_path, encoding="utf-8") as file:
+                snapshot = json.load(file)
+        except FileNotFoundError:
+            return
+
+        self._karma = {row[0]: (row[1], row[2]) for row in snapshot["karma"]}
+        for guild_id, user_id, karma, last_karma in snapshot["guild_karma"]:
+            self._guild_karma.setdefault(guild_id, {})[user_id] = (karma, last_karma)
+        self._guilds = {row[0]: row[1] for row in snapshot["guilds"]}
+        self._users = {row[0]: row[1] for row in snapshot["users"]}
+        for user_id, guild_id, nickname, is_member in snapshot["members"]:
+            self._members.setdefault(guild_id, {})[user_id] = (nickname, is_member)
+        for guild_id, day, user_id, delta in snapshot["buckets"]:
+            self._buckets.setdefault(guild_id, {}).setdefault(day, {})[user_id] = delta
+        self._guild_karma_seeded = snapshot.get("guild_karma_seeded", False)
+
+    def _replay_journal(self) -> int:
+        """Apply every journal record written since the snapshot; returns the count."""
+        count = 0
+        good_bytes = 0
+        try:
+            file = open(self.journal_path, "rb")
+        except FileNotFoundError:
+            return 0
+
+        with file:
+            for line in file:
+                try:
+                    if not line.endswith(b"\n"):
+                        raise ValueError("unterminated record")
+                    records = json.loads(line)
+                except ValueError:
+                    # A crash mid-append leaves a torn last line.  It was
+                    # never acknowledged, so it is cut off before appending.
+                    print(f"Dropping a torn record at the end of {self.journal_path}")
+                    os.truncate(self.journal_path, good_bytes)
+                    break
+                if isinstance(records[0], str):
+                    records = [records]
+                for record in records:
+                    self._apply(record)
+                good_bytes += len(line)
+                count += len(records)
+        return count
+
+    def _apply(self, record: list) -> None:
+        """Apply one journal record to the in-memory state."""
+        kind = record[0]
+        if kind == KARMA:
+            _, guild_id, user_id, karma, last_karma = record
+            self._karma_rows(guild_id, create=True)[user_id] = (karma, last_karma)
+        elif kind == KARMA_DELETED:
+            _, guild_id, user_id = record
+            self._karma_rows(guild_id).pop(user_id, None)
+        elif kind == GUILD:
+            self._guilds[record[1]] = record[2]
+        elif kind == USER:
+            self._users[record[1]] = record[2]
+        elif kind == NICKNAME:
+            _, user_id, guild_id, nickname, is_member = record
+            self._members.setdefault(guild_id, {})[user_id] = (nickname, is_member)
+        elif kind == BUCKET:
+            _, guild_id, day, user_id, delta = record
+            self._buckets.setdefault(guild_id, {}).setdefault(day, {})[user_id] = delta
+        elif kind == BUCKETS_PRUNED:
+            for days in self._buckets.values():
+                for day in [day for day in days if day < record[1]]:
+                    del days[day]
+        elif kind == GUILD_KARMA_SEEDED:
+            self._guild_karma_seeded = True
+        else:
+            raise ValueError(f"Unknown journal record: {record!r}")
+
+    def _commit(self, records: list[list]) -> None:
+        """
+        Append records to the journal, then apply them; caller holds the write lock.
+
+        The journal is written first, so a write that fails leaves memory
+        untouched and the caller sees the error.
+        """
+        if not records:
+            return
+        # One line per write, so a torn append loses the write as a whole;
+        # a karma change is never replayed without its bucket.
+        line = json.dumps(records, separators=(",", ":")) + "\n"
+        size = os.fstat(self._journal.fileno()).st_size
+        try:
+            self._journal.write(line)
+            # Handed to the OS on every write, so the journal survives the
+            # bot crashing; snapshots are fsynced.
+            self._journal.flush()
+        except OSError:
+            self._discard_partial_append(size)
+            raise
+        for record in records:
+            self._apply(record)
+        self._journal_records += len(records)
+
+    def _discard_partial_append(self, size: int) -> None:
+        """Cut a failed append off the journal, so later writes follow a whole line."""
+        try:
+            self._journal.close()
+        except OSError:
+            # The unwritten rest of the line is dropped with the buffer.
+            pass
+        try:
+            os.truncate(self.journal_path, size)
+        finally:
+            self._journal = open(self.journal_path, "a", encoding="utf-8")
+
+    def snapshot(self) -> None:
+        """Write the whole state to the snapshot file and truncate the journal."""
+        with self._write_lock:
+            snapshot = {
+                "karma": [[user_id, *row] for user_id, row in self._karma.items()],
+                "guild_karma": [
+                    [guild_id, user_id, *row]
+                    for guild_id, rows in self._guild_karma.items()
+                    for user_id, row in rows.items()
+                ],
+                "guilds": [list(item) for item in self._guilds.items()],
+                "users": [list(item) for item in self._users.items()],
+                "members": [
+                    [user_id, guild_id, *state]
+                    for guild_id, members in self._members.items()
+                    for user_id, state in members.items()
+                ],
+                "buckets": [
+                    [guild_id, day, user_id, delta]
+                    for guild_id, days in self._buckets.items()
+                    for day, users in days.items()
+                    for user_id, delta in users.items()
+                ],
+                "guild_karma_seeded": self._guild_karma_seeded,
+            }
+            temp_path = f"{self.snapshot_path}.tmp"
+            with open(temp_path, "w", encoding="utf-8") as file:
+                json.dump(snapshot, file, separators=(",", ":"))
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temp_path, self.snapshot_path)
+            # A crash before the truncate only replays records the snapshot
+            # already holds.
+            self._journal.close()
+            self._journal = open(self.journal_path, "w", encoding="utf-8")
+            self._journal_records = 0
+
+    def flush(self) -> int:
+        """
+        Write all buffered registry rows, and snapshot once the journal is long.
+
+        Returns:
+            int: The number of registry rows written.
+        """
+        written = super().flush()
+        if self._journal_records >= self.snapshot_every:
+            self.snapshot()
+        return written
+
+    def close(self) -> None:
+        """Snapshot the state, so the next start replays nothing, and close the journal."""
+        with self._write_lock:
+            self.snapshot()
+            self._journal.close()
+
+    # Karma
+
+    def _karma_rows(self, guild_id: int | None, create: bool = False) -> dict:
+        """Return the karma rows for a guild, or the global rows for None."""
+        if guild_id is None:
+            return self._karma
+        if create:
+            return self._guild_karma.setdefault(guild_id, {})
+        return self._guild_karma.get(guild_id, {})
+
+    def _scope_guild(self, guild_id: int | None) -> int | None:
+        """Return the guild a user's karma is kept under, or None for global karma."""
+        return guild_id if self.guild_scoped else None
+
+    def migrate_to_guild_scope(self) -> int:
+        """
+        Seed per-guild karma from global karma.
+
+        Every guild a user is a current member of starts with that user's
+        global karma.  The seed is recorded in the journal, so it only ever
+        runs once.
+
+        Returns:
+            int: The number of per-guild karma rows created.
+        """
+        with self._write_lock:
+            if self._guild_karma_seeded:
+                return 0
+            records = [
+                [KARMA, guild_id, user_id, *self._karma[user_id]]
+                for guild_id, members in self._members.items()
+                for user_id, (_, is_member) in members.items()
+                if user_id in self._karma and is_member != 0
+            ]
+            self._commit(records + [[GUILD_KARMA_SEEDED]])
+            return len(records)
+
+    def create(self, user_id: int, karma: int = 0, guild_id: int | None = None) -> None:
+        """
+        Add a new user with an initial karma value.
+
+        Args:
+            user_id (int): The Discord user ID to add.
+            karma (int, optional): The initial karma value. Defaults to 0.
+            guild_id (int, optional): The guild, in guild-scoped mode.
+        """
+        guild_id = self._scope_guild(guild_id)
+        with self._write_lock:
+            if user_id not in self._karma_rows(guild_id):
+                self._commit([[KARMA, guild_id, user_id, karma, 0]])
+
+    def get_karma(self, user_id: int, guild_id: int | None = None) -> int | None:
+        """
+        Retrieve the karma value for a specific user.
+
+        Args:
+            user_id (int): The Discord user ID to look up.
+            guild_id (int, optional): The guild, in guild-scoped mode.
+
+        Returns:
+            int or None: The user's karma value, or None if the user does not exist.
+        """
+        row = self._karma_rows(self._scope_guild(guild_id)).get(user_id)
+        return row[0] if row else None
+
+    def update(self, user_id: int, delta: int, guild_id: int | None = None) -> None:
+        """
+        Add a delta to an existing user's karma and stamp last_karma.
+
+        Args:
+            user_id (int): The Discord user ID to update.
+            delta (int): The amount to add (or subtract) from the user's karma.
+            guild_id (int, optional): The guild, in guild-scoped mode.
+        """
+        guild_id = self._scope_guild(guild_id)
+        with self._write_lock:
+            row = self._karma_rows(guild_id).get(user_id)
+            if row is not None:
+                self._commit([[KARMA, guild_id, user_id, row[0] + delta, int(time.time())]])
+
+    def apply_karma(
+        self,
+        user_id: int,
+        delta: int,
+        spam_delay: int = KARMA_SPAM_DELAY,
+        guild_id: int | None = None,
+        giver_id: int | None = None,
+        message_id: int | None = None,
+    ) -> KarmaUpdate:
+        """
+        Atomically create the user if needed, enforce the spam delay, and
+        apply a karma delta.
+
+        Args:
+            user_id (int): The Discord user ID to update.
+            delta (int): The (already capped) amount to add to the user's karma.
+            spam_delay (int): Minimum seconds since the last change. Use 0 to
+                disable the check.
+            guild_id (int, optional): The guild, in guild-scoped mode.
+            giver_id (int, optional): Who gave the karma; karma given by a
+                user counts towards windowed leaderboards.
+            message_id (int, optional): Unused; there is no per-event log.
+
+        Returns:
+            KarmaUpdate: The user's karma after the call, whether the delta
+                was applied (False when rejected by the spam delay), and the
+                stored last_karma timestamp.
+        """
+        return self.apply_karma_batch(
+            [(user_id, delta)], spam_delay, guild_id, giver_id, message_id
+        )[0]
+
+    def apply_karma_batch(
+        self,
+        changes: list[tuple[int, int]],
+        spam_delay: int = KARMA_SPAM_DELAY,
+        guild_id: int | None = None,
+        giver_id: int | None = None,
+        message_id: int | None = None,
+    ) -> list[KarmaUpdate]:
+        """
+        Apply several karma changes from one message as one journal write.
+
+        The new karma rows and day buckets share one journal line, so after
+        a crash the batch is replayed whole or not at all.
+
+        Args:
+            changes (list): (user_id, delta) pairs; deltas are already capped.
+            spam_delay (int): Minimum seconds since each user's last change.
+                Use 0 to disable the check.
+            guild_id (int, optional): The guild, in guild-scoped mode.
+            giver_id (int, optional): Who gave the karma; karma given by a
+                user counts towards windowed leaderboards.
+            message_id (int, optional): Unused; there is no per-event log.
+
+        Returns:
+            list[KarmaUpdate]: One result per change, in order.
+        """
+        now = int(time.time())
+        scope = self._scope_guild(guild_id)
+        bucket_guild = guild_id or 0
+        day = now // SECONDS_PER_DAY
+        results = []
+        records = []
+        with self._write_lock:
+            rows = self._karma_rows(scope)
+            # Changes earlier in the batch are only applied by _commit, so
+            # track them here for users mentioned twice.
+            karma_seen = {}
+            buckets_seen = {}
+            for user_id, delta in changes:
+                row = karma_seen.get(user_id) or rows.get(user_id)
+                if row is not None and now - row[1] < spam_delay:
+                    results.append(KarmaUpdate(row[0], False, row[1]))
+                    continue
+
+                karma = (row[0] if row else 0) + delta
+                karma_seen[user_id] = (karma, now)
+                records.append([KARMA, scope, user_id, karma, now])
+                if giver_id is not None:
+                    total = buckets_seen.get(user_id)
+                    if total is None:
+                        total = (
+                            self._buckets.get(bucket_guild, {}).get(day, {}).get(user_id, 0)
+                        )
+                    buckets_seen[user_id] = total + delta
+                    records.append([BUCKET, bucket_guild, day, user_id, total + delta])
+                results.append(KarmaUpdate(karma, True, now))
+            if records:
+                self._commit(records)
+        return results
+
+    def delete(self, user_id: int, guild_id: int | None = None) -> None:
+        """
+        Remove a user's karma.
+
+        Args:
+            user_id (int): The Discord user ID to delete.
+            guild_id (int, optional): The guild, in guild-scoped mode.
+        """
+        guild_id = self._scope_guild(guild_id)
+        with self._write_lock:
+            if user_id in self._karma_rows(guild_id):
+                self._commit([[KARMA_DELETED, guild_id, user_id]])
+
+    def can_update_karma(self, user_id: int, guild_id: int | None = None) -> bool:
+        """
+        Determine whether enough time has passed since the user's last karma update.
+
+        Args:
+            user_id (int): The Discord user ID to check.
+            guild_id (int, optional): The guild, in guild-scoped mode.
+
+        Returns:
+            bool: True if the user can receive a karma update, False otherwise.
+        """
+        row = self._karma_rows(self._scope_guild(guild_id)).get(user_id)
+        return not (row and time.time() - row[1] < KARMA_SPAM_DELAY)
+
+    def recent_karma_changes(self, since: int) -> list[tuple]:
+        """
+        Retrieve users whose karma changed at or after a given time.
+
+        Args:
+            since (int): Unix timestamp to look back to.
+
+        Returns:
+            list[tuple]: (karma_key, last_karma) pairs, where karma_key is as
+                returned by `karma_key`.
+        """
+        with self._write_lock:
+            rows = [
+                (user_id, row[1]) for user_id, row in self._karma.items() if row[1] >= since
+            ]
+            if self.guild_scoped:
+                rows.extend(
+                    ((guild_id, user_id), row[1])
+                    for guild_id, guild_rows in self._guild_karma.items()
+                    for user_id, row in guild_rows.items()
+                    if row[1] >= since
+                )
+            return rows
+
+    def all_user_ids_and_karma(
+        self, chunk_size: int = EXPORT_CHUNK_SIZE
+    ) -> Iterator[tuple[int, int]]:
+        """
+        Stream all users and their karma values.
+
+        Args:
+            chunk_size (int): Unused; the rows are already in memory.
+
+        Yields:
+            tuple[int, int]: A user ID and that user's karma.
+        """
+        with self._write_lock:
+            if not self.guild_scoped:
+                rows = [(user_id, row[0]) for user_id, row in self._karma.items()]
+            else:
+                totals: dict[int, int] = {}
+                for guild_rows in self._guild_karma.values():
+                    for user_id, row in guild_rows.items():
+                        totals[user_id] = totals.get(user_id, 0) + row[0]
+                rows = list(totals.items())
+        yield from rows
+
+    def _karma_user_ids(self) -> set[int]:
+        """Return every karma-tracked user ID in the current scope."""
+        if not self.guild_scoped:
+            return set(self._karma)
+        return {
+            user_id for guild_rows in self._guild_karma.values() for user_id in guild_rows
+        }
+
+    def all_user_ids(self, chunk_size: int = EXPORT_CHUNK_SIZE) -> Iterator[int]:
+        """
+        Stream all karma-tracked user IDs.
+
+        Args:
+            chunk_size (int): Unused; the rows are already in memory.
+
+        Yields:
+            int: A Discord user ID.
+        """
+        with self._write_lock:
+            user_ids = self._karma_user_ids()
+        yield from user_ids
+
+    def karma_user_count(self) -> int:
+        """Return the number of karma-tracked users."""
+        with self._write_lock:
+            return len(self._karma_user_ids())
+
+    # Registry
+
+    def upsert_guild(self, guild_id: int, guild_name: str) -> None:
+        """Insert or update a guild in the local registry."""
+        with self._write_lock:
+            self._commit([[GUILD, guild_id, guild_name]])
+        self.registry_cache.forget_guild(guild_id)
+
+    def upsert_user(self, user_id: int, user_name: str) -> None:
+        """Insert or update a user in the local registry."""
+        with self._write_lock:
+            self._commit([[USER, user_id, user_name]])
+        self.registry_cache.forget_user(user_id)
+
+    def upsert_user_nickname(
+        self,
+        user_id: int,
+        guild_id: int,
+        nickname: str | None,
+        is_member: int | None,
+    ) -> None:
+        """Insert or update a user's guild-specific name and membership state."""
+        with self._write_lock:
+            self._commit([[NICKNAME, user_id, guild_id, nickname, is_member]])
+        self.registry_cache.forget_member(user_id, guild_id)
+
+    def write_registry_batch(self, guilds: list, users: list, nicknames: list) -> None:
+        """
+        Upsert many registry rows in one journal append.
+
+        Args:
+            guilds (list): (guild_id, guild_name) tuples.
+            users (list): (user_id, user_name) tuples.
+            nicknames (list): (user_id, guild_id, nickname, is_member) tuples.
+        """
+        records = [[GUILD, *row] for row in guilds]
+        records.extend([USER, *row] for row in users)
+        records.extend([NICKNAME, *row] for row in nicknames)
+        with self._write_lock:
+            self._commit(records)
+
+    def _write_member_sync(
+        self, guild_id: int, guild_name: str, members: list[tuple[int, str, str | None]]
+    ) -> tuple[MemberSync, list[int]]:
+        """Diff and write a guild member sync; returns the counts and departed IDs."""
+        current = {
+            user_id: (user_name, nickname) for user_id, user_name, nickname in members
+        }
+        records = [[GUILD, guild_id, guild_name]]
+        joined = changed = 0
+        with self._write_lock:
+            stored = self._members.get(guild_id, {})
+            for user_id, (user_name, nickname) in current.items():
+                old = stored.get(user_id)
+                if old is None or old[1] != 1:
+                    joined += 1
+                elif self._users.get(user_id) != user_name or old[0] != nickname:
+                    changed += 1
+                else:
+                    continue
+                records.append([USER, user_id, user_name])
+                records.append([NICKNAME, user_id, guild_id, nickname, 1])
+            departed = [
+                user_id
+                for user_id, (_, is_member) in stored.items()
+                if is_member != 0 and user_id not in current
+            ]
+            records.extend([NICKNAME, user_id, guild_id, None, 0] for user_id in departed)
+            self._commit(records)
+        return MemberSync(joined, len(departed), changed), departed
+
+    def prune_karma_buckets(self, before_day: int) -> int:
+        """
+        Delete daily karma buckets that no leaderboard window reaches.
+
+        Args:
+            before_day (int): Days since the epoch; older buckets are deleted.
+
+        Returns:
+            int: The number of buckets deleted.
+        """
+        with self._write_lock:
+            count = sum(
+                len(users)
+                for days in self._buckets.values()
+                for day, users in days.items()
+                if day < before_day
+            )
+            if count:
+                self._commit([[BUCKETS_PRUNED, before_day]])
+            return count
+
+    # Export and import
+
+    def export_rows(
+        self, table: str, chunk_size: int = EXPORT_CHUNK_SIZE
+    ) -> Iterator[tuple]:
+        """
+        Stream every row of an exportable table.
+
+        Args:
+            table (str): One of EXPORT_TABLES.
+            chunk_size (int): Unused; the rows are already in memory.
+
+        Yields:
+            tuple: The row's values, in EXPORT_TABLES column order.
+        """
+        with self._write_lock:
+            if table == "guilds":
+                rows = list(self._guilds.items())
+            elif table == "users":
+                rows = list(self._users.items())
+            elif table == "user_nicknames":
+                rows = [
+                    (user_id, guild_id, *state)
+                    for guild_id, members in self._members.items()
+                    for user_id, state in members.items()
+                ]
+            elif table == "karma":
+                rows = [(user_id, *row) for user_id, row in self._karma.items()]
+            elif table == "guild_karma":
+                rows = [
+                    (guild_id, user_id, *row)
+                    for guild_id, guild_rows in self._guild_karma.items()
+                    for user_id, row in guild_rows.items()
+                ]
+            else:
+                raise KeyError(table)
+        yield from rows
+
+    def import_rows(
+        self, table: str, rows: Iterable[tuple], chunk_size: int = EXPORT_CHUNK_SIZE
+    ) -> int:
+        """
+        Upsert a stream of rows into an exportable table.
+
+        Rows are consumed chunk_size at a time, each chunk becoming one
+        journal append.
+
+        Args:
+            table (str): One of EXPORT_TABLES.
+            rows (Iterable[tuple]): Values in EXPORT_TABLES column order.
+            chunk_size (int): Rows written per journal append.
+
+        Returns:
+            int: The number of rows imported.
+        """
+        prefixes = {
+            "guilds": [GUILD],
+            "users": [USER],
+            "user_nicknames": [NICKNAME],
+            "karma": [KARMA, None],
+            "guild_karma": [KARMA],
+        }
+        prefix = prefixes[table]
+        imported = 0
+        rows = iter(rows)
+        while chunk := list(islice(rows, chunk_size)):
+            with self._write_lock:
+                self._commit([[*prefix, *row] for row in chunk])
+            imported += len(chunk)
+        return imported
+
+    # Ranked queries
+
+    def _entries(self, guild_id: int, totals, limit: int, descending: bool) -> list:
+        """Rank (user_id, karma) pairs of a guild's current members into entries."""
+        members = self._members.get(guild_id, {})
+        sign = -1 if descending else 1
+        current = (
+            (user_id, karma)
+            for user_id, karma in totals
+            if members.get(user_id, (None, None))[1] == 1
+        )
+        ranked = heapq.nsmallest(
+            limit, current, key=lambda pair: (sign * pair[1], pair[0])
+        )
+        return [
+            KarmaEntry((user_id, karma, self._users.get(user_id), members[user_id][0]))
+            for user_id, karma in ranked
+        ]
+
+    def _get_ranked_karma_entries(
+        self, guild_id: int, limit: int, descending: bool
+    ) -> list[KarmaEntry]:
+        """Return ranked karma rows with locally cached names."""
+        with self._write_lock:
+            rows = self._karma_rows(self._scope_guild(guild_id))
+            totals = ((user_id, row[0]) for user_id, row in rows.items())
+            return self._entries(guild_id, totals, limit, descending)
+
+    def get_windowed_karma_entries(
+        self, guild_id: int, days: int, limit: int, descending: bool = True
+    ) -> list[KarmaEntry]:
+        """
+        Return users ranked by the karma they were given in the last few days.
+
+        Only users given karma in the window are ranked.  Rows have the same
+        shape as get_top_karma_entries, with `karma` holding the window's total.
+
+        Args:
+            guild_id (int): The guild to rank current members of.
+            days (int): Window length in days, including today.
+            limit (int): Maximum rows to return.
+            descending (bool): Most karma first when True, least when False.
+
+        Returns:
+            list[KarmaEntry]: user_id, karma, user_name and nickname rows.
+        """
+        first_day = int(time.time()) // SECONDS_PER_DAY - (days - 1)
+        with self._write_lock:
+            if self.guild_scoped:
+                bucket_guilds = [self._buckets.get(guild_id, {})]
+            else:
+                # Global karma counts what was given in any guild.
+                bucket_guilds = list(self._buckets.values())
+            totals: dict[int, int] = {}
+            for bucket_days in bucket_guilds:
+                for day, users in bucket_days.items():
+                    if day < first_day:
+                        continue
+                    for user_id, delta in users.items():
+                        totals[user_id] = totals.get(user_id, 0) + delta
+            return self._entries(guild_id, totals.items(), limit, descending)
+
+    def member_karma_rows(self) -> list[tuple[int, int, int]]:
+        """
+        Return the karma of every current guild member, for rank indexing.
+
+        Returns:
+            list[tuple[int, int, int]]: (guild_id, user_id, karma) rows.
+        """
+        with self._write_lock:
+            return [
+                (guild_id, user_id, row[0])
+                for guild_id, members in self._members.items()
+                for user_id, (_, is_member) in members.items()
+                if is_member == 1
+                and (row := self._karma_rows(self._scope_guild(guild_id)).get(user_id))
+            ]
+
+    # Backfill
+
+    def all_guild_ids(self) -> list[int]:
+        """Return all guild IDs in the local registry."""
+        with self._write_lock:
+            return sorted(self._guilds)
+
+    def registry_backfill_plan(self, guild_id: int, after_user_id: int = 0) -> list[int]:
+        """
+        Return every karma user missing registry data for a guild.
+
+        A user needs backfilling when they have no registry name, or no
+        membership row for the guild, or an unknown membership state.
+
+        Args:
+            guild_id (int): The guild to plan for.
+            after_user_id (int): Only return user IDs above this, to resume
+                an interrupted run.
+
+        Returns:
+            list[int]: User IDs in ascending order.
+        """
+        with self._write_lock:
+            members = self._members.get(guild_id, {})
+            return sorted(
+                user_id
+                for user_id in self._karma_user_ids()
+                if user_id > after_user_id
+                and (
+                    user_id not in self._users
+                    or members.get(user_id, (None, None))[1] is None
+                )
+            )
+
+    def mark_departed(self, guild_id: int, user_ids: list[int]) -> None:
+        """
+        Record users as not in a guild in one journal append.
+
+        Users without a registry name get a `user-<id>` placeholder; existing
+        names are kept.
+
+        Args:
+            guild_id (int): The guild the users are not in.
+            user_ids (list[int]): The users to mark.
+        """
+        with self._write_lock:
+            records = [
+                [USER, user_id, f"user-{user_id}"]
+                for user_id in user_ids
+                if user_id not in self._users
+            ]
+            records.extend([NICKNAME, user_id, guild_id, None, 0] for user_id in user_ids)
+            self._commit(records)
+        for user_id in user_ids:
+            self.registry_cache.forget_member(user_id, guild_id)
+
+    def needs_registry_backfill(self, user_id: int, guild_id: int) -> bool:
+        """Return True when we are missing user or guild-specific name data."""
+        with self._write_lock:
+            state = self._members.get(guild_id, {}).get(user_id)
+            return user_id not in self._users or state is None or state[1] is None
+
+    def has_user_registry_entry(self, user_id: int) -> bool:
+        """Return True if the user exists in the local registry."""
+        return user_id in self._users
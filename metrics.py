@@ -0,0 +1,381 @@
+"""Lightweight instrumentation for Karmabot.
+
+This module provides the Metrics class, which records call counts, latency
+histograms and row counts for the bot's hot paths, and can render them for
+the `stats` command or as a Prometheus textfile.
+
+Instrumentation is decided once, at import time: when ENABLE_METRICS is
+off, `timed` and `instrument_methods` return the functions they are given
+unchanged, so disabled metrics cost nothing per call.
+"""
+
+import asyncio
+import functools
+import inspect
+import os
+import threading
+import time
+
+from settings import ENABLE_METRICS, METRICS_DUMP_INTERVAL, METRICS_TEXTFILE
+
+# Upper bounds, in seconds, of the latency histogram buckets.
+LATENCY_BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    float("inf"),
+)
+
+
+class Histogram:
+    """Counts observations into fixed latency buckets."""
+
+    __slots__ = ("counts", "count", "total")
+
+    def __init__(self):
+        """Initialize an empty Histogram."""
+        self.counts = [0] * len(LATENCY_BUCKETS)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, seconds: float) -> None:
+        """Record one observation."""
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                self.counts[index] += 1
+                break
+        self.count += 1
+        self.total += seconds
+
+    def quantile(self, q: float) -> float:
+        """Estimate a quantile as the upper bound of the bucket it falls in."""
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return LATENCY_BUCKETS[-1]
+
+
+class Metrics:
+    """
+    Process-wide registry of latency histograms and row counters.
+
+    Timers are keyed by name (e.g. "on_message" or "db.apply_karma").
+    Recording is thread-safe, since database methods run on worker threads.
+    """
+
+    def __init__(self, enabled: bool = ENABLE_METRICS):
+        """
+        Initialize an empty Metrics registry.
+
+        Args:
+            enabled (bool): Whether to instrument anything at all.
+        """
+        self.enabled = enabled
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._timers: dict[str, Histogram] = {}
+        self._rows_read: dict[str, int] = {}
+        self._rows_written: dict[str, int] = {}
+        self._caches: dict[str, object] = {}
+        self._dump_task = None
+
+    def observe(self, name: str, seconds: float) -> None:
+        """Record one call of `name` that took `seconds`."""
+        with self._lock:
+            histogram = self._timers.get(name)
+            if histogram is None:
+                histogram = self._timers[name] = Histogram()
+            histogram.observe(seconds)
+
+    def add_rows(self, name: str, read: int = 0, written: int = 0) -> None:
+        """Add to the rows read and written by `name`."""
+        with self._lock:
+            if read:
+                self._rows_read[name] = self._rows_read.get(name, 0) + read
+            if written:
+                self._rows_written[name] = self._rows_written.get(name, 0) + written
+
+    def track_cache(self, name: str, cache) -> None:
+        """
+        Report a cache's hit and miss counts alongside the timers.
+
+        Args:
+            name (str): The cache's name, e.g. "registry".
+            cache: Any object with `hits` and `misses` counters; a later
+                cache with the same name replaces it.
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self._caches[name] = cache
+
+    def _cache_counts(self) -> dict[str, tuple[int, int]]:
+        """Return (hits, misses) for every tracked cache; caller holds the lock."""
+        return {
+            name: (cache.hits, cache.misses) for name, cache in self._caches.items()
+        }
+
+    def timed(self, name: str | None = None):
+        """
+        Decorate a function or coroutine function to record its latency.
+
+        Args:
+            name (str, optional): The timer name. Defaults to the function name.
+        """
+
+        def decorator(func):
+            if not self.enabled:
+                return func
+            timer_name = name or func.__name__
+
+            if inspect.iscoroutinefunction(func):
+
+                @functools.wraps(func)
+                async def async_wrapper(*args, **kwargs):
+                    started = time.perf_counter()
+                    try:
+                        return await func(*args, **kwargs)
+                    finally:
+                        self.observe(timer_name, time.perf_counter() - started)
+
+                return async_wrapper
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.observe(timer_name, time.perf_counter() - started)
+
+            return wrapper
+
+        return decorator
+
+    def instrument_methods(
+        self,
+        prefix: str,
+        skip: tuple[str, ...] = (),
+        writes: frozenset[str] = frozenset(),
+    ):
+        """
+        Class decorator that times every public method of a database class.
+
+        Rows written are taken from the change in the instance's writer
+        connection `total_changes`, when it has one.  Rows read are the
+        length of any list a read method returns, or the number of items a
+        generator method yields; generator methods are timed until their
+        iteration ends.  Abstract methods are skipped.
+
+        Args:
+            prefix (str): Prepended to each timer name, e.g. "db".
+            skip (tuple[str, ...]): Method names to leave alone, such as
+                `close`, after which the writer can no longer be inspected.
+            writes (frozenset[str]): Write methods, whose results are never
+                counted as rows read.
+        """
+
+        def decorator(cls):
+            if not self.enabled:
+                return cls
+            for attr, func in list(vars(cls).items()):
+                if attr.startswith("_") or attr in skip:
+                    continue
+                if not inspect.isfunction(func):
+                    continue
+                if getattr(func, "__isabstractmethod__", False):
+                    continue
+                name = f"{prefix}.{attr}"
+                if inspect.isgeneratorfunction(func):
+                    wrapper = self._instrument_generator(name, func)
+                else:
+                    wrapper = self._instrument_method(name, func, attr not in writes)
+                setattr(cls, attr, wrapper)
+            return cls
+
+        return decorator
+
+    def _instrument_method(self, name: str, func, counts_reads: bool):
+        """Wrap one database method with timing and row counting."""
+
+        @functools.wraps(func)
+        def wrapper(instance, *args, **kwargs):
+            # Databases that forward their writes elsewhere, or that do not
+            # use SQLite at all, have no writer connection.
+            writer = getattr(instance, "_writer", None)
+            changes = writer.total_changes if writer is not None else 0
+            started = time.perf_counter()
+            try:
+                result = func(instance, *args, **kwargs)
+            finally:
+                self.observe(name, time.perf_counter() - started)
+            read = len(result) if counts_reads and isinstance(result, list) else 0
+            written = writer.total_changes - changes if writer is not None else 0
+            self.add_rows(name, read, written)
+            return result
+
+        return wrapper
+
+    def _instrument_generator(self, name: str, func):
+        """Wrap one streaming database method, timing its whole iteration."""
+
+        @functools.wraps(func)
+        def wrapper(instance, *args, **kwargs):
+            read = 0
+            started = time.perf_counter()
+            try:
+                for item in func(instance, *args, **kwargs):
+                    read += 1
+                    yield item
+            finally:
+                # Also reached when the caller closes the iterator early.
+                self.observe(name, time.perf_counter() - started)
+                self.add_rows(name, read)
+
+        return wrapper
+
+    def summary(self, limit: int = 15) -> str:
+        """
+        Render the busiest timers as a fixed-width table for chat.
+
+        Args:
+            limit (int): Maximum number of timers to list.
+
+        Returns:
+            str: One line per timer: calls, mean, p50, p99, rows read/written.
+        """
+        with self._lock:
+            timers = sorted(
+                self._timers.items(), key=lambda item: item[1].total, reverse=True
+            )[:limit]
+            rows_read = dict(self._rows_read)
+            rows_written = dict(self._rows_written)
+            caches = self._cache_counts()
+
+        uptime = int(time.time() - self.started)
+        lines = [
+            f"uptime {uptime}s",
+            f"{'name':<34} {'calls':>7} {'mean':>8} {'p50':>8} {'p99':>8}"
+            f" {'read':>7} {'written':>7}",
+        ]
+        for name, histogram in timers:
+            mean = histogram.total / histogram.count * 1e3
+            lines.append(
+                f"{name:<34} {histogram.count:>7} {mean:>6.2f}ms"
+                f" {histogram.quantile(0.5) * 1e3:>6.2f}ms"
+                f" {histogram.quantile(0.99) * 1e3:>6.2f}ms"
+                f" {rows_read.get(name, 0):>7} {rows_written.get(name, 0):>7}"
+            )
+        for name, (hits, misses) in sorted(caches.items()):
+            total = hits + misses
+            rate = hits / total if total else 0.0
+            lines.append(
+                f"{name + ' cache':<34} {hits:>7} hits {misses:>7} misses"
+                f" {rate:>7.1%} hit rate"
+            )
+        return "\n".join(lines)
+
+    def render_prometheus(self) -> str:
+        """Render every metric in the Prometheus text exposition format."""
+        with self._lock:
+            timers = {
+                name: (list(h.counts), h.count, h.total)
+                for name, h in self._timers.items()
+            }
+            rows_read = dict(self._rows_read)
+            rows_written = dict(self._rows_written)
+            caches = self._cache_counts()
+
+        lines = [
+            "# HELP karmabot_call_duration_seconds Latency of instrumented calls.",
+            "# TYPE karmabot_call_duration_seconds histogram",
+        ]
+        for name, (counts, count, total) in sorted(timers.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(LATENCY_BUCKETS, counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(
+                    f'karmabot_call_duration_seconds_bucket{{name="{name}",le="{le}"}}'
+                    f" {cumulative}"
+                )
+            lines.append(f'karmabot_call_duration_seconds_sum{{name="{name}"}} {total}')
+            lines.append(f'karmabot_call_duration_seconds_count{{name="{name}"}} {count}')
+
+        for metric, values, help_text in (
+            ("karmabot_rows_read_total", rows_read, "Rows returned by database calls."),
+            (
+                "karmabot_rows_written_total",
+                rows_written,
+                "Rows changed by database calls.",
+            ),
+        ):
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} counter")
+            for name, value in sorted(values.items()):
+                lines.append(f'{metric}{{name="{name}"}} {value}')
+
+        for metric, index, help_text in (
+            ("karmabot_cache_hits_total", 0, "Lookups answered by an in-memory cache."),
+            ("karmabot_cache_misses_total", 1, "Lookups an in-memory cache missed."),
+        ):
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} counter")
+            for name, counts in sorted(caches.items()):
+                lines.append(f'{metric}{{cache="{name}"}} {counts[index]}')
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path: str) -> None:
+        """Atomically replace `path` with the current metrics."""
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as file:
+            file.write(self.render_prometheus())
+        os.replace(temp_path, path)
+
+    def start_textfile_writer(
+        self, path: str | None = METRICS_TEXTFILE, interval: float = METRICS_DUMP_INTERVAL
+    ) -> None:
+        """
+        Start the background task that periodically writes the textfile.
+
+        Does nothing when metrics are disabled, no path is configured, or the
+        task is already running.
+
+        Args:
+            path (str, optional): Where to write the metrics.
+            interval (float): Seconds between writes.
+        """
+        if not self.enabled or not path:
+            return
+        if self._dump_task is not None and not self._dump_task.done():
+            return
+        self._dump_task = asyncio.create_task(self._write_periodically(path, interval))
+
+    async def _write_periodically(self, path: str, interval: float) -> None:
+        """Write the textfile forever, every `interval` seconds."""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                self.write_textfile(path)
+            except OSError as exc:
+                print(f"Writing metrics to {path} failed: {exc}")
+
+
+metrics = Metrics()
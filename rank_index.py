@@ -0,0 +1,234 @@
+"""In-memory karma rankings for Karmabot.
+
+This module provides the RankIndex class, which keeps an order-statistic
+index of every guild's members by karma so that "what rank am I?" and
+"who is around me?" are answered in logarithmic time without touching the
+database.
+"""
+
+import random
+
+# Enough levels for billions of entries at p = 1/2.
+MAX_LEVELS = 32
+
+
+class _Node:
+    """A skiplist node: a key plus per-level forward links and link widths."""
+
+    __slots__ = ("key", "next", "width")
+
+    def __init__(self, key, levels: int):
+        self.key = key
+        self.next = [None] * levels
+        self.width = [1] * levels
+
+
+class IndexableSkiplist:
+    """
+    A sorted collection with O(log n) insert, remove, rank and index lookups.
+
+    Each link records how many bottom-level steps it skips, which lets a
+    search count the keys it passes on the way down.  Keys must be unique
+    and mutually comparable.
+    """
+
+    def __init__(self):
+        """Initialize an empty skiplist."""
+        self.size = 0
+        self._head = _Node(None, MAX_LEVELS)
+
+    def __len__(self) -> int:
+        """Return the number of keys stored."""
+        return self.size
+
+    def _path(self, key) -> list[_Node]:
+        """Return, for every level, the last node whose key is below `key`."""
+        chain = [None] * MAX_LEVELS
+        node = self._head
+        for level in reversed(range(MAX_LEVELS)):
+            while node.next[level] is not None and node.next[level].key < key:
+                node = node.next[level]
+            chain[level] = node
+        return chain
+
+    def insert(self, key) -> None:
+        """Add a key."""
+        chain = [None] * MAX_LEVELS
+        steps_at_level = [0] * MAX_LEVELS
+        node = self._head
+        for level in reversed(range(MAX_LEVELS)):
+            while node.next[level] is not None and node.next[level].key < key:
+                steps_at_level[level] += node.width[level]
+                node = node.next[level]
+            chain[level] = node
+
+        levels = 1
+        while levels < MAX_LEVELS and random.getrandbits(1):
+            levels += 1
+
+        new_node = _Node(key, levels)
+        steps = 0
+        for level in range(levels):
+            prev = chain[level]
+            new_node.next[level] = prev.next[level]
+            prev.next[level] = new_node
+            new_node.width[level] = prev.width[level] - steps
+            prev.width[level] = steps + 1
+            steps += steps_at_level[level]
+        for level in range(levels, MAX_LEVELS):
+            chain[level].width[level] += 1
+        self.size += 1
+
+    def remove(self, key) -> None:
+        """Remove a key, raising KeyError if it is not present."""
+        chain = self._path(key)
+        target = chain[0].next[0]
+        if target is None or target.key != key:
+            raise KeyError(key)
+
+        for level in range(len(target.next)):
+            prev = chain[level]
+            prev.width[level] += target.width[level] - 1
+            prev.next[level] = target.next[level]
+        for level in range(len(target.next), MAX_LEVELS):
+            chain[level].width[level] -= 1
+        self.size -= 1
+
+    def rank(self, key) -> int:
+        """Return the number of keys smaller than `key`."""
+        position = 0
+        node = self._head
+        for level in reversed(range(MAX_LEVELS)):
+            while node.next[level] is not None and node.next[level].key < key:
+                position += node.width[level]
+                node = node.next[level]
+        return position
+
+    def __getitem__(self, index: int):
+        """Return the key at a zero-based position."""
+        if not 0 <= index < self.size:
+            raise IndexError(index)
+        remaining = index + 1
+        node = self._head
+        for level in reversed(range(MAX_LEVELS)):
+            while node.next[level] is not None and node.width[level] <= remaining:
+                remaining -= node.width[level]
+                node = node.next[level]
+        return node.key
+
+
+class RankIndex:
+    """
+    Per-guild karma rankings of each guild's current members.
+
+    Every guild gets an IndexableSkiplist of (-karma, user_id) keys, matching
+    the leaderboard's ordering, plus a map of each member's karma.  With
+    global karma, a user's change is applied to every guild they are in.
+    """
+
+    def __init__(self, guild_scoped: bool = False):
+        """
+        Initialize an empty RankIndex.
+
+        Args:
+            guild_scoped (bool): Whether karma is tracked per guild.
+        """
+        self.guild_scoped = guild_scoped
+        self._rankings: dict[int, IndexableSkiplist] = {}
+        self._karma: dict[int, dict[int, int]] = {}
+        self._user_guilds: dict[int, set[int]] = {}
+
+    def load(self, rows) -> None:
+        """
+        Replace the index with freshly loaded data.
+
+        Args:
+            rows: An iterable of (guild_id, user_id, karma) for current members.
+        """
+        self._rankings = {}
+        self._karma = {}
+        self._user_guilds = {}
+        for guild_id, user_id, karma in rows:
+            self.add_member(guild_id, user_id, karma)
+
+    def add_member(self, guild_id: int, user_id: int, karma: int) -> None:
+        """Add (or move) a guild member with the given karma."""
+        members = self._karma.setdefault(guild_id, {})
+        ranking = self._rankings.setdefault(guild_id, IndexableSkiplist())
+        old = members.get(user_id)
+        if old == karma:
+            return
+        if old is not None:
+            ranking.remove((-old, user_id))
+        ranking.insert((-karma, user_id))
+        members[user_id] = karma
+        self._user_guilds.setdefault(user_id, set()).add(guild_id)
+
+    def remove_member(self, guild_id: int, user_id: int) -> None:
+        """Drop a user who left a guild."""
+        karma = self._karma.get(guild_id, {}).pop(user_id, None)
+        if karma is None:
+            return
+        self._rankings[guild_id].remove((-karma, user_id))
+        guilds = self._user_guilds.get(user_id)
+        if guilds is not None:
+            guilds.discard(guild_id)
+            if not guilds:
+                del self._user_guilds[user_id]
+
+    def karma_changed(
+        self, user_id: int, karma: int, guild_id: int | None = None
+    ) -> None:
+        """
+        Apply a karma change made in a guild.
+
+        Args:
+            user_id (int): The user whose karma changed.
+            karma (int): The user's new karma.
+            guild_id (int, optional): The guild the change was made in. With
+                global karma, every other guild the user is in is updated
+                too; pass None for a change made in a guild not indexed here.
+        """
+        guild_ids = {guild_id} if guild_id is not None else set()
+        if not self.guild_scoped:
+            guild_ids |= self._user_guilds.get(user_id, set())
+        for member_guild_id in guild_ids:
+            self.add_member(member_guild_id, user_id, karma)
+
+    def karma_of(self, guild_id: int, user_id: int) -> int | None:
+        """Return a member's indexed karma, or None if they are not ranked."""
+        return self._karma.get(guild_id, {}).get(user_id)
+
+    def rank(self, guild_id: int, user_id: int) -> tuple[int, int] | None:
+        """
+        Return a member's one-based rank and the number of ranked members.
+
+        Returns:
+            tuple or None: (rank, total), or None if the user is not ranked.
+        """
+        karma = self.karma_of(guild_id, user_id)
+        if karma is None:
+            return None
+        ranking = self._rankings[guild_id]
+        return ranking.rank((-karma, user_id)) + 1, len(ranking)
+
+    def around(
+        self, guild_id: int, user_id: int, radius: int = 2
+    ) -> list[tuple[int, int, int]]:
+        """
+        Return the members ranked near a user, including the user.
+
+        Returns:
+            list[tuple[int, int, int]]: (rank, user_id, karma) entries, best first.
+        """
+        position = self.rank(guild_id, user_id)
+        if position is None:
+            return []
+        ranking = self._rankings[guild_id]
+        start = max(0, position[0] - 1 - radius)
+        end = min(len(ranking), position[0] + radius)
+        entries = []
+        for index in range(start, end):
+            negative_karma, member_id = ranking[index]
+            entries.append((index + 1, member_id, -negative_karma))
+        return entries
@@ -0,0 +1,77 @@
+"""Adaptive request pacing for Karmabot's maintenance jobs.
+
+This module provides the AdaptiveRateLimiter class, which spaces out
+Discord requests shared by many concurrent tasks and adjusts its pace to
+the rate limits Discord actually reports.
+"""
+
+import asyncio
+import time
+
+
+class AdaptiveRateLimiter:
+    """
+    Paces requests from any number of tasks to one shared rate.
+
+    The limiter follows additive-increase / multiplicative-decrease: every
+    successful request shortens the interval between requests a little, and
+    every rate limit doubles it and pauses all callers for the Retry-After
+    period Discord asked for.
+    """
+
+    def __init__(
+        self,
+        interval: float,
+        min_interval: float = 0.05,
+        max_interval: float = 60.0,
+        speedup: float = 0.02,
+    ):
+        """
+        Initialize an AdaptiveRateLimiter.
+
+        Args:
+            interval (float): Starting seconds between requests.
+            min_interval (float): The shortest interval the limiter speeds up to.
+            max_interval (float): The longest interval the limiter backs off to.
+            speedup (float): Seconds taken off the interval per success.
+        """
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min(max(interval, min_interval), max_interval)
+        self.speedup = speedup
+        self.rate_limited = 0
+        self._next_slot = 0.0
+        self._paused_until = 0.0
+
+    async def acquire(self) -> None:
+        """Wait for this caller's turn to make a request."""
+        now = time.monotonic()
+        slot = max(now, self._next_slot, self._paused_until)
+        self._next_slot = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    def succeeded(self) -> None:
+        """Report a request that went through; speeds the limiter up slightly."""
+        self.interval = max(self.min_interval, self.interval - self.speedup)
+
+    def limited(self, retry_after: float | None) -> None:
+        """
+        Report a rate-limited request.
+
+        Args:
+            retry_after (float, optional): Seconds Discord asked us to wait,
+                from the Retry-After header. When None, the new interval is
+                used as the pause.
+        """
+        self.rate_limited += 1
+        self.interval = min(self.max_interval, self.interval * 2)
+        pause = retry_after if retry_after is not None else self.interval
+        self._paused_until = max(self._paused_until, time.monotonic() + pause)
+        # Requests already queued behind the pause keep their spacing.
+        self._next_slot = max(self._next_slot, self._paused_until)
+
+    @property
+    def rate(self) -> float:
+        """Current requests per second."""
+        return 1.0 / self.interval
@@ -0,0 +1,100 @@
+"""Write-behind buffering for Karmabot's user/guild registry.
+
+This module provides the RegistryBuffer class, which coalesces registry
+upserts in memory so they can be written in a single batched transaction
+instead of one transaction per message.
+"""
+
+import threading
+
+from settings import REGISTRY_MAX_BATCH
+
+
+class RegistryBuffer:
+    """
+    Coalesces pending guild, user, and nickname upserts in memory.
+
+    Only the latest value per key is kept, so a user who posts a hundred
+    times between flushes costs one row in the next batch.
+    """
+
+    def __init__(self, max_batch: int = REGISTRY_MAX_BATCH):
+        """
+        Initialize an empty RegistryBuffer.
+
+        Args:
+            max_batch (int): Number of pending rows at which the buffer
+                reports itself as full and should be flushed early.
+        """
+        self.max_batch = max_batch
+        self._lock = threading.Lock()
+        self._guilds: dict[int, str] = {}
+        self._users: dict[int, str] = {}
+        self._nicknames: dict[tuple[int, int], tuple[str | None, int | None]] = {}
+
+    def __len__(self) -> int:
+        """Return the number of pending rows across all registry tables."""
+        with self._lock:
+            return len(self._guilds) + len(self._users) + len(self._nicknames)
+
+    def is_full(self) -> bool:
+        """Return True once the buffer has reached its batch size."""
+        return len(self) >= self.max_batch
+
+    def add_guild(self, guild_id: int, guild_name: str) -> None:
+        """Queue a guild upsert."""
+        with self._lock:
+            self._guilds[guild_id] = guild_name
+
+    def add_user(self, user_id: int, user_name: str) -> None:
+        """Queue a user upsert."""
+        with self._lock:
+            self._users[user_id] = user_name
+
+    def add_nickname(
+        self,
+        user_id: int,
+        guild_id: int,
+        nickname: str | None,
+        is_member: int | None,
+    ) -> None:
+        """Queue a guild-specific nickname and membership upsert."""
+        with self._lock:
+            self._nicknames[(user_id, guild_id)] = (nickname, is_member)
+
+    def drain(self) -> tuple[list, list, list]:
+        """
+        Remove and return every pending row.
+
+        Returns:
+            tuple: Three lists of parameter tuples, ready for executemany:
+                - (guild_id, guild_name)
+                - (user_id, user_name)
+                - (user_id, guild_id, nickname, is_member)
+        """
+        with self._lock:
+            guilds, self._guilds = self._guilds, {}
+            users, self._users = self._users, {}
+            nicknames, self._nicknames = self._nicknames, {}
+        return (
+            list(guilds.items()),
+            list(users.items()),
+            [
+                (user_id, guild_id, nickname, is_member)
+                for (user_id, guild_id), (nickname, is_member) in nicknames.items()
+            ],
+        )
+
+    def requeue(self, guilds: list, users: list, nicknames: list) -> None:
+        """
+        Put drained rows back after a failed flush.
+
+        Rows queued since the drain are newer, so they take precedence.
+        """
+        with self._lock:
+            for guild_id, guild_name in guilds:
+                self._guilds.setdefault(guild_id, guild_name)
+            for user_id, user_name in users:
+                self._users.setdefault(user_id, user_name)
+            for user_id, guild_id, nickname, is_member in nicknames:
+                self._nicknames.setdefault((user_id, guild_id), (nickname, is_member))
@@ -0,0 +1,105 @@
+"""Change detection for Karmabot's user/guild registry.
+
+This module provides the RegistryCache class, a size-bounded LRU record of
+the registry state we last wrote, so that unchanged guild names, user names
+and nicknames never reach SQLite again.
+"""
+
+import threading
+from collections import OrderedDict
+
+from settings import REGISTRY_CACHE_SIZE
+
+
+class RegistryCache:
+    """
+    Remembers the last-known registry state and reports what has changed.
+
+    Member state is keyed by (user_id, guild_id); a guild_id of None tracks
+    users seen outside of any guild.  Guild names are tracked separately.
+    Each `*_changed` call counts as a hit when nothing changed (the write can
+    be skipped) and as a miss otherwise.
+    """
+
+    def __init__(self, max_size: int = REGISTRY_CACHE_SIZE):
+        """
+        Initialize an empty RegistryCache.
+
+        Args:
+            max_size (int): Maximum number of member and guild entries kept.
+        """
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._members: OrderedDict = OrderedDict()
+        self._guilds: OrderedDict = OrderedDict()
+        # user_id -> guild IDs (None for outside any guild) with member entries.
+        self._user_guilds: dict[int, set] = {}
+
+    def _changed(self, entries: OrderedDict, key, value) -> bool:
+        """Store `value` under `key`, returning True if it differs from the cache."""
+        with self._lock:
+            if entries.get(key) == value:
+                entries.move_to_end(key)
+                self.hits += 1
+                return False
+
+            entries[key] = value
+            entries.move_to_end(key)
+            if entries is self._members:
+                self._user_guilds.setdefault(key[0], set()).add(key[1])
+            if len(entries) > self.max_size:
+                evicted, _ = entries.popitem(last=False)
+                if entries is self._members:
+                    self._unindex_member(evicted)
+            self.misses += 1
+            return True
+
+    def _unindex_member(self, key) -> None:
+        """Drop a removed member entry from the per-user index; caller holds the lock."""
+        user_id, guild_id = key
+        guilds = self._user_guilds.get(user_id)
+        if guilds is not None:
+            guilds.discard(guild_id)
+            if not guilds:
+                del self._user_guilds[user_id]
+
+    def guild_changed(self, guild_id: int, guild_name: str) -> bool:
+        """Return True if the guild's name differs from what was last stored."""
+        return self._changed(self._guilds, guild_id, guild_name)
+
+    def member_changed(
+        self,
+        user_id: int,
+        guild_id: int | None,
+        user_name: str,
+        nickname: str | None = None,
+        is_member: int | None = None,
+    ) -> bool:
+        """Return True if the member's registry state differs from what was last stored."""
+        return self._changed(
+            self._members, (user_id, guild_id), (user_name, nickname, is_member)
+        )
+
+    def forget_guild(self, guild_id: int) -> None:
+        """Drop a guild whose stored state was changed behind the cache's back."""
+        with self._lock:
+            self._guilds.pop(guild_id, None)
+
+    def forget_member(self, user_id: int, guild_id: int | None) -> None:
+        """Drop a member whose stored state was changed behind the cache's back."""
+        with self._lock:
+            if self._members.pop((user_id, guild_id), None) is not None:
+                self._unindex_member((user_id, guild_id))
+
+    def forget_user(self, user_id: int) -> None:
+        """Drop a user's member entries after their name was changed behind the cache's back."""
+        with self._lock:
+            for guild_id in self._user_guilds.pop(user_id, ()):
+                del self._members[(user_id, guild_id)]
+
+    def hit_rate(self) -> float:
+        """Return the fraction of registry writes that were skipped."""
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
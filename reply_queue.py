@@ -0,0 +1,212 @@
+"""Outbound reply batching for Karmabot.
+
+This module provides the ReplyQueue class, which merges the bot's replies to
+a channel into as few messages as possible and paces sends to stay inside
+Discord's per-channel rate limits.
+"""
+
+import asyncio
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+import discord
+
+from metrics import metrics
+from settings import REPLY_COALESCE_WINDOW, REPLY_RATE_LIMIT, REPLY_RATE_PERIOD
+
+# Discord rejects messages longer than this.
+MAX_MESSAGE_LENGTH = 2000
+# Opens and closes a Markdown code block, e.g. around a leaderboard.
+FENCE = "```"
+
+
+def _fence_opener(line: str) -> str:
+    """Return the marker that reopens the code block opened on `line`, keeping its language."""
+    language = line[line.rfind(FENCE) + len(FENCE) :]
+    return FENCE + language if language.isalnum() else FENCE
+
+
+def _split_entry(entry: str, max_length: int) -> list[str]:
+    """
+    Split an overlong entry on line boundaries into pieces of at most `max_length`.
+
+    A code block open where a piece ends is closed there and reopened at the
+    start of the next piece, so every piece renders on its own.  A single
+    overlong line is cut.
+    """
+    pieces = []
+    current = None
+    # The marker of the code block still open at the end of `current`.
+    opener = None
+    closing = len(FENCE) + 1
+    for line in entry.split("\n"):
+        width = max_length
+        if opener is not None or FENCE in line:
+            width -= closing + (len(opener) + 1 if opener is not None else 0)
+        width = max(1, width)
+        for start in range(0, max(len(line), 1), width):
+            segment = line[start : start + width]
+            after = opener
+            if segment.count(FENCE) % 2:
+                after = None if opener is not None else _fence_opener(segment)
+            room = max_length - (closing if after is not None else 0)
+            if current is not None and len(current) + 1 + len(segment) <= room:
+                current = f"{current}\n{segment}"
+            else:
+                if current is not None:
+                    pieces.append(current if opener is None else f"{current}\n{FENCE}")
+                current = segment if opener is None else f"{opener}\n{segment}"
+            opener = after
+    pieces.append(current)
+    return pieces
+
+
+def split_message(entries: list[str], max_length: int = MAX_MESSAGE_LENGTH) -> list[str]:
+    """
+    Pack reply entries into as few messages as possible.
+
+    Entries are joined with newlines.  An entry that is too long on its own
+    is split on line boundaries, closing and reopening any code block it is
+    in the middle of, and a single overlong line is cut.
+
+    Args:
+        entries (list[str]): The replies to send, in order.
+        max_length (int): Maximum length of each message.
+
+    Returns:
+        list[str]: The messages to send.
+    """
+    pieces = []
+    for entry in entries:
+        if len(entry) <= max_length:
+            pieces.append(entry)
+            continue
+        pieces.extend(_split_entry(entry, max_length))
+
+    messages = []
+    current = None
+    for piece in pieces:
+        if current is None:
+            current = piece
+        elif len(current) + 1 + len(piece) <= max_length:
+            current = f"{current}\n{piece}"
+        else:
+            messages.append(current)
+            current = piece
+    if current is not None:
+        messages.append(current)
+    return messages
+
+
+class ReplyQueue:
+    """
+    Per-channel outbound queue that coalesces replies and budgets sends.
+
+    Replies posted to a channel are held for REPLY_COALESCE_WINDOW seconds so
+    that everything produced by one incoming message (and any short burst
+    after it) goes out together.  Sends to each channel are limited to
+    REPLY_RATE_LIMIT messages per REPLY_RATE_PERIOD seconds.
+    """
+
+    def __init__(
+        self,
+        coalesce_window: float = REPLY_COALESCE_WINDOW,
+        rate_limit: int = REPLY_RATE_LIMIT,
+        rate_period: float = REPLY_RATE_PERIOD,
+    ):
+        """
+        Initialize an empty ReplyQueue.
+
+        Args:
+            coalesce_window (float): Seconds to wait for more replies before sending.
+            rate_limit (int): Messages allowed per channel per `rate_period`.
+            rate_period (float): Length of the rate-limit window in seconds.
+        """
+        self.coalesce_window = coalesce_window
+        self.rate_limit = rate_limit
+        self.rate_period = rate_period
+        self._pending: dict[int, list[str]] = {}
+        self._holds: dict[int, int] = defaultdict(int)
+        self._tasks: dict[int, asyncio.Task] = {}
+        self._sent: dict[int, deque] = {}
+
+    def post(self, channel, text: str) -> None:
+        """
+        Queue a reply for a channel.
+
+        Args:
+            channel (discord.abc.Messageable): Where to send the reply.
+            text (str): The reply text.
+        """
+        self._pending.setdefault(channel.id, []).append(text)
+        self._schedule(channel)
+
+    @contextmanager
+    def holding(self, channel):
+        """
+        Hold a channel's replies until the block exits.
+
+        Wrap the handling of one incoming message in this so that all of its
+        replies are merged, however long the handling takes.
+        """
+        self._holds[channel.id] += 1
+        try:
+            yield
+        finally:
+            self._holds[channel.id] -= 1
+            if not self._holds[channel.id]:
+                del self._holds[channel.id]
+                self._schedule(channel)
+
+    def _schedule(self, channel) -> None:
+        """Start the channel's send task if replies are waiting and not held."""
+        if channel.id in self._holds or channel.id in self._tasks:
+            return
+        if not self._pending.get(channel.id):
+            return
+        self._tasks[channel.id] = asyncio.create_task(self._drain(channel))
+
+    async def _drain(self, channel) -> None:
+        """
+        Send a channel's pending replies once the coalesce window has passed.
+
+        A channel that is held again before its replies go out keeps them
+        queued; releasing the hold schedules a new send task.
+        """
+        try:
+            await asyncio.sleep(self.coalesce_window)
+            while self._pending.get(channel.id) and channel.id not in self._holds:
+                entries = self._pending.pop(channel.id)
+                for content in split_message(entries):
+                    await self._wait_for_budget(channel.id)
+                    started = time.perf_counter()
+                    try:
+                        await channel.send(content)
+                    except discord.HTTPException as exc:
+                        print(f"Reply to channel {channel.id} failed: {exc}")
+                    if metrics.enabled:
+                        metrics.observe("reply_send", time.perf_counter() - started)
+        finally:
+            del self._tasks[channel.id]
+
+    async def _wait_for_budget(self, channel_id: int) -> None:
+        """Sleep until the channel has room in its rate-limit window, then claim it."""
+        while True:
+            now = time.monotonic()
+            self._expire_sent(channel_id, now)
+            sent = self._sent.setdefault(channel_id, deque())
+            if len(sent) < self.rate_limit:
+                sent.append(now)
+                return
+            await asyncio.sleep(self.rate_period - (now - sent[0]))
+
+    def _expire_sent(self, channel_id: int, now: float) -> None:
+        """Drop a channel's send times older than the rate-limit window, and the channel if it has none."""
+        sent = self._sent.get(channel_id)
+        if sent is None:
+            return
+        while sent and now - sent[0] >= self.rate_period:
+            sent.popleft()
+        if not sent:
+            del self._sent[channel_id]
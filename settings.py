@@ -15,6 +15,138 @@ SQLITE_DB = "db.sqlite3"
 DISCORD_API_KEY_FILE = "discordapikey.txt"
 
 
+### Database settings ###
+
+# Where karma and the user/guild registry are stored.
+# "sqlite" keeps everything in the SQLITE_DB file.
+# "memory" keeps everything in memory, which makes every read free, and
+# persists it through an append-only journal (MEMORY_DB_JOURNAL) plus
+# periodic snapshots (MEMORY_DB_SNAPSHOT).  All data must fit in memory,
+# karma_log.py and shard_launcher.py need "sqlite", and there is no
+# per-event karma history.
+# Defaults to "sqlite".
+STORAGE_BACKEND = "sqlite"
+
+# Files used by the "memory" storage backend.  The journal is handed to the
+# operating system after every write, so it survives the bot crashing;
+# snapshots are flushed to disk.
+# Defaults to "db.journal" and "db.snapshot".
+MEMORY_DB_JOURNAL = "db.journal"
+MEMORY_DB_SNAPSHOT = "db.snapshot"
+# Number of journal records after which the next flush writes a snapshot
+# and empties the journal, keeping restarts fast.  A snapshot is also
+# written on shutdown.
+# Defaults to 100000.
+MEMORY_SNAPSHOT_EVERY = 100000
+
+# The bot keeps its SQLite connections open for its whole lifetime instead
+# of reconnecting for every query.  These settings tune those connections.
+
+# SQLite journal mode.  "WAL" lets readers run alongside the writer.
+# Defaults to "WAL".
+SQLITE_JOURNAL_MODE = "WAL"
+
+# SQLite synchronous level.  "NORMAL" is safe with WAL and avoids an fsync
+# on every commit; use "FULL" if you need durability across power loss.
+# Defaults to "NORMAL".
+SQLITE_SYNCHRONOUS = "NORMAL"
+
+# Seconds to wait on a locked database before giving up.
+# Defaults to 5 seconds.
+SQLITE_BUSY_TIMEOUT = 5.0  # seconds
+
+# Number of prepared statements cached per connection.
+# Defaults to 256.
+SQLITE_CACHED_STATEMENTS = 256
+
+# Number of extra read-only connections (and reader threads) to keep open.
+# Set to 0 to run reads on the single writer connection.
+# Defaults to 2.
+SQLITE_READER_CONNECTIONS = 2
+
+# The bot maintains the SQLite file itself while it runs: it checkpoints
+# the write-ahead log, refreshes the query planner's statistics, returns
+# free pages to the file system and, optionally, writes backups.  Each task
+# runs on its own cadence, and only once no message has arrived for
+# MAINTENANCE_IDLE_SECONDS; long tasks are split into small steps that stop
+# as soon as messages arrive again.
+# Toggles database maintenance.
+# Defaults to True.
+ENABLE_MAINTENANCE = True
+# Seconds between runs of each task.  None disables a task.
+# Defaults to a checkpoint every 5 minutes, statistics every 6 hours, free
+# page cleanup every day and no backups.
+MAINTENANCE_INTERVALS = {
+    "checkpoint": 300,
+    "optimize": 6 * 60 * 60,
+    "vacuum": 24 * 60 * 60,
+    "backup": None,
+}
+# Seconds without any message before maintenance may run.
+# Defaults to 30 seconds.
+MAINTENANCE_IDLE_SECONDS = 30.0  # seconds
+# Free pages returned to the file system per step.
+# Defaults to 500.
+MAINTENANCE_VACUUM_PAGES = 500
+# Rows sampled per index when refreshing statistics, which keeps it quick
+# on large databases.  0 samples every row.
+# Defaults to 1000.
+MAINTENANCE_ANALYSIS_LIMIT = 1000
+# Directory backups are written to, and how many of the newest to keep.
+# Defaults to "backups" and 7.
+DB_BACKUP_DIR = "backups"
+DB_BACKUP_KEEP = 7
+
+# Guild, user and nickname updates seen in messages are buffered in memory
+# and written in one batch instead of one transaction per message.
+# Seconds between registry flushes.
+# Defaults to 5 seconds.
+REGISTRY_FLUSH_INTERVAL = 5.0  # seconds
+# Number of pending registry rows that triggers an early flush.
+# Defaults to 500.
+REGISTRY_MAX_BATCH = 500
+# Number of users/guilds whose last-written registry state is remembered,
+# so unchanged names and nicknames are not written again.
+# Defaults to 50000.
+REGISTRY_CACHE_SIZE = 50000
+
+# Toggles reconciling every server's full member list with the registry when
+# the bot connects, so joins, leaves and nickname changes that happened while
+# it was offline are picked up before the first leaderboard.  Only the
+# differences are written, in one transaction per server.
+# Defaults to True.
+SYNC_MEMBERS_ON_STARTUP = True
+
+
+### Karma settings ###
+
+# Whether karma is shared across every server the bot is in ("global"), or
+# tracked separately for each server ("guild").  Switching to "guild" seeds
+# each server's karma from the global totals of its current members, once,
+# the first time the bot starts; run backfill_registry.py beforehand so every
+# user is known.
+# Defaults to "global".
+KARMA_SCOPE = "global"
+
+# Number of karma values kept in memory, so repeated karma queries are
+# answered without touching the database.  Every karma change the bot makes
+# is written through to it, so it never serves a stale value.  Set to 0 to
+# disable it.
+# Defaults to 50000.
+KARMA_CACHE_SIZE = 50000
+
+# Every karma change is appended to an event log (who gave what to whom,
+# where and when), in the same transaction as the change itself.
+# Number of rows processed per batch when rebuilding karma totals from the
+# event log with karma_log.py.
+# Defaults to 1000.
+KARMA_REBUILD_CHUNK = 1000
+# Number of rows read or written per batch when streaming data out of or
+# into the database, e.g. with karma_export.py.
+# Defaults to 5000.
+EXPORT_CHUNK_SIZE = 5000
+
+
 ### Buzzkill settings ###
 
 # Buzzkill settings are designed to curtail the more excessive enthusiasm
@@ -60,6 +192,72 @@ ENABLE_LEADERBOARD = True
 # Defaults to 5.
 LEADERBOARD_SIZE = 5
 
+# Leaderboards are cached per server and patched as karma changes.
+# Seconds before a cached leaderboard is refetched regardless.
+# Defaults to 300 seconds.
+LEADERBOARD_CACHE_TTL = 300  # seconds
+
+# Time windows for `top week`, `top month`, `bottom week` and so on, in days
+# (including today).  Karma given in each server is summed per day, and
+# daily totals older than the longest window are deleted.
+# Defaults to 7 days for "week" and 30 days for "month".
+LEADERBOARD_WINDOWS = {"week": 7, "month": 30}
+
+
+### Reply settings ###
+
+# Replies to a channel are merged into as few messages as possible and
+# paced to stay inside Discord's per-channel rate limits.
+
+# Seconds to wait for more replies to the same channel before sending.
+# Defaults to 0.5 seconds.
+REPLY_COALESCE_WINDOW = 0.5  # seconds
+
+# Maximum messages the bot sends to one channel per REPLY_RATE_PERIOD.
+# Defaults to 5 messages per 5 seconds, matching Discord's channel limit.
+REPLY_RATE_LIMIT = 5
+REPLY_RATE_PERIOD = 5.0  # seconds
+
+
+### Sharding settings ###
+
+# Number of Discord shards.  None runs a single unsharded connection, which
+# is right for most bots; Discord requires sharding above 2,500 servers.
+# Defaults to None.
+SHARD_COUNT = None
+
+# Number of processes to spread the shards over when started with
+# shard_launcher.py.  Each process handles messages on its own CPU core;
+# all database writes go through one writer in the launcher process.
+# Defaults to 1.
+SHARD_PROCESSES = 1
+
+# Local address the database writer listens on for shard processes.
+# Defaults to ("127.0.0.1", 47474).
+DB_WRITER_ADDRESS = ("127.0.0.1", 47474)
+
+# Set by shard_launcher.py in each shard process; leave these as None.
+SHARD_IDS = None
+DB_WRITER_AUTHKEY = None
+
+
+### Metrics settings ###
+
+# Toggles built-in instrumentation: call counts and latency histograms for
+# message handling, leaderboards and every database call, rows read and
+# written, and reply-send latency.  Server administrators can see a summary
+# with `@KarmaBot stats`.  When off, nothing is instrumented at all.
+# Defaults to False.
+ENABLE_METRICS = False
+
+# Optional path of a Prometheus textfile (e.g. for node_exporter's textfile
+# collector) to write the metrics to.  None disables the file.
+# Defaults to None.
+METRICS_TEXTFILE = None
+# Seconds between textfile writes.
+# Defaults to 60 seconds.
+METRICS_DUMP_INTERVAL = 60.0  # seconds
+
 
 ## Utility functions for loading settings, do not adjust ###
 
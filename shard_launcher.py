@@ -0,0 +1,97 @@
+"""Run Karmabot as several shard processes sharing one database writer.
+
+The launcher process owns the only SQLite writer (see db_writer.py) and
+starts SHARD_PROCESSES bot processes, each running an AutoShardedClient for
+its share of the SHARD_COUNT shards.  Shard processes read the database
+directly and send every write to the launcher, which also runs database
+maintenance (see maintenance.py).
+
+Usage:
+    python ./shard_launcher.py [--shards N] [--processes P]
+"""
+
+import argparse
+import multiprocessing
+import secrets
+
+import settings
+from db import KarmaDatabase
+from db_writer import DatabaseWriter
+from maintenance import MaintenanceScheduler
+
+
+def run_shard(shard_ids: list[int], shard_count: int, address, authkey: bytes):
+    """Entry point of one shard process."""
+    # karmabot reads these at import time to build its client and database.
+    settings.SHARD_IDS = shard_ids
+    settings.SHARD_COUNT = shard_count
+    settings.DB_WRITER_ADDRESS = address
+    settings.DB_WRITER_AUTHKEY = authkey
+    import karmabot
+
+    karmabot.main()
+
+
+def parse_args() -> argparse.Namespace:
+    """Parse command-line arguments for the launcher."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=settings.SHARD_PROCESSES,
+        help="Number of bot processes to start.",
+    )
+    parser.add_argument(
+        "--shards",
+        type=int,
+        default=settings.SHARD_COUNT,
+        help="Total number of Discord shards. Defaults to one per process.",
+    )
+    return parser.parse_args()
+
+
+def main() -> None:
+    """Start the database writer and the shard processes, and wait for them."""
+    args = parse_args()
+    if settings.STORAGE_BACKEND != "sqlite":
+        # Shard processes read the SQLite file directly.
+        raise SystemExit('shard_launcher.py needs STORAGE_BACKEND = "sqlite".')
+    processes = max(1, args.processes)
+    shards = max(args.shards or processes, processes)
+
+    # Fresh per run, so only this launcher's children can write.
+    authkey = secrets.token_bytes(32)
+    db = KarmaDatabase(reader_count=0)
+    maintenance = MaintenanceScheduler(db) if settings.ENABLE_MAINTENANCE else None
+    writer = DatabaseWriter(
+        settings.DB_WRITER_ADDRESS, authkey, db, maintenance=maintenance
+    )
+    writer.start()
+
+    context = multiprocessing.get_context("spawn")
+    children = []
+    for index in range(processes):
+        shard_ids = list(range(index, shards, processes))
+        children.append(
+            context.Process(
+                target=run_shard,
+                args=(shard_ids, shards, writer.address, authkey),
+                name=f"karmabot-shards-{index}",
+            )
+        )
+    try:
+        for child in children:
+            child.start()
+        print(f"Started {processes} processes for {shards} shards.")
+        for child in children:
+            child.join()
+    except KeyboardInterrupt:
+        # Ctrl-C reaches the children too; let them shut down cleanly.
+        for child in children:
+            child.join()
+    finally:
+        writer.close()
+
+
+if __name__ == "__main__":
+    main()
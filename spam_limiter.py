@@ -0,0 +1,99 @@
+"""In-process karma spam limiting for Karmabot.
+
+This module provides the SpamLimiter class, which answers "can this user's
+karma change yet?" from memory so that spam-rejected adjustments never have
+to touch the database.
+"""
+
+import heapq
+import time
+
+from settings import KARMA_SPAM_DELAY
+
+
+class SpamLimiter:
+    """
+    Tracks when each user's karma cooldown expires.
+
+    A dict maps each key to the time its cooldown ends, so checks are O(1).
+    A min-heap of (expiry, key) pairs lets expired entries be pruned as time
+    passes, which keeps memory bounded by the number of users changed within
+    the last `delay` seconds.
+
+    The database stays authoritative; this is a pre-filter that must be kept
+    in step with it through `record`.
+    """
+
+    def __init__(self, delay: float = KARMA_SPAM_DELAY):
+        """
+        Initialize an empty SpamLimiter.
+
+        Args:
+            delay (float): Cooldown in seconds after each karma change.
+        """
+        self.delay = delay
+        self._expiry: dict = {}
+        self._heap: list = []
+
+    def __len__(self) -> int:
+        """Return the number of keys currently cooling down."""
+        return len(self._expiry)
+
+    def _prune(self, now: float) -> None:
+        """Drop every entry whose cooldown has ended."""
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            expiry, key = heapq.heappop(heap)
+            # Skip stale heap entries left behind by a later `record`.
+            if self._expiry.get(key) == expiry:
+                del self._expiry[key]
+
+    def record(self, key, changed_at: float) -> None:
+        """
+        Note that `key` had its karma changed at `changed_at`.
+
+        Args:
+            key: The user (or guild/user pair) whose karma changed.
+            changed_at (float): Unix timestamp of the change.
+        """
+        expiry = changed_at + self.delay
+        if expiry <= time.time():
+            self._expiry.pop(key, None)
+            return
+        self._expiry[key] = expiry
+        heapq.heappush(self._heap, (expiry, key))
+
+    def try_acquire(self, key, now: float | None = None) -> bool:
+        """
+        Check the cooldown for `key` and, if it has passed, start a new one.
+
+        Reserving on success means a second adjustment racing the first is
+        rejected immediately, before the first reaches the database.
+
+        Args:
+            key: The user (or guild/user pair) about to be changed.
+            now (float, optional): Current Unix timestamp.
+
+        Returns:
+            bool: True if the change may go ahead.
+        """
+        now = time.time() if now is None else now
+        self._prune(now)
+        if key in self._expiry:
+            return False
+        self.record(key, now)
+        return True
+
+    def release(self, key) -> None:
+        """Cancel a reservation whose database write did not happen."""
+        self._expiry.pop(key, None)
+
+    def warm(self, rows) -> None:
+        """
+        Load recent changes, e.g. from the karma table's last_karma column.
+
+        Args:
+            rows: An iterable of (key, last_karma) pairs.
+        """
+        for key, changed_at in rows:
+            self.record(key, changed_at)
@@ -0,0 +1,494 @@
+"""Storage backends for Karmabot.
+
+This module provides StorageBackend, the interface every karma store
+implements, plus the logic all backends share: write-behind buffering of
+the user/guild registry, member sync bookkeeping and spam keys.
+
+Two backends ship with the bot:
+
+- db.KarmaDatabase keeps everything in a SQLite file.
+- memory_db.MemoryKarmaDatabase keeps everything in memory and persists it
+  through an append-only journal plus periodic snapshots.
+
+`open_storage` builds the backend selected by STORAGE_BACKEND.
+"""
+
+import time
+from abc import ABC, abstractmethod
+from typing import Iterable, Iterator, NamedTuple
+
+from metrics import metrics
+from registry_buffer import RegistryBuffer
+from registry_cache import RegistryCache
+from settings import (
+    EXPORT_CHUNK_SIZE,
+    KARMA_SPAM_DELAY,
+    LEADERBOARD_WINDOWS,
+    STORAGE_BACKEND,
+)
+
+SECONDS_PER_DAY = 86400
+
+# Backend methods that write.  Shard processes send these to the database
+# writer, and metrics never counts their results as rows read.
+WRITE_METHODS = frozenset(
+    {
+        "create",
+        "update",
+        "apply_karma",
+        "apply_karma_batch",
+        "delete",
+        "migrate_to_guild_scope",
+        "upsert_guild",
+        "upsert_user",
+        "upsert_user_nickname",
+        "write_registry_batch",
+        "mark_departed",
+        "_write_member_sync",
+        "prune_karma_buckets",
+        "rebuild_karma_totals",
+        "compact_karma_events",
+    }
+)
+
+# Tables that can be exported and imported, as (key columns, value columns),
+# in an order that imports parents before the rows referring to them.
+EXPORT_TABLES = {
+    "guilds": (("guild_id",), ("guild_name",)),
+    "users": (("user_id",), ("user_name",)),
+    "user_nicknames": (("user_id", "guild_id"), ("nickname", "is_member")),
+    "karma": (("user_id",), ("karma", "last_karma")),
+    "guild_karma": (("guild_id", "user_id"), ("karma", "last_karma")),
+}
+
+
+class KarmaUpdate(NamedTuple):
+    """The outcome of an atomic karma adjustment."""
+
+    karma: int | None
+    applied: bool
+    last_karma: int | None = None
+
+
+class MemberSync(NamedTuple):
+    """What a guild member sync changed in the registry."""
+
+    joined: int
+    left: int
+    changed: int
+
+
+class Row(tuple):
+    """
+    A result row readable by position or by column name, like sqlite3.Row.
+
+    Backends that do not use SQLite return these from ranked queries, so
+    callers never need to know which backend produced a row.
+    """
+
+    __slots__ = ()
+    _fields: tuple[str, ...] = ()
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return tuple.__getitem__(self, self._fields.index(key))
+        return tuple.__getitem__(self, key)
+
+    def keys(self) -> list[str]:
+        """Return the column names, so dict(row) works."""
+        return list(self._fields)
+
+
+class KarmaEntry(Row):
+    """A ranked karma row: user_id, karma, user_name and nickname."""
+
+    __slots__ = ()
+    _fields = ("user_id", "karma", "user_name", "nickname")
+
+
+@metrics.instrument_methods("db", skip=("close",), writes=WRITE_METHODS)
+class StorageBackend(ABC):
+    """
+    Interface and shared behaviour of Karmabot's karma stores.
+
+    Karma is either global (keyed by user) or, when guild_scoped is set,
+    kept separately per guild (keyed by guild and user).  Karma methods take
+    an optional guild_id; it is ignored in global mode, and karma given
+    outside a guild always counts globally.
+
+    Registry updates seen in messages are buffered by the record_* methods
+    and written in batches by `flush`; backends only implement the batch
+    write.  Backends set `reader_count` to the number of reads they can
+    serve concurrently (0 runs reads on the writer thread) and provide a
+    reentrant `_write_lock` held around every write.
+    """
+
+    def __init__(self, guild_scoped: bool, reader_count: int = 0):
+        """
+        Initialize the state every backend shares.
+
+        Args:
+            guild_scoped (bool): Keep karma per guild instead of globally.
+            reader_count (int): Number of reads the backend serves concurrently.
+        """
+        self.guild_scoped = guild_scoped
+        self.reader_count = reader_count
+        self.registry_buffer = RegistryBuffer()
+        self.registry_cache = RegistryCache()
+        # Hits are registry writes skipped because nothing changed.
+        metrics.track_cache("registry", self.registry_cache)
+        self._pruned_day = None
+
+    @abstractmethod
+    def close(self) -> None:
+        """Release the backend's connections or files."""
+
+    def karma_key(self, user_id: int, guild_id: int | None = None):
+        """Return the key identifying a user's karma row, e.g. for spam tracking."""
+        if self.guild_scoped and guild_id is not None:
+            return (guild_id, user_id)
+        return user_id
+
+    # Karma
+
+    @abstractmethod
+    def migrate_to_guild_scope(self) -> int:
+        """
+        Seed per-guild karma from the global karma of current members, once.
+
+        Returns:
+            int: The number of per-guild karma rows created.
+        """
+
+    @abstractmethod
+    def create(self, user_id: int, karma: int = 0, guild_id: int | None = None) -> None:
+        """Add a user with an initial karma value, unless they already exist."""
+
+    @abstractmethod
+    def get_karma(self, user_id: int, guild_id: int | None = None) -> int | None:
+        """Return a user's karma, or None if the user does not exist."""
+
+    @abstractmethod
+    def update(self, user_id: int, delta: int, guild_id: int | None = None) -> None:
+        """Add a delta to an existing user's karma and stamp last_karma."""
+
+    @abstractmethod
+    def apply_karma(
+        self,
+        user_id: int,
+        delta: int,
+        spam_delay: int = KARMA_SPAM_DELAY,
+        guild_id: int | None = None,
+        giver_id: int | None = None,
+        message_id: int | None = None,
+    ) -> KarmaUpdate:
+        """
+        Atomically create the user if needed, enforce the spam delay, and
+        apply a karma delta.
+
+        Returns:
+            KarmaUpdate: The user's karma after the call, whether the delta
+                was applied, and the stored last_karma timestamp.
+        """
+
+    @abstractmethod
+    def apply_karma_batch(
+        self,
+        changes: list[tuple[int, int]],
+        spam_delay: int = KARMA_SPAM_DELAY,
+        guild_id: int | None = None,
+        giver_id: int | None = None,
+        message_id: int | None = None,
+    ) -> list[KarmaUpdate]:
+        """
+        Apply several (user_id, delta) changes from one message in a single
+        transaction, each as apply_karma would.
+
+        Returns:
+            list[KarmaUpdate]: One result per change, in order.
+        """
+
+    @abstractmethod
+    def delete(self, user_id: int, guild_id: int | None = None) -> None:
+        """Remove a user's karma."""
+
+    @abstractmethod
+    def can_update_karma(self, user_id: int, guild_id: int | None = None) -> bool:
+        """Return True if the spam delay has passed since the user's last change."""
+
+    @abstractmethod
+    def recent_karma_changes(self, since: int) -> list[tuple]:
+        """Return (karma_key, last_karma) pairs changed at or after `since`."""
+
+    @abstractmethod
+    def all_user_ids_and_karma(
+        self, chunk_size: int = EXPORT_CHUNK_SIZE
+    ) -> Iterator[tuple[int, int]]:
+        """Stream (user_id, karma) for every user, summed over guilds."""
+
+    @abstractmethod
+    def all_user_ids(self, chunk_size: int = EXPORT_CHUNK_SIZE) -> Iterator[int]:
+        """Stream every karma-tracked user ID."""
+
+    @abstractmethod
+    def karma_user_count(self) -> int:
+        """Return the number of karma-tracked users."""
+
+    # Registry
+
+    @abstractmethod
+    def upsert_guild(self, guild_id: int, guild_name: str) -> None:
+        """Insert or update a guild in the local registry."""
+
+    @abstractmethod
+    def upsert_user(self, user_id: int, user_name: str) -> None:
+        """Insert or update a user in the local registry."""
+
+    @abstractmethod
+    def upsert_user_nickname(
+        self,
+        user_id: int,
+        guild_id: int,
+        nickname: str | None,
+        is_member: int | None,
+    ) -> None:
+        """Insert or update a user's guild-specific name and membership state."""
+
+    @abstractmethod
+    def write_registry_batch(self, guilds: list, users: list, nicknames: list) -> None:
+        """
+        Upsert many registry rows at once.
+
+        Args:
+            guilds (list): (guild_id, guild_name) tuples.
+            users (list): (user_id, user_name) tuples.
+            nicknames (list): (user_id, guild_id, nickname, is_member) tuples.
+        """
+
+    @abstractmethod
+    def _write_member_sync(
+        self, guild_id: int, guild_name: str, members: list[tuple[int, str, str | None]]
+    ) -> tuple[MemberSync, list[int]]:
+        """Diff and write a guild member sync; returns the counts and departed IDs."""
+
+    @abstractmethod
+    def prune_karma_buckets(self, before_day: int) -> int:
+        """Delete daily karma totals older than `before_day`; returns the count."""
+
+    def flush_registry(self) -> int:
+        """
+        Write every buffered registry upsert in one batch.
+
+        Returns:
+            int: The number of rows written.
+        """
+        guilds, users, nicknames = self.registry_buffer.drain()
+        count = len(guilds) + len(users) + len(nicknames)
+        if not count:
+            return 0
+
+        try:
+            self.write_registry_batch(guilds, users, nicknames)
+        except Exception:
+            self.registry_buffer.requeue(guilds, users, nicknames)
+            raise
+        return count
+
+    def flush(self) -> int:
+        """
+        Write all buffered registry rows.
+
+        The first flush of each day also prunes expired karma buckets.
+
+        Returns:
+            int: The number of rows written.
+        """
+        written = self.flush_registry()
+        today = int(time.time()) // SECONDS_PER_DAY
+        if self._pruned_day != today:
+            self.prune_karma_buckets(today - max(LEADERBOARD_WINDOWS.values()))
+            self._pruned_day = today
+        return written
+
+    def sync_guild_members(
+        self, guild_id: int, guild_name: str, members: list[tuple[int, str, str | None]]
+    ) -> MemberSync:
+        """
+        Reconcile a guild's registry rows with its full current member list.
+
+        The stored rows are diffed against `members`, and only joins, leaves,
+        name and nickname changes are written, all at once.  The registry
+        cache is primed with the result so later messages from these members
+        skip the registry entirely.
+
+        Args:
+            guild_id (int): The guild to sync.
+            guild_name (str): The guild's current name.
+            members (list): (user_id, user_name, nickname) for every member.
+
+        Returns:
+            MemberSync: Counts of members who joined (or rejoined), left,
+                and changed name or nickname.
+        """
+        # Buffered rows are older than the member list; write them first so
+        # the diff sees them.
+        self.flush_registry()
+        sync, departed = self._write_member_sync(guild_id, guild_name, members)
+
+        self.registry_cache.guild_changed(guild_id, guild_name)
+        for user_id, user_name, nickname in members:
+            self.registry_cache.member_changed(user_id, guild_id, user_name, nickname, 1)
+        for user_id in departed:
+            self.registry_cache.forget_member(user_id, guild_id)
+        return sync
+
+    def record_guild(self, guild) -> None:
+        """Buffer a guild from Discord for the local registry if it changed."""
+        if self.registry_cache.guild_changed(guild.id, guild.name):
+            self.registry_buffer.add_guild(guild.id, guild.name)
+
+    def _record_member_state(
+        self, member, guild, nickname: str | None, is_member: int | None
+    ) -> None:
+        """Buffer a user's name and guild membership state if either changed."""
+        guild_id = guild.id if guild is not None else None
+        if not self.registry_cache.member_changed(
+            member.id, guild_id, member.name, nickname, is_member
+        ):
+            return
+
+        self.registry_buffer.add_user(member.id, member.name)
+        if guild is not None:
+            self.registry_buffer.add_nickname(member.id, guild.id, nickname, is_member)
+
+    def record_member(self, member, guild=None) -> None:
+        """Buffer a member or user plus any guild-specific nickname if changed."""
+        target_guild = guild or getattr(member, "guild", None)
+        if target_guild is None:
+            self._record_member_state(member, None, None, None)
+            return
+
+        self.record_guild(target_guild)
+        self._record_member_state(
+            member, target_guild, getattr(member, "nick", None), 1
+        )
+
+    def record_departed_member(self, member, guild=None) -> None:
+        """Buffer a user as not currently belonging to a guild if not already."""
+        target_guild = guild or getattr(member, "guild", None)
+        if target_guild is None:
+            return
+
+        self.record_guild(target_guild)
+        self._record_member_state(member, target_guild, None, 0)
+
+    def record_message(self, message) -> None:
+        """Buffer the message's guild, author, and mentions for the registry."""
+        if message.guild is None:
+            return
+
+        self.record_guild(message.guild)
+        for member in (message.author, *message.mentions):
+            self._record_member_state(
+                member, message.guild, getattr(member, "nick", None), 1
+            )
+
+    # Export and import
+
+    @abstractmethod
+    def export_rows(
+        self, table: str, chunk_size: int = EXPORT_CHUNK_SIZE
+    ) -> Iterator[tuple]:
+        """Stream every row of one of EXPORT_TABLES, in its column order."""
+
+    @abstractmethod
+    def import_rows(
+        self, table: str, rows: Iterable[tuple], chunk_size: int = EXPORT_CHUNK_SIZE
+    ) -> int:
+        """Upsert a stream of rows into one of EXPORT_TABLES; returns the count."""
+
+    # Ranked queries
+    #
+    # These only read.  Membership comes from stored registry rows, so call
+    # flush_registry first to make buffered joins and leaves count.
+
+    def get_top_karma_entries(self, guild_id: int, limit: int) -> list:
+        """Return the highest-karma users with locally cached names."""
+        return self._get_ranked_karma_entries(guild_id, limit, descending=True)
+
+    def get_bottom_karma_entries(self, guild_id: int, limit: int) -> list:
+        """Return the lowest-karma users with locally cached names."""
+        return self._get_ranked_karma_entries(guild_id, limit, descending=False)
+
+    @abstractmethod
+    def _get_ranked_karma_entries(
+        self, guild_id: int, limit: int, descending: bool
+    ) -> list:
+        """Return a guild's current members ranked by karma, ties by user ID."""
+
+    @abstractmethod
+    def get_windowed_karma_entries(
+        self, guild_id: int, days: int, limit: int, descending: bool = True
+    ) -> list:
+        """
+        Return users ranked by the karma they were given in the last few days.
+
+        Args:
+            guild_id (int): The guild to rank current members of.
+            days (int): Window length in days, including today.
+            limit (int): Maximum rows to return.
+            descending (bool): Most karma first when True, least when False.
+
+        Returns:
+            list: user_id, karma, user_name and nickname rows.
+        """
+
+    @abstractmethod
+    def member_karma_rows(self) -> list[tuple[int, int, int]]:
+        """Return (guild_id, user_id, karma) for every current guild member."""
+
+    # Backfill
+
+    @abstractmethod
+    def all_guild_ids(self) -> list[int]:
+        """Return all guild IDs in the local registry, ascending."""
+
+    @abstractmethod
+    def registry_backfill_plan(self, guild_id: int, after_user_id: int = 0) -> list[int]:
+        """Return karma users above `after_user_id` missing registry data for a guild."""
+
+    @abstractmethod
+    def mark_departed(self, guild_id: int, user_ids: list[int]) -> None:
+        """Record users as not in a guild, adding placeholder names if needed."""
+
+    @abstractmethod
+    def needs_registry_backfill(self, user_id: int, guild_id: int) -> bool:
+        """Return True when we are missing user or guild-specific name data."""
+
+    @abstractmethod
+    def has_user_registry_entry(self, user_id: int) -> bool:
+        """Return True if the user exists in the local registry."""
+
+
+def open_storage(backend: str | None = None) -> StorageBackend:
+    """
+    Open the configured storage backend with its default settings.
+
+    Args:
+        backend (str, optional): "sqlite" or "memory". Defaults to
+            STORAGE_BACKEND.
+
+    Returns:
+        StorageBackend: The opened backend.
+    """
+    backend = backend or STORAGE_BACKEND
+    # Imported here, since both backends import this module.
+    if backend == "sqlite":
+        from db import KarmaDatabase
+
+        return KarmaDatabase()
+    if backend == "memory":
+        from memory_db import MemoryKarmaDatabase
+
+        return MemoryKarmaDatabase()
+    raise ValueError(f"Unknown storage backend: {backend!r}")
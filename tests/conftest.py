@@ -0,0 +1,19 @@
+"""Shared setup for Karmabot's tests.
+
+The bot's modules live at the top of the repository, and settings.py reads
+the Discord API key from the working directory as soon as it is imported.
+The tests never connect to Discord, so they run from a scratch directory
+holding a placeholder key.
+"""
+
+import os
+import sys
+import tempfile
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+_workdir = tempfile.mkdtemp(prefix="karmabot-tests-")
+with open(os.path.join(_workdir, "discordapikey.txt"), "w", encoding="utf-8") as file:
+    file.write("placeholder")
+os.chdir(_workdir)
@@ -0,0 +1,47 @@
+"""Tests for the single-pass karma command parser."""
+
+from karma_parser import ADJUST, QUERY, RANK, KarmaCommand, parse_karma_commands
+
+
+def test_messages_without_mentions_have_no_commands():
+    assert parse_karma_commands("just chatting ++ karma") == {}
+
+
+def test_adjustments_count_their_symbols():
+    assert parse_karma_commands("<@1> +++ and <@!2> --") == {
+        1: KarmaCommand(1, ADJUST, 3),
+        2: KarmaCommand(2, ADJUST, -2),
+    }
+
+
+def test_keywords_are_case_insensitive_queries():
+    assert parse_karma_commands("<@1> KARMA <@2>rank") == {
+        1: KarmaCommand(1, QUERY),
+        2: KarmaCommand(2, RANK),
+    }
+
+
+def test_keywords_must_be_whole_words():
+    assert parse_karma_commands("<@1> karmaless <@2> ranked") == {}
+
+
+def test_a_query_wins_over_an_adjustment():
+    assert parse_karma_commands("<@1> ++ then <@1> karma") == {1: KarmaCommand(1, QUERY)}
+
+
+def test_the_first_keyword_wins():
+    assert parse_karma_commands("<@1> rank <@1> karma") == {1: KarmaCommand(1, RANK)}
+
+
+def test_only_the_first_adjustment_counts():
+    assert parse_karma_commands("<@1> ++ <@1> ---") == {1: KarmaCommand(1, ADJUST, 2)}
+
+
+def test_mixed_symbols_give_no_command():
+    assert parse_karma_commands("<@1> +-+ <@1> ++ <@2> -") == {
+        2: KarmaCommand(2, ADJUST, -1)
+    }
+
+
+def test_mentions_without_a_command_are_ignored():
+    assert parse_karma_commands("hi <@1>, <@2> is great") == {}
@@ -0,0 +1,63 @@
+"""Tests for patching cached leaderboards as karma changes."""
+
+import random
+
+from leaderboard import LeaderboardCache, _bottom_key, _patch_ranking, _top_key
+
+GUILD = 10
+
+
+def ranking(karma: dict, key, limit: int) -> list[dict]:
+    """Return what the database would: the first `limit` rows by `key`."""
+    rows = [{"user_id": user_id, "karma": value} for user_id, value in karma.items()]
+    return sorted(rows, key=key)[:limit]
+
+
+def test_patching_matches_a_fresh_ranking_or_asks_for_one():
+    rng = random.Random(3)
+    for key in (_top_key, _bottom_key):
+        for _ in range(500):
+            limit = rng.randint(1, 5)
+            karma = {user_id: rng.randint(-5, 5) for user_id in range(rng.randint(0, 8))}
+            rows = ranking(karma, key, limit)
+            user_id = rng.randrange(10)
+            new_karma = rng.randint(-8, 8)
+            if user_id in karma:
+                karma[user_id] = new_karma
+
+            if _patch_ranking(rows, user_id, new_karma, key, limit):
+                assert rows == ranking(karma, key, limit)
+
+
+def test_a_change_outside_the_cut_keeps_the_ranking():
+    karma = {1: 9, 2: 7, 3: 5, 4: 1}
+    rows = ranking(karma, _top_key, 3)
+
+    assert _patch_ranking(rows, 4, 2, _top_key, 3)
+    assert [row["user_id"] for row in rows] == [1, 2, 3]
+
+
+def test_a_user_sliding_to_last_place_needs_a_refetch():
+    rows = ranking({1: 9, 2: 7, 3: 5, 4: 4}, _top_key, 3)
+
+    assert not _patch_ranking(rows, 2, 3, _top_key, 3)
+
+
+def test_an_entrant_to_a_short_ranking_needs_a_refetch():
+    rows = ranking({1: 9}, _top_key, 3)
+
+    assert not _patch_ranking(rows, 2, 0, _top_key, 3)
+
+
+def test_cache_patches_or_drops_entries_on_karma_changes():
+    cache = LeaderboardCache(ttl=60)
+    karma = {1: 9, 2: 7, 3: 5, 4: 1}
+    cache.put(GUILD, 2, ranking(karma, _top_key, 2), ranking(karma, _bottom_key, 2))
+
+    cache.karma_changed(2, 8, GUILD)
+    top, bottom = cache.get(GUILD, 2)
+    assert [(row["user_id"], row["karma"]) for row in top] == [(1, 9), (2, 8)]
+    assert [row["user_id"] for row in bottom] == [4, 3]
+
+    cache.karma_changed(4, 6, GUILD)
+    assert cache.get(GUILD, 2) is None
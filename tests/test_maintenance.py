@@ -0,0 +1,38 @@
+"""Tests for the database maintenance tasks."""
+
+import os
+import time
+
+import pytest
+
+from db import KarmaDatabase
+from maintenance import MaintenanceScheduler
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = KarmaDatabase(str(tmp_path / "karma.sqlite3"), reader_count=1)
+    yield db
+    db.close()
+
+
+def test_backups_in_the_same_second_do_not_overwrite(db, tmp_path, monkeypatch):
+    monkeypatch.setattr(time, "strftime", lambda _: "20260101-120000")
+    scheduler = MaintenanceScheduler(db, backup_dir=str(tmp_path / "b"), backup_keep=2)
+
+    paths = [scheduler.backup() for _ in range(3)]
+
+    assert len(set(paths)) == 3
+    assert sorted(os.listdir(tmp_path / "b")) == [
+        "karma-20260101-120000.1.sqlite3",
+        "karma-20260101-120000.2.sqlite3",
+    ]
+
+
+def test_passive_checkpoint_copies_the_log(db):
+    db.apply_karma(1, 2, spam_delay=0)
+
+    assert db.checkpoint()
+    assert db.checkpoint("TRUNCATE")
+    with pytest.raises(ValueError):
+        db.checkpoint("FULL")
@@ -0,0 +1,86 @@
+"""Tests for the skiplist-backed karma rankings."""
+
+import random
+
+import pytest
+
+from rank_index import IndexableSkiplist, RankIndex
+
+
+def test_skiplist_matches_a_sorted_list_under_random_edits():
+    rng = random.Random(7)
+    # The skiplist draws node levels from the global generator.
+    random.seed(7)
+    skiplist = IndexableSkiplist()
+    expected = []
+    for _ in range(2000):
+        if expected and rng.random() < 0.4:
+            key = rng.choice(expected)
+            skiplist.remove(key)
+            expected.remove(key)
+        else:
+            key = rng.randrange(10_000)
+            if key in expected:
+                continue
+            skiplist.insert(key)
+            expected.append(key)
+        expected.sort()
+        assert len(skiplist) == len(expected)
+
+    assert [skiplist[index] for index in range(len(skiplist))] == expected
+    for position, key in enumerate(expected):
+        assert skiplist.rank(key) == position
+    assert skiplist.rank(-1) == 0
+    assert skiplist.rank(10_000) == len(expected)
+
+
+def test_skiplist_rejects_missing_keys_and_positions():
+    skiplist = IndexableSkiplist()
+    skiplist.insert(5)
+
+    with pytest.raises(KeyError):
+        skiplist.remove(4)
+    with pytest.raises(IndexError):
+        skiplist[1]
+
+
+def test_rank_orders_by_karma_then_user_id():
+    index = RankIndex()
+    index.load([(10, 1, 5), (10, 2, 9), (10, 3, 5), (20, 1, 5)])
+
+    assert index.rank(10, 2) == (1, 3)
+    assert index.rank(10, 1) == (2, 3)
+    assert index.rank(10, 3) == (3, 3)
+    assert index.rank(20, 1) == (1, 1)
+    assert index.rank(10, 4) is None
+
+
+def test_global_karma_changes_move_the_user_in_every_guild():
+    index = RankIndex(guild_scoped=False)
+    index.load([(10, 1, 5), (10, 2, 9), (20, 1, 5), (20, 3, 1)])
+
+    index.karma_changed(1, 20, 10)
+
+    assert index.rank(10, 1) == (1, 2)
+    assert index.karma_of(20, 1) == 20
+
+
+def test_guild_karma_changes_stay_in_their_guild():
+    index = RankIndex(guild_scoped=True)
+    index.load([(10, 1, 5), (20, 1, 5)])
+
+    index.karma_changed(1, 20, 10)
+
+    assert index.karma_of(10, 1) == 20
+    assert index.karma_of(20, 1) == 5
+
+
+def test_around_lists_neighbours_best_first():
+    index = RankIndex()
+    index.load([(10, user_id, user_id) for user_id in range(1, 8)])
+
+    assert index.around(10, 4, radius=1) == [(3, 5, 5), (4, 4, 4), (5, 3, 3)]
+    assert index.around(10, 7, radius=2) == [(1, 7, 7), (2, 6, 6), (3, 5, 5)]
+
+    index.remove_member(10, 5)
+    assert index.around(10, 4, radius=1) == [(2, 6, 6), (3, 4, 4), (4, 3, 3)]
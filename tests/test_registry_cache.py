@@ -0,0 +1,46 @@
+"""Tests for the registry change-detection cache."""
+
+from registry_cache import RegistryCache
+
+GUILD = 10
+OTHER_GUILD = 20
+ALICE = 1
+BOB = 2
+
+
+def test_unchanged_state_counts_as_a_hit():
+    cache = RegistryCache()
+
+    assert cache.member_changed(ALICE, GUILD, "alice", "al", 1)
+    assert not cache.member_changed(ALICE, GUILD, "alice", "al", 1)
+    assert cache.member_changed(ALICE, GUILD, "alice", "ally", 1)
+
+    assert (cache.hits, cache.misses) == (1, 2)
+    assert cache.hit_rate() == 1 / 3
+
+
+def test_forget_user_drops_every_guild_entry():
+    cache = RegistryCache()
+    for guild_id in (GUILD, OTHER_GUILD, None):
+        cache.member_changed(ALICE, guild_id, "alice")
+    cache.member_changed(BOB, GUILD, "bob")
+
+    cache.forget_user(ALICE)
+
+    for guild_id in (GUILD, OTHER_GUILD, None):
+        assert cache.member_changed(ALICE, guild_id, "alice")
+    assert not cache.member_changed(BOB, GUILD, "bob")
+
+
+def test_forget_user_skips_evicted_entries():
+    cache = RegistryCache(max_size=2)
+    cache.member_changed(ALICE, GUILD, "alice")
+    cache.member_changed(ALICE, OTHER_GUILD, "alice")
+    cache.member_changed(BOB, GUILD, "bob")
+    cache.forget_member(ALICE, OTHER_GUILD)
+
+    cache.forget_user(ALICE)
+    cache.forget_user(BOB)
+
+    assert cache.member_changed(BOB, GUILD, "bob")
+    assert cache._user_guilds == {BOB: {GUILD}}
@@ -0,0 +1,44 @@
+"""Tests for packing replies into Discord messages."""
+
+from reply_queue import split_message
+
+
+def test_short_entries_share_one_message():
+    assert split_message(["a", "b", "c"], max_length=10) == ["a\nb\nc"]
+
+
+def test_entries_start_a_new_message_when_full():
+    assert split_message(["aaaa", "bbbb", "cc"], max_length=9) == ["aaaa\nbbbb", "cc"]
+
+
+def test_long_entries_split_on_lines_and_long_lines_are_cut():
+    messages = split_message(["one\ntwo\n" + "x" * 12], max_length=5)
+
+    assert messages == ["one", "two", "xxxxx", "xxxxx", "xx"]
+    assert all(len(message) <= 5 for message in messages)
+
+
+def test_code_blocks_are_closed_and_reopened_across_messages():
+    board = "Top:\n```py\n" + "\n".join(f"{n}. user{n}" for n in range(1, 9)) + "\n```"
+
+    messages = split_message([board], max_length=30)
+
+    assert len(messages) > 1
+    assert all(len(message) <= 30 for message in messages)
+    for message in messages:
+        assert message.count("```") % 2 == 0
+    assert all(message.startswith("```py\n") for message in messages[1:])
+    body = [
+        line for message in messages for line in message.split("\n") if "```" not in line
+    ]
+    assert body == [line for line in board.split("\n") if "```" not in line]
+
+
+def test_inline_fences_are_tracked_too():
+    stats = "Stats:\n```uptime 1s\n" + "\n".join(["row"] * 6) + "```"
+
+    messages = split_message([stats], max_length=20)
+
+    assert all(len(message) <= 20 for message in messages)
+    assert all(message.count("```") % 2 == 0 for message in messages)
+    assert messages[-1].endswith("row```")
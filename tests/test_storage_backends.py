@@ -0,0 +1,260 @@
+"""Checks every storage backend must pass, run against each of them."""
+
+import time
+
+import pytest
+
+from db import MIGRATIONS, KarmaDatabase
+from memory_db import MemoryKarmaDatabase
+from storage import EXPORT_TABLES
+
+BACKENDS = ("sqlite", "memory")
+
+GUILD = 10
+OTHER_GUILD = 20
+ALICE = 1
+BOB = 2
+CAROL = 3
+
+
+def make_db(backend: str, directory, guild_scoped: bool = False):
+    """Open a backend whose files live in `directory`."""
+    if backend == "sqlite":
+        return KarmaDatabase(
+            str(directory / "karma.sqlite3"), reader_count=1, guild_scoped=guild_scoped
+        )
+    return MemoryKarmaDatabase(
+        str(directory / "db.journal"),
+        str(directory / "db.snapshot"),
+        guild_scoped=guild_scoped,
+    )
+
+
+@pytest.fixture(params=BACKENDS)
+def open_db(request, tmp_path):
+    """Return a function that opens the backend under test, closing it afterwards."""
+    opened = []
+
+    def open_db(guild_scoped: bool = False):
+        db = make_db(request.param, tmp_path, guild_scoped)
+        opened.append(db)
+        return db
+
+    yield open_db
+    for db in opened:
+        db.close()
+
+
+def populate(db) -> None:
+    """Register a guild with a current and a departed member, and give karma."""
+    db.upsert_guild(GUILD, "Guild")
+    db.upsert_user(ALICE, "alice")
+    db.upsert_user(BOB, "bob")
+    db.upsert_user(CAROL, "carol")
+    db.upsert_user_nickname(ALICE, GUILD, "al", 1)
+    db.upsert_user_nickname(BOB, GUILD, None, 1)
+    db.upsert_user_nickname(CAROL, GUILD, None, 0)
+    db.apply_karma(ALICE, 3, spam_delay=0, guild_id=GUILD, giver_id=BOB)
+    db.apply_karma(BOB, -2, spam_delay=0, guild_id=GUILD, giver_id=ALICE)
+    db.apply_karma(CAROL, 4, spam_delay=0, guild_id=GUILD, giver_id=ALICE)
+
+
+def exported(db) -> dict:
+    """Return every exportable row, table by table."""
+    return {table: sorted(db.export_rows(table)) for table in EXPORT_TABLES}
+
+
+def test_spam_delay_blocks_changes_inside_the_window(open_db, monkeypatch):
+    db = open_db()
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now)
+
+    first = db.apply_karma(ALICE, 2, spam_delay=60)
+    second = db.apply_karma(ALICE, 5, spam_delay=60)
+
+    assert first.applied and first.karma == 2
+    assert not second.applied and second.karma == 2
+    assert db.get_karma(ALICE) == 2
+
+
+def test_spam_delay_lets_changes_through_after_the_window(open_db, monkeypatch):
+    db = open_db()
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now)
+    db.apply_karma(ALICE, 2, spam_delay=60)
+
+    monkeypatch.setattr(time, "time", lambda: now + 61)
+    later = db.apply_karma(ALICE, 1, spam_delay=60)
+
+    assert later.applied and later.karma == 3
+    assert later.last_karma == int(now + 61)
+
+
+def test_spam_delay_applies_per_user_in_a_batch(open_db):
+    db = open_db()
+    db.apply_karma(ALICE, 1, spam_delay=60)
+
+    results = db.apply_karma_batch([(ALICE, 2), (BOB, 3)], spam_delay=60)
+
+    assert [result.applied for result in results] == [False, True]
+    assert (db.get_karma(ALICE), db.get_karma(BOB)) == (1, 3)
+
+
+def test_zero_spam_delay_disables_the_check(open_db):
+    db = open_db()
+    db.apply_karma(ALICE, 1, spam_delay=0)
+
+    assert db.apply_karma(ALICE, 1, spam_delay=0).applied
+    assert db.get_karma(ALICE) == 2
+
+
+def test_guild_scope_keeps_karma_per_guild(open_db):
+    db = open_db(guild_scoped=True)
+
+    db.apply_karma(ALICE, 3, spam_delay=0, guild_id=GUILD)
+    db.apply_karma(ALICE, -1, spam_delay=0, guild_id=OTHER_GUILD)
+    db.apply_karma(ALICE, 5, spam_delay=0)
+
+    assert db.get_karma(ALICE, GUILD) == 3
+    assert db.get_karma(ALICE, OTHER_GUILD) == -1
+    assert db.get_karma(ALICE) == 5
+    assert db.get_karma(BOB, GUILD) is None
+
+
+def test_global_scope_ignores_the_guild(open_db):
+    db = open_db()
+
+    db.apply_karma(ALICE, 3, spam_delay=0, guild_id=GUILD)
+    db.apply_karma(ALICE, 1, spam_delay=0, guild_id=OTHER_GUILD)
+
+    assert db.get_karma(ALICE, GUILD) == db.get_karma(ALICE) == 4
+
+
+def test_switching_to_guild_scope_seeds_current_members_once(open_db):
+    populate(open_db())
+
+    db = open_db(guild_scoped=True)
+    assert db.get_karma(ALICE, GUILD) == 3
+    assert db.get_karma(BOB, GUILD) == -2
+    assert db.get_karma(CAROL, GUILD) is None
+
+    db.delete(ALICE, GUILD)
+    db.delete(BOB, GUILD)
+    assert db.migrate_to_guild_scope() == 0
+
+    db = open_db(guild_scoped=True)
+    assert db.get_karma(ALICE, GUILD) is None
+
+
+@pytest.mark.parametrize("target", BACKENDS)
+@pytest.mark.parametrize("source", BACKENDS)
+def test_export_import_round_trip(source, target, tmp_path):
+    (tmp_path / "source").mkdir()
+    (tmp_path / "target").mkdir()
+    source_db = make_db(source, tmp_path / "source")
+    target_db = make_db(target, tmp_path / "target")
+    try:
+        populate(source_db)
+        rows = exported(source_db)
+
+        for table in EXPORT_TABLES:
+            assert target_db.import_rows(table, iter(rows[table]), chunk_size=2) == len(
+                rows[table]
+            )
+
+        assert exported(target_db) == rows
+        assert target_db.get_karma(ALICE) == 3
+    finally:
+        source_db.close()
+        target_db.close()
+
+
+def test_writes_survive_a_restart_without_close(open_db):
+    db = open_db()
+    populate(db)
+    db.apply_karma_batch(
+        [(ALICE, 2), (BOB, 1)], spam_delay=0, guild_id=GUILD, giver_id=CAROL
+    )
+    rows = exported(db)
+    week = db.get_windowed_karma_entries(GUILD, 7, 5)
+
+    # Opened alongside the first instance, which never snapshots or closes
+    # cleanly first, so everything must come back from what each write
+    # left on disk.
+    reopened = open_db()
+
+    assert exported(reopened) == rows
+    assert reopened.get_karma(ALICE) == 5
+    assert [(row["user_id"], row["karma"]) for row in week] == [(ALICE, 5), (BOB, -1)]
+    assert [
+        (row["user_id"], row["karma"])
+        for row in reopened.get_windowed_karma_entries(GUILD, 7, 5)
+    ] == [(ALICE, 5), (BOB, -1)]
+
+
+def test_memory_journal_drops_a_torn_last_write(tmp_path):
+    db = make_db("memory", tmp_path)
+    populate(db)
+    db.snapshot()
+    db.apply_karma(ALICE, 2, spam_delay=0)
+    db._journal.close()
+    with open(tmp_path / "db.journal", "a", encoding="utf-8") as journal:
+        journal.write('[["k",null,1,99')
+
+    reopened = make_db("memory", tmp_path)
+    try:
+        assert reopened.get_karma(ALICE) == 5
+        reopened.apply_karma(ALICE, 1, spam_delay=0)
+    finally:
+        reopened.close()
+
+    reopened = make_db("memory", tmp_path)
+    try:
+        assert reopened.get_karma(ALICE) == 6
+    finally:
+        reopened.close()
+
+
+class FailingJournal:
+    """Journal stand-in whose writes get part of the way and then fail."""
+
+    def __init__(self, journal):
+        self.journal = journal
+
+    def write(self, line):
+        self.journal.write(line[:5])
+        raise OSError(28, "No space left on device")
+
+    def __getattr__(self, name):
+        return getattr(self.journal, name)
+
+
+def test_memory_write_that_fails_to_journal_changes_nothing(tmp_path):
+    db = make_db("memory", tmp_path)
+    try:
+        db.apply_karma(ALICE, 2, spam_delay=0)
+        db._journal = FailingJournal(db._journal)
+
+        with pytest.raises(OSError):
+            db.apply_karma(ALICE, 3, spam_delay=0)
+
+        assert db.get_karma(ALICE) == 2
+        db.apply_karma(BOB, 1, spam_delay=0)
+        reopened = make_db("memory", tmp_path)
+        assert (reopened.get_karma(ALICE), reopened.get_karma(BOB)) == (2, 1)
+        reopened.close()
+    finally:
+        db.close()
+
+
+def test_sqlite_schema_version_does_not_depend_on_scope(tmp_path):
+    for guild_scoped in (False, True):
+        directory = tmp_path / str(guild_scoped)
+        directory.mkdir()
+        db = make_db("sqlite", directory, guild_scoped)
+        try:
+            with db._read() as conn:
+                version = conn.execute("PRAGMA user_version").fetchone()[0]
+            assert version == len(MIGRATIONS)
+        finally:
+            db.close()
@@ -2,11 +2,21 @@
 
 import discord
 
-from db import KarmaDatabase
+from async_db import shared_database
+from db import KarmaUpdate
 
 
 class User:
-    """Represents a user and provides methods to interact with the karma database."""
+    """
+    Represents a user and provides methods to interact with the karma database.
+
+    Users are created for every mention and leaderboard row, so they use
+    __slots__ and share the process-wide database.  A known karma value
+    (from a leaderboard row, an update or an earlier lookup) is carried
+    along and returned without a database call.
+    """
+
+    __slots__ = ("db", "id", "name", "display_name", "guild_id", "_karma")
 
     def __init__(
         self,
@@ -17,21 +27,29 @@ class User:
         name: str | None = None,
         display_name: str | None = None,
         karma: int | None = None,
+        guild_id: int | None = None,
     ):
         """
         Initialize a User object.
 
         Args:
             discord_user: A discord.Member or discord.User object.
-            db: Optional KarmaDatabase instance. If None, a new one is created.
+            db: Optional AsyncKarmaDatabase instance. If None, the process-wide
+                shared database is used.
+            guild_id: The guild whose karma this user carries, in guild-scoped
+                mode. Taken from discord_user when it is a Member.
         """
-        self.db = db if db is not None else KarmaDatabase()
+        self.db = db if db is not None else shared_database()
         self._karma = karma
+        self.guild_id = guild_id
 
         if discord_user is not None:
             self.id = discord_user.id
             self.name = discord_user.name
             self.display_name = discord_user.display_name
+            guild = getattr(discord_user, "guild", None)
+            if guild is not None:
+                self.guild_id = guild.id
             return
 
         if user_id is None or name is None or display_name is None:
@@ -43,38 +61,53 @@ class User:
         self.name = name
         self.display_name = display_name
 
-    def exists(self) -> bool:
+    async def exists(self) -> bool:
         """
         Check if the user exists in the database.
 
         Returns:
             bool: True if user exists, False otherwise.
         """
-        return self.db.get_karma(self.id) is not None
+        return await self.get_karma() is not None
 
-    def update_karma(self, delta: int) -> None:
+    async def update_karma(
+        self,
+        delta: int,
+        spam_delay: int = 0,
+        giver_id: int | None = None,
+        message_id: int | None = None,
+    ) -> KarmaUpdate:
         """
-        Update the user's karma by a given delta.
+        Update the user's karma by a given delta, creating the user if needed.
 
         Args:
             delta (int): The amount to change the user's karma by.
+            spam_delay (int, optional): Minimum seconds since the user's last
+                karma change. Defaults to 0 (no spam check).
+            giver_id (int, optional): Who gave the karma, for the event log.
+            message_id (int, optional): The triggering message, for the event log.
+
+        Returns:
+            KarmaUpdate: The user's resulting karma and whether the change
+                was applied.
         """
-        if not self.exists():
-            self.db.create(self.id)
-        self.db.update(self.id, delta)
-        if self._karma is not None:
-            self._karma += delta
+        result = await self.db.apply_karma(
+            self.id, delta, spam_delay, self.guild_id, giver_id, message_id
+        )
+        if result.karma is not None:
+            self._karma = result.karma
+        return result
 
-    def get_karma(self) -> int | None:
+    async def get_karma(self) -> int | None:
         """
         Retrieve the user's current karma.
 
         Returns:
             int or None: The user's karma, or None if not found.
         """
-        if self._karma is not None:
-            return self._karma
-        return self.db.get_karma(self.id)
+        if self._karma is None:
+            self._karma = await self.db.get_karma(self.id, self.guild_id)
+        return self._karma
 
     @classmethod
     def from_message(cls, message, db=None):
@@ -83,21 +116,21 @@ class User:
 
         Args:
             message: A discord.Message object.
-            db: Optional KarmaDatabase instance.
+            db: Optional AsyncKarmaDatabase instance.
 
         Returns:
             User: The corresponding User object.
         """
         return cls(message.author, db)
 
-    def can_update_karma(self) -> bool:
+    async def can_update_karma(self) -> bool:
         """
         Check if the user can update their karma based on the delay.
 
         Returns:
             bool: True if the user can update karma, False otherwise.
         """
-        return self.db.can_update_karma(self.id)
+        return await self.db.can_update_karma(self.id, self.guild_id)
 
     @classmethod
     async def from_id(cls, user_id: int, guild: discord.Guild, db=None):
@@ -107,7 +140,7 @@ class User:
         Args:
             user_id (int): The Discord user ID.
             guild (discord.Guild): The guild to search for the user.
-            db: Optional KarmaDatabase instance.
+            db: Optional AsyncKarmaDatabase instance.
 
         Returns:
             User: The corresponding User object, or None if not found.
@@ -121,13 +154,14 @@ class User:
         return cls(member, db)
 
     @classmethod
-    def from_registry_row(cls, row, db=None):
+    def from_registry_row(cls, row, db=None, guild_id=None):
         """
         Create a User object from a local registry/leaderboard query row.
 
         Args:
             row: A sqlite row containing user_id, karma, user_name, and nickname.
-            db: Optional KarmaDatabase instance.
+            db: Optional AsyncKarmaDatabase instance.
+            guild_id: Optional guild the row was ranked in.
 
         Returns:
             User: A lightweight user populated from cached local data.
@@ -140,4 +174,5 @@ class User:
             name=user_name,
             display_name=display_name,
             karma=row["karma"],
+            guild_id=guild_id,
         )